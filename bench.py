@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+###################################################################################################
+#Name:	bench.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Microbenchmarks the packet library (see packet/bench.py): parsing the IP and TCP headers,
+#       word_sum, calc_checksum and to_bytes over a corpus of bare ACKs, MSS-sized segments, SYNs
+#       with options and odd-length payloads. Reports ns/op, the noise between rounds and allocs/op,
+#       compares the scores (times against a reference loop) with the saved baseline and exits with
+#       status 1 if anything is still slower than the threshold and the noise allow when it's run
+#       again.
+#
+#       The baseline is a local file (bench_baseline.json, which isn't checked in) built up by
+#       running with --save a few times on the machine the comparisons will run on, so the spread
+#       between those runs is known; one taken on another machine or Python is refused rather than
+#       compared against.
+#
+#       Examples:
+#           ./bench.py
+#           ./bench.py --filter checksum --threshold 0.1
+#           ./bench.py --save
+#
+#    Revisions:
+#    2026-10-17 - Only compare against a baseline from this machine, allowing for the noise.
+#    2026-10-17 - Report benchmarks too noisy to gate on when saving a baseline.
+#
+###################################################################################################
+
+import argparse
+import os
+import sys
+from packet import bench
+
+BASELINE_PATH=os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Packet library microbenchmarks")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file (default: bench_baseline.json next to this script)")
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline instead of comparing")
+    parser.add_argument("--threshold", type=float, default=bench.DEFAULT_THRESHOLD,
+                        help="least slowdown that fails a benchmark, as a fraction; noisy ones are allowed more (default: " + str(bench.DEFAULT_THRESHOLD) + ")")
+    parser.add_argument("--filter", action="append", help="only run benchmarks whose names contain this; can be given more than once")
+    parser.add_argument("--rounds", type=int, default=bench.DEFAULT_ROUNDS, help="rounds per benchmark, of which the best counts (default: " + str(bench.DEFAULT_ROUNDS) + ")")
+    parser.add_argument("--run-time", type=float, default=bench.DEFAULT_RUN_TIME, help="seconds per timed run (default: " + str(bench.DEFAULT_RUN_TIME) + ")")
+    parser.add_argument("--repeat", type=int, default=bench.DEFAULT_REPEAT, help="timed runs per round (default: " + str(bench.DEFAULT_REPEAT) + ")")
+    args = parser.parse_args()
+
+    baseline = None
+    if not args.save:
+        try:
+            baseline = bench.load_baseline(args.baseline)
+        except FileNotFoundError:
+            print("No baseline at " + args.baseline + "; run with --save to make one")
+        except ValueError as e:
+            parser.error(str(e))
+        else:
+            if baseline.get("environment") != bench.environment():
+                parser.error("the baseline was taken on " + str(baseline.get("environment")) + ", not " + bench.environment() +
+                             "; run with --save to take one here")
+
+    results = bench.run(args.filter, args.rounds, args.run_time, args.repeat)
+    regressions = []
+    if baseline is not None:
+        regressions = bench.recheck(results, baseline, args.threshold, args.rounds, args.run_time, args.repeat)
+
+    print("%-28s %12s %8s %10s %10s %10s" % ("benchmark", "ns/op", "noise", "allocs/op", "baseline", "allowed"))
+    for name, result in results.items():
+        base = baseline["benchmarks"].get(name) if baseline is not None else None
+        change = ("%+.0f%%" % (bench.change(result, base) * 100)) if base else "-"
+        allowed = ("+%.0f%%" % (bench.allowance(base, args.threshold) * 100)) if base else "-"
+        print("%-28s %12.1f %7.0f%% %10.2f %10s %10s" % (name, result["ns"], result["noise"] * 100, result["allocs"], change, allowed))
+
+    if args.save:
+        bench.save_baseline(args.baseline, results)
+        runs = min(len(base["scores"]) for base in bench.load_baseline(args.baseline)["benchmarks"].values())
+        print("Saved run " + str(runs) + " of the last " + str(bench.HISTORY) + " to " + args.baseline +
+              ("" if runs > 1 else "; save a few more runs so the noise between them is known"))
+        noisy = bench.too_noisy(bench.load_baseline(args.baseline), args.threshold)
+        if noisy:
+            print("\nToo noisy to gate on at --threshold " + str(args.threshold) + " (allowance capped at +" +
+                  str(round(bench.ALLOWANCE_CAP * args.threshold * 100)) + "%):")
+            for message in noisy:
+                print("\t" + message)
+            print("Save again when the machine is quieter (the oldest run drops out after " + str(bench.HISTORY) +
+                  "), or delete " + args.baseline + " and start over")
+            sys.exit(1)
+    elif regressions:
+        print("\nRegressed past the threshold:")
+        for regression in regressions:
+            print("\t" + regression)
+        sys.exit(1)
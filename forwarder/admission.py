@@ -0,0 +1,116 @@
+###################################################################################################
+#Name:	admission.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Rate limits new connections per client. Every "inside" IP has a token bucket that fills at a
+#       fixed rate up to a burst size, and each SYN that matches a rule takes a token; a SYN that
+#       finds the bucket empty is dropped before it gets a NAT entry. Segments of existing connections
+#       never touch the buckets.
+#
+#       A flood from spoofed addresses gets a fresh bucket per address, so this only slows down real
+#       hosts; the NAT table's limits (see nat.py) are what bound the memory such a flood can use.
+#       The buckets themselves are bounded the same way: beyond max_sources, the least recently used
+#       bucket is forgotten, which only ever lets its host start over with a full bucket.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+from collections import OrderedDict
+
+# New connections per second per client, and how many can be opened at once after a quiet spell
+DEFAULT_SYN_RATE = 100.0
+DEFAULT_SYN_BURST = 200
+
+# The most clients with a bucket at once
+DEFAULT_MAX_SOURCES = 65536
+
+class SynLimiter:
+    __slots__ = ('rate', 'burst', 'max_sources', 'buckets', 'limited')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, rate = DEFAULT_SYN_RATE, burst = DEFAULT_SYN_BURST, max_sources = DEFAULT_MAX_SOURCES)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the limiter
+#    rate - tokens added to each bucket per second.
+#    burst - the most tokens a bucket holds.
+#    max_sources - the most buckets kept.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a limiter with no buckets. buckets maps an IP to a [tokens, last refill
+#    time] pair, least recently used first; limited counts the SYNs dropped.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, rate = DEFAULT_SYN_RATE, burst = DEFAULT_SYN_BURST, max_sources = DEFAULT_MAX_SOURCES):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_sources = max(1, max_sources)
+        self.buckets = OrderedDict()
+        self.limited = 0
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		allow
+#
+#    Prototype:	def allow(self, src_ip, now)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the limiter
+#    src_ip - the client's IP as a big-endian integer.
+#    now - the current time.monotonic().
+#
+#    Return Values:
+#    True if the client may open another connection.
+#
+#    Description:
+#    This function takes a token from the client's bucket, after topping it up for the time since
+#    its last SYN. A client seen for the first time starts with a full bucket.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def allow(self, src_ip, now):
+        buckets = self.buckets
+        bucket = buckets.get(src_ip)
+        if bucket is None:
+            if len(buckets) >= self.max_sources:
+                buckets.popitem(last=False)
+            buckets[src_ip] = [self.burst - 1, now]
+            return True
+
+        buckets.move_to_end(src_ip)
+        tokens = bucket[0] + (now - bucket[1]) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        bucket[1] = now
+
+        if tokens < 1:
+            bucket[0] = tokens
+            self.limited += 1
+            return False
+        bucket[0] = tokens - 1
+        return True
@@ -0,0 +1,343 @@
+###################################################################################################
+#Name:	backends.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       The packet I/O backends the single-process forwarder can run on. Every backend is a receiver
+#       and a sender with the batchio interface (recv; queue, queue_rewrite, flush and source_ip),
+#       plus a way to attach the prefilter, so the engine doesn't know which one it's using:
+#
+#       raw     - a raw TCP socket for both directions; the kernel builds the IP header and routes
+#                 each forwarded segment. This is the original forwarder.
+#       packet  - an AF_PACKET socket (optionally bound to one interface) for receiving, as the fanout
+#                 workers use, and a send-only raw socket for sending. Frames shorter than the
+#                 Ethernet minimum come with padding after the IP packet, which the engine cuts off
+#                 at the IP total length; receivers of any new backend must be trimmed the same way.
+#       tun     - a TUN device the host routes the forwarded traffic into; whole IP packets are read
+#                 and written (see forwarder/tun.py).
+#       memory  - queues in memory, for tests: packets pushed into the receiver come out of recv and
+#                 forwarded segments are collected by the sender.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+import queue
+from socket import socket, htons
+from socket import AF_INET, AF_PACKET, SOCK_DGRAM, SOCK_RAW, IPPROTO_TCP, SOL_SOCKET, SO_MARK
+from forwarder import batchio, bpf, fanout, tun
+from forwarder.engine import PacketCollector
+
+BACKENDS = ('raw', 'packet', 'tun', 'memory')
+
+class Backend:
+    __slots__ = ('name', 'receiver', 'sender', 'handles', '_attach_prefilter')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, name, receiver, sender, handles = (), attach_prefilter = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the backend
+#    name - one of BACKENDS.
+#    receiver - where packets come from (see batchio.BatchReceiver).
+#    sender - where forwarded segments go (see batchio.BatchSender).
+#    handles - the sockets and devices to close with the backend.
+#    attach_prefilter - called with (forward_rules, draining) to filter the receive side, or None
+#                       if the backend can't filter.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function bundles an opened backend. Use open_backend rather than creating one directly.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, name, receiver, sender, handles = (), attach_prefilter = None):
+        self.name = name
+        self.receiver = receiver
+        self.sender = sender
+        self.handles = handles
+        self._attach_prefilter = attach_prefilter
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		attach_prefilter
+#
+#    Prototype:	def attach_prefilter(self, forward_rules, draining = ())
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the backend
+#    forward_rules - the compiled forwarding rules (a rules.RuleTable).
+#    draining - RuleTables of rules that existing connections still use after a reload.
+#
+#    Return Values:
+#    True if a filter was attached.
+#
+#    Description:
+#    This function (re)attaches the prefilter (see bpf.attach_prefilter) to the receive side. It has
+#    the signature Engine.run expects of on_rules_changed.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def attach_prefilter(self, forward_rules, draining = ()):
+        if self._attach_prefilter is None:
+            return False
+        return self._attach_prefilter(forward_rules, draining)
+
+    def close(self):
+        for handle in self.handles:
+            handle.close()
+
+class MemoryReceiver:
+    __slots__ = ('batch_size', 'truncated', 'no_buffers', 'packets')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, batch_size = batchio.DEFAULT_BATCH_SIZE)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the receiver
+#    batch_size - the most packets returned by one recv.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a receiver fed by push, which may be called from another thread.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, batch_size = batchio.DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.truncated = 0
+        self.no_buffers = 0
+        self.packets = queue.SimpleQueue()
+
+    def push(self, packet):
+        self.packets.put(packet)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		recv
+#
+#    Prototype:	def recv(self, timeout)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the receiver
+#    timeout - the longest time to wait for a packet, in seconds.
+#
+#    Return Values:
+#    A list of the pushed packets, oldest first, possibly empty.
+#
+#    Description:
+#    This function waits for the first packet and returns it with whatever else is already queued,
+#    up to the batch size.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def recv(self, timeout):
+        try:
+            packets = [self.packets.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        while len(packets) < self.batch_size:
+            try:
+                packets.append(self.packets.get_nowait())
+            except queue.Empty:
+                break
+        return packets
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		open_raw_backend
+#
+#    Prototype:	def open_raw_backend(batch_size, buffer_size, use_mmsg, mark = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    batch_size - packets received/sent per system call.
+#    buffer_size - the largest packet that can be received or sent.
+#    use_mmsg - whether to use recvmmsg/sendmmsg.
+#    mark - the SO_MARK to put on forwarded packets, or None.
+#
+#    Return Values:
+#    A Backend.
+#
+#    Description:
+#    This function opens one raw TCP socket for both receiving and sending.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def open_raw_backend(batch_size, buffer_size, use_mmsg, mark = None):
+    s = socket(AF_INET, SOCK_RAW, IPPROTO_TCP)
+    s.bind(('', IPPROTO_TCP)) # '' binds to any (all?) available interface
+    if mark is not None:
+        s.setsockopt(SOL_SOCKET, SO_MARK, mark)
+
+    receiver = batchio.BatchReceiver(s, batch_size, buffer_size, use_mmsg)
+    sender = batchio.BatchSender(s, batch_size, buffer_size, use_mmsg)
+    return Backend('raw', receiver, sender, (s,), lambda forward_rules, draining: bpf.attach_prefilter(s, forward_rules, draining))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		open_packet_backend
+#
+#    Prototype:	def open_packet_backend(batch_size, buffer_size, use_mmsg, mark = None, interface = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    batch_size - packets received/sent per system call.
+#    buffer_size - the largest packet that can be received or sent.
+#    use_mmsg - whether to use recvmmsg/sendmmsg.
+#    mark - the SO_MARK to put on forwarded packets, or None.
+#    interface - the interface to listen on, or None for all of them.
+#
+#    Return Values:
+#    A Backend.
+#
+#    Description:
+#    This function opens an AF_PACKET socket that receives IP packets and ignores the host's own
+#    output, like a fanout worker's. Sending through it would mean resolving the next hop's link
+#    address ourselves, so forwarded segments go out through a send-only raw socket instead
+#    (see fanout.open_send_socket).
+#    Unlike the raw socket's, what this socket receives is the whole link-layer payload, so small
+#    packets (a bare ACK is 40 bytes) arrive padded to the 46-byte Ethernet minimum. The packets
+#    are handed on as received; Engine.handle_batch and PacketBatch.load trim them to the IP total
+#    length, and the backend only forwards the same bytes as raw because they do.
+#
+#    Revisions:
+#	2026-10-17 - Documented the Ethernet padding.
+#
+#########################################################################################################
+def open_packet_backend(batch_size, buffer_size, use_mmsg, mark = None, interface = None):
+    s = socket(AF_PACKET, SOCK_DGRAM, htons(fanout.ETH_P_IP))
+    if interface:
+        s.bind((interface, fanout.ETH_P_IP))
+    s.setsockopt(fanout.SOL_PACKET, fanout.PACKET_IGNORE_OUTGOING, 1)
+    send_socket = fanout.open_send_socket(mark)
+
+    receiver = batchio.BatchReceiver(s, batch_size, buffer_size, use_mmsg)
+    sender = batchio.BatchSender(send_socket, batch_size, buffer_size, use_mmsg)
+    return Backend('packet', receiver, sender, (s, send_socket), lambda forward_rules, draining: bpf.attach_prefilter(s, forward_rules, draining))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		open_tun_backend
+#
+#    Prototype:	def open_tun_backend(batch_size, buffer_size, mark = None, name = tun.DEFAULT_TUN_NAME)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    batch_size - packets read per wakeup and queued per flush.
+#    buffer_size - the largest packet that can be received or sent.
+#    mark - the firewall mark whose routes pick the source address, or None.
+#    name - the TUN device to open (or create).
+#
+#    Return Values:
+#    A Backend.
+#
+#    Description:
+#    This function opens a TUN device for both receiving and sending. It has no prefilter (see
+#    forwarder/tun.py).
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def open_tun_backend(batch_size, buffer_size, mark = None, name = tun.DEFAULT_TUN_NAME):
+    device = tun.TunDevice(name)
+    receiver = tun.TunReceiver(device, batch_size, buffer_size)
+    sender = tun.TunSender(device, batch_size, buffer_size, mark)
+    return Backend('tun', receiver, sender, (device,))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		open_backend
+#
+#    Prototype:	def open_backend(name, batch_size = batchio.DEFAULT_BATCH_SIZE, buffer_size = batchio.DEFAULT_BUFFER_SIZE, use_mmsg = True, mark = None, interface = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    name - one of BACKENDS.
+#    batch_size - packets received/sent per system call.
+#    buffer_size - the largest packet that can be received or sent.
+#    use_mmsg - whether to use recvmmsg/sendmmsg (socket backends only).
+#    mark - the SO_MARK to put on forwarded packets, or None.
+#    interface - the interface to listen on for the packet backend, or the TUN device's name for
+#                the tun backend; None for the default.
+#
+#    Return Values:
+#    A Backend.
+#
+#    Description:
+#    This function opens a backend by name. The memory backend's sender forwards from the address
+#    each packet was received on, since there's no route to look up.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def open_backend(name, batch_size = batchio.DEFAULT_BATCH_SIZE, buffer_size = batchio.DEFAULT_BUFFER_SIZE, use_mmsg = True, mark = None, interface = None):
+    if name == 'raw':
+        return open_raw_backend(batch_size, buffer_size, use_mmsg, mark)
+    if name == 'packet':
+        return open_packet_backend(batch_size, buffer_size, use_mmsg, mark, interface)
+    if name == 'tun':
+        return open_tun_backend(batch_size, buffer_size, mark, interface or tun.DEFAULT_TUN_NAME)
+    if name == 'memory':
+        return Backend('memory', MemoryReceiver(batch_size), PacketCollector())
+    raise ValueError("unknown backend " + repr(name) + "; expected one of " + ", ".join(BACKENDS))
@@ -0,0 +1,536 @@
+###################################################################################################
+#Name:	batchio.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Batched packet I/O for the forwarder. Packets are received into a ring of preallocated buffers
+#       and outgoing packets are copied into a second ring, so nothing is allocated per packet for I/O.
+#       On Linux the rings are filled and drained with recvmmsg/sendmmsg (through ctypes), i.e. one
+#       system call per batch; elsewhere, or if libc can't be loaded, recvmsg_into/sendto are used
+#       one packet at a time with the same interface.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+import ctypes
+import ctypes.util
+import errno
+import select
+from socket import socket, inet_ntop, inet_pton, htonl
+from socket import AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_MARK, MSG_DONTWAIT, MSG_TRUNC
+from packet import tcp
+
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_BUFFER_SIZE = 65535 # Large enough for GRO-merged segments
+RETRY_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR) # recvmmsg found nothing to read after all
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_uint16),
+                ('sin_addr', ctypes.c_uint32), ('sin_zero', ctypes.c_char * 8)]
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		load_mmsg
+#
+#    Prototype:	def load_mmsg()
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#
+#    Return Values:
+#    The libc handle with recvmmsg/sendmmsg prototypes set, or None if they aren't available.
+#
+#    Description:
+#    This function looks up recvmmsg and sendmmsg in the C library.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def load_mmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        libc.recvmmsg.restype = ctypes.c_int
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        libc.sendmmsg.restype = ctypes.c_int
+    except (OSError, AttributeError, TypeError):
+        return None
+    return libc
+
+class BufferRing:
+    __slots__ = ('count', 'size', 'storage', 'views', 'lengths')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, count, size)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the ring
+#    count - the number of buffers.
+#    size - the size of each buffer in bytes.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function allocates count buffers of size bytes in one contiguous block. views[i] is a
+#    memoryview of buffer i and lengths[i] is how much of it is currently in use.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def __init__(self, count, size):
+        self.count = count
+        self.size = size
+        self.storage = (ctypes.c_char * (count * size))()
+        whole = memoryview(self.storage).cast('B')
+        self.views = [whole[i * size:(i + 1) * size] for i in range(count)]
+        self.lengths = [0] * count
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		address_of
+#
+#    Prototype:	def address_of(self, index)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the ring
+#    index - a buffer index.
+#
+#    Return Values:
+#    The memory address of buffer index (for iovecs).
+#
+#    Description:
+#    This function returns where a buffer lives so the kernel can read or write it directly.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def address_of(self, index):
+        return ctypes.addressof(self.storage) + index * self.size
+
+class BatchReceiver:
+    __slots__ = ('sock', 'ring', 'truncated', 'no_buffers', '_libc', '_msgs', '_poll')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, sock, batch_size = DEFAULT_BATCH_SIZE, buffer_size = DEFAULT_BUFFER_SIZE, use_mmsg = True)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the receiver
+#    sock - the socket to read from; it's switched to non-blocking mode.
+#    batch_size - the most packets returned by one recv call.
+#    buffer_size - the largest packet that can be received without truncation.
+#    use_mmsg - whether to try recvmmsg before falling back to recvmsg_into.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a receiver with its own buffer ring.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def __init__(self, sock, batch_size = DEFAULT_BATCH_SIZE, buffer_size = DEFAULT_BUFFER_SIZE, use_mmsg = True):
+        self.sock = sock
+        self.ring = BufferRing(batch_size, buffer_size)
+        self.truncated = 0
+        self.no_buffers = 0
+        self._libc = load_mmsg() if use_mmsg else None
+        self._poll = select.poll()
+        self._poll.register(sock.fileno(), select.POLLIN)
+        sock.setblocking(False)
+
+        if self._libc is not None:
+            # The iovecs always point at the same buffers, so they're set up once
+            self._msgs = (mmsghdr * batch_size)()
+            iovecs = (iovec * batch_size)()
+            for i in range(batch_size):
+                iovecs[i].iov_base = self.ring.address_of(i)
+                iovecs[i].iov_len = buffer_size
+                self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+                self._msgs[i].msg_hdr.msg_iovlen = 1
+        else:
+            self._msgs = None
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		recv
+#
+#    Prototype:	def recv(self, timeout)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the receiver
+#    timeout - the longest time to wait for the first packet, in seconds.
+#
+#    Return Values:
+#    A list of memoryviews, one per packet received (empty if the wait timed out). The views are only
+#    valid until the next call to recv.
+#
+#    Description:
+#    This function waits for at least one packet, then takes as many more as are already queued,
+#    up to the batch size. Truncated packets are dropped and counted. A wakeup with nothing to read
+#    (another reader took the packet, or a signal arrived) just returns an empty batch, as does the
+#    kernel running out of buffers, which is counted; anything else is raised as an OSError.
+#
+#    Revisions:
+#	2026-10-17 - Return an empty batch on EAGAIN/EINTR/ENOBUFS instead of raising
+#    
+#########################################################################################################
+    def recv(self, timeout):
+        if not self._poll.poll(int(timeout * 1000)):
+            return []
+
+        ring = self.ring
+        views = ring.views
+        packets = []
+
+        if self._libc is not None:
+            count = self._libc.recvmmsg(self.sock.fileno(), ctypes.addressof(self._msgs), ring.count, MSG_DONTWAIT, None)
+            if count < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOBUFS:
+                    self.no_buffers += 1
+                elif err not in RETRY_ERRORS:
+                    raise OSError(err, "recvmmsg failed")
+                return packets
+
+            for i in range(count):
+                msg = self._msgs[i]
+                if msg.msg_hdr.msg_flags & MSG_TRUNC:
+                    self.truncated += 1
+                    continue
+                ring.lengths[i] = msg.msg_len
+                packets.append(views[i][:msg.msg_len])
+        else:
+            for i in range(ring.count):
+                try:
+                    length, ancdata, flags, address = self.sock.recvmsg_into([views[i]], 0, MSG_DONTWAIT)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError as e:
+                    if e.errno != errno.ENOBUFS:
+                        raise
+                    self.no_buffers += 1
+                    break
+
+                if flags & MSG_TRUNC:
+                    self.truncated += 1
+                    continue
+                ring.lengths[i] = length
+                packets.append(views[i][:length])
+
+        return packets
+
+class BatchSender:
+    __slots__ = ('sock', 'ring', 'pending', 'dropped', '_libc', '_msgs', '_iovecs', '_addrs', '_fallback_addrs', '_sources')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, sock, batch_size = DEFAULT_BATCH_SIZE, buffer_size = DEFAULT_BUFFER_SIZE, use_mmsg = True)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the sender
+#    sock - the socket to send on.
+#    batch_size - the number of packets that can be queued before they're flushed.
+#    buffer_size - the largest packet that can be queued.
+#    use_mmsg - whether to try sendmmsg before falling back to sendto.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a sender with its own buffer ring and destination addresses.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def __init__(self, sock, batch_size = DEFAULT_BATCH_SIZE, buffer_size = DEFAULT_BUFFER_SIZE, use_mmsg = True):
+        self.sock = sock
+        self.ring = BufferRing(batch_size, buffer_size)
+        self.pending = 0
+        self.dropped = 0
+        self._libc = load_mmsg() if use_mmsg else None
+        self._sources = {}
+
+        if self._libc is not None:
+            self._msgs = (mmsghdr * batch_size)()
+            self._iovecs = (iovec * batch_size)()
+            self._addrs = (sockaddr_in * batch_size)()
+            for i in range(batch_size):
+                self._iovecs[i].iov_base = self.ring.address_of(i)
+                self._addrs[i].sin_family = AF_INET
+                self._msgs[i].msg_hdr.msg_name = ctypes.addressof(self._addrs[i])
+                self._msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+                self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+                self._msgs[i].msg_hdr.msg_iovlen = 1
+            self._fallback_addrs = None
+        else:
+            self._msgs = None
+            self._iovecs = None
+            self._addrs = None
+            self._fallback_addrs = [None] * batch_size
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		queue
+#
+#    Prototype:	def queue(self, data, dst_ip)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the sender
+#    data - the packet to send (copied into the ring, so it can be reused right away).
+#    dst_ip - the destination IP as a big-endian integer.
+#
+#    Return Values:
+#    True if the packet was queued.
+#
+#    Description:
+#    This function queues a packet for the next flush, flushing first if the ring is full. Packets
+#    larger than the ring's buffers are dropped and counted.
+#
+#    Revisions:
+#	2026-10-17 - Return whether the packet was queued.
+#    
+#########################################################################################################
+    def queue(self, data, dst_ip):
+        length = len(data)
+        if length > self.ring.size:
+            self.dropped += 1
+            return False
+
+        if self.pending == self.ring.count:
+            self.flush()
+
+        index = self.pending
+        self.ring.views[index][:length] = data
+        self.ring.lengths[index] = length
+
+        if self._libc is not None:
+            self._iovecs[index].iov_len = length
+            self._addrs[index].sin_addr = htonl(dst_ip)
+        else:
+            self._fallback_addrs[index] = (inet_ntop(AF_INET, dst_ip.to_bytes(4, 'big')), 0)
+
+        self.pending += 1
+        return True
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		queue_rewrite
+#
+#    Prototype:	def queue_rewrite(self, data, dst_ip, src_port, dst_port, checksum)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the sender
+#    data - the received TCP segment to forward (copied into the ring).
+#    dst_ip - the destination IP as a big-endian integer.
+#    src_port - the source port to forward it from.
+#    dst_port - the destination port to forward it to.
+#    checksum - its checksum with the new ports and addresses.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function queues a segment like queue and then patches its ports and checksum in the ring
+#    buffer, so forwarding a segment makes no copy of it besides the one into the ring.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def queue_rewrite(self, data, dst_ip, src_port, dst_port, checksum):
+        if self.queue(data, dst_ip):
+            tcp.patch_header(self.ring.views[self.pending - 1], 0, src_port, dst_port, checksum)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		flush
+#
+#    Prototype:	def flush(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the sender
+#
+#    Return Values:
+#	
+#    Description:
+#    This function sends every queued packet. Packets the kernel won't take (e.g. because the socket
+#    buffer is full) are dropped and counted rather than retried.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def flush(self):
+        pending = self.pending
+        if not pending:
+            return
+        self.pending = 0
+
+        if self._libc is not None:
+            sent = 0
+            while sent < pending:
+                result = self._libc.sendmmsg(self.sock.fileno(), ctypes.addressof(self._msgs) + sent * ctypes.sizeof(mmsghdr), pending - sent, 0)
+                if result <= 0:
+                    # Skip the packet that failed and carry on with the rest
+                    self.dropped += 1
+                    sent += 1
+                else:
+                    sent += result
+        else:
+            views = self.ring.views
+            lengths = self.ring.lengths
+            for i in range(pending):
+                try:
+                    self.sock.sendto(views[i][:lengths[i]], self._fallback_addrs[i])
+                except (BlockingIOError, OSError):
+                    self.dropped += 1
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		source_ip
+#
+#    Prototype:	def source_ip(self, dst_ip, default)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the sender
+#    dst_ip - a destination IP as a big-endian integer.
+#    default - what to return if there's no route to dst_ip.
+#
+#    Return Values:
+#    The source IP the kernel will put on packets sent to dst_ip, as a big-endian integer.
+#
+#    Description:
+#    This function finds the source address for a destination, which the TCP checksum covers. The
+#    kernel picks it from the route, so on a multi-homed forwarder it isn't necessarily the address
+#    the packet came in on. The answer is found by connecting a UDP socket (with the send socket's
+#    mark, which may select the route) and cached per destination; route changes aren't picked up.
+#
+#    Revisions:
+#	2026-10-17 - Moved the route lookup to route_source.
+#    
+#########################################################################################################
+    def source_ip(self, dst_ip, default):
+        src_ip = self._sources.get(dst_ip)
+        if src_ip is not None:
+            return src_ip
+
+        src_ip = route_source(dst_ip, self.sock.getsockopt(SOL_SOCKET, SO_MARK))
+        if src_ip is None:
+            return default
+
+        self._sources[dst_ip] = src_ip
+        return src_ip
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		route_source
+#
+#    Prototype:	def route_source(dst_ip, mark = 0)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    dst_ip - a destination IP as a big-endian integer.
+#    mark - the SO_MARK packets to dst_ip are sent with (0 for none).
+#
+#    Return Values:
+#    The source IP of the route to dst_ip as a big-endian integer, or None if there's no route.
+#
+#    Description:
+#    This function asks the kernel which source address it would use for dst_ip by connecting a UDP
+#    socket (nothing is sent).
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def route_source(dst_ip, mark = 0):
+    probe = socket(AF_INET, SOCK_DGRAM)
+    try:
+        if mark:
+            probe.setsockopt(SOL_SOCKET, SO_MARK, mark)
+        probe.connect((inet_ntop(AF_INET, dst_ip.to_bytes(4, 'big')), 9))
+        return int.from_bytes(inet_pton(AF_INET, probe.getsockname()[0]), 'big')
+    except OSError:
+        return None
+    finally:
+        probe.close()
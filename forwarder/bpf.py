@@ -0,0 +1,588 @@
+###################################################################################################
+#Name:	bpf.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       A small classic BPF assembler and the programs the forwarder hands to the kernel. Programs are
+#       lists of (code, jt, jf, k) tuples; jt/jf (and k for BPF_JA) may name a label, which is placed
+#       in the list as a plain string. All offsets are from the start of the IP header, i.e. they're
+#       meant for sockets that deliver layer-3 packets (raw IP and SOCK_DGRAM packet sockets).
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+import ctypes
+import struct
+from socket import SOL_SOCKET
+
+# Instruction classes, sizes, modes and operations (linux/filter.h)
+BPF_LD = 0x00
+BPF_LDX = 0x01
+BPF_ALU = 0x04
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_MISC = 0x07
+
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+
+BPF_IMM = 0x00
+BPF_ABS = 0x20
+BPF_IND = 0x40
+BPF_MSH = 0xa0
+
+BPF_JA = 0x00
+BPF_JEQ = 0x10
+BPF_JGT = 0x20
+BPF_JGE = 0x30
+BPF_JSET = 0x40
+
+BPF_AND = 0x50
+BPF_K = 0x00
+BPF_X = 0x08
+BPF_A = 0x10
+
+SO_ATTACH_FILTER = 26
+SO_DETACH_FILTER = 27
+
+# Accept the whole packet
+ACCEPT = 0x40000
+
+IPPROTO_TCP = 6
+
+class sock_fprog(ctypes.Structure):
+    _fields_ = [('len', ctypes.c_ushort), ('filter', ctypes.c_void_p)]
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		stmt
+#
+#    Prototype:	def stmt(code, k = 0)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    code - the instruction's opcode.
+#    k - the instruction's constant (or a label name for BPF_JA).
+#
+#    Return Values:
+#    The instruction as a tuple.
+#
+#    Description:
+#    This function builds a non-conditional instruction (BPF_STMT).
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def stmt(code, k = 0):
+    return (code, 0, 0, k)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		jump
+#
+#    Prototype:	def jump(code, k, jt, jf)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    code - the jump opcode.
+#    k - the constant compared against A.
+#    jt - instructions to skip (or a label) if the comparison is true.
+#    jf - instructions to skip (or a label) if it's false.
+#
+#    Return Values:
+#    The instruction as a tuple.
+#
+#    Description:
+#    This function builds a conditional jump (BPF_JUMP).
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def jump(code, k, jt, jf):
+    return (code, jt, jf, k)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		assemble
+#
+#    Prototype:	def assemble(program)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    program - a list of instruction tuples and label strings.
+#
+#    Return Values:
+#    The program as an array of struct sock_filter, as bytes.
+#
+#    Description:
+#    This function resolves the labels to relative offsets and encodes the instructions. Raises
+#    ValueError if a label is unknown or behind the jump (BPF only jumps forwards), a conditional
+#    jump is too far (more than 255 instructions; use a BPF_JA for those) or the program is too long
+#    for the kernel.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def assemble(program):
+    labels = {}
+    instructions = []
+    for item in program:
+        if isinstance(item, str):
+            labels[item] = len(instructions)
+        else:
+            instructions.append(item)
+
+    if len(instructions) > 4096:
+        raise ValueError("BPF program too long (" + str(len(instructions)) + " instructions)")
+
+    def resolve(value, index):
+        if not isinstance(value, str):
+            return value
+        if value not in labels:
+            raise ValueError("Unknown BPF label " + value)
+        return labels[value] - index - 1
+
+    encoded = bytearray()
+    for index, (code, jt, jf, k) in enumerate(instructions):
+        jt = resolve(jt, index)
+        jf = resolve(jf, index)
+        k = resolve(k, index)
+        if not (0 <= jt <= 255 and 0 <= jf <= 255) or (code == BPF_JMP | BPF_JA and k < 0):
+            raise ValueError("BPF jump out of range at instruction " + str(index))
+        encoded.extend(struct.pack('HBBI', code, jt, jf, k & 0xFFFFFFFF))
+
+    return bytes(encoded)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		fprog
+#
+#    Prototype:	def fprog(code)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    code - an assembled program.
+#
+#    Return Values:
+#    (struct sock_fprog as bytes, the buffer it points to). The buffer must be kept alive until the
+#    setsockopt call returns.
+#
+#    Description:
+#    This function wraps an assembled program for setsockopt.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def fprog(code):
+    buffer = ctypes.create_string_buffer(code, len(code))
+    prog = sock_fprog(len(code) // 8, ctypes.addressof(buffer))
+    return bytes(prog), buffer
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		attach_filter
+#
+#    Prototype:	def attach_filter(sock, program)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    sock - the socket to filter.
+#    program - a list of instructions (see assemble).
+#
+#    Return Values:
+#	
+#    Description:
+#    This function attaches a socket filter, replacing any filter already attached. The swap is
+#    atomic as far as the socket is concerned.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def attach_filter(sock, program):
+    prog, buffer = fprog(assemble(program))
+    sock.setsockopt(SOL_SOCKET, SO_ATTACH_FILTER, prog)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		drop_all_program
+#
+#    Prototype:	def drop_all_program()
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#
+#    Return Values:
+#    A program that rejects every packet.
+#
+#    Description:
+#    This function builds the filter for send-only raw sockets, so they don't queue copies of
+#    every TCP packet on the host.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def drop_all_program():
+    return [stmt(BPF_RET | BPF_K, 0)]
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		fanout_program
+#
+#    Prototype:	def fanout_program(forward_ports)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    forward_ports - (low, high) ranges of the ports on the left-hand side of the forwarding rules.
+#
+#    Return Values:
+#    A program for PACKET_FANOUT_CBPF.
+#
+#    Description:
+#    This function builds the fanout selector. The kernel sends each packet to worker
+#    (return value % worker count). A connection's packets have to reach the same worker in both
+#    directions even though the NAT changes the tuple, so the selector keys on the port the NAT
+#    mapping is named after: the source port for packets to a forwarded port (which the forwarder
+#    reuses when it can), and the destination port for everything else (replies to a NAT'd port).
+#    Workers only allocate NAT ports that map back to themselves (see PortAllocator).
+#
+#    Revisions:
+#	2026-10-17 - Take port ranges.
+#    
+#########################################################################################################
+def fanout_program(forward_ports):
+    program = [
+        stmt(BPF_LD | BPF_B | BPF_ABS, 9),              # A = IP protocol
+        jump(BPF_JMP | BPF_JEQ | BPF_K, IPPROTO_TCP, 1, 0),
+        stmt(BPF_JMP | BPF_JA, "other"),
+        stmt(BPF_LDX | BPF_B | BPF_MSH, 0),             # X = IP header length
+        stmt(BPF_LD | BPF_H | BPF_IND, 2),              # A = TCP destination port
+    ]
+    program += goto_if_in_ports(forward_ports, "forward")
+    program += [
+        stmt(BPF_RET | BPF_A),                          # Reply: select on the destination port
+        "forward",
+        stmt(BPF_LD | BPF_H | BPF_IND, 0),              # A = TCP source port
+        stmt(BPF_RET | BPF_A),
+        "other",
+        stmt(BPF_RET | BPF_K, 0)
+    ]
+    return program
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		goto_if_equal
+#
+#    Prototype:	def goto_if_equal(k, label)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    k - the constant compared against A.
+#    label - where to jump if A == k.
+#
+#    Return Values:
+#    The instructions, as a list.
+#
+#    Description:
+#    This function builds a conditional jump that can reach any label, by pairing the comparison with
+#    a BPF_JA (conditional jumps only reach 255 instructions ahead).
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def goto_if_equal(k, label):
+    return [jump(BPF_JMP | BPF_JEQ | BPF_K, k, 0, 1), stmt(BPF_JMP | BPF_JA, label)]
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		goto_if_in_ports
+#
+#    Prototype:	def goto_if_in_ports(ranges, label)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    ranges - a collection of (low, high) port ranges.
+#    label - where to jump if A is in one of them.
+#
+#    Return Values:
+#    The instructions, as a list.
+#
+#    Description:
+#    This function builds a port-set test. Overlapping and adjacent ranges are merged first, and a
+#    range costs three instructions however many ports it covers.
+#
+#    Revisions:
+#	2026-10-17 - Take port ranges rather than single ports.
+#    
+#########################################################################################################
+def goto_if_in_ports(ranges, label):
+    program = []
+    for low, high in port_ranges(ranges):
+        if low == high:
+            program += goto_if_equal(low, label)
+        else:
+            program += [
+                jump(BPF_JMP | BPF_JGE | BPF_K, low, 0, 2),
+                jump(BPF_JMP | BPF_JGT | BPF_K, high, 1, 0),
+                stmt(BPF_JMP | BPF_JA, label)
+            ]
+    return program
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		port_ranges
+#
+#    Prototype:	def port_ranges(ranges)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    ranges - a collection of (low, high) port ranges.
+#
+#    Return Values:
+#    A sorted list of disjoint, non-adjacent (low, high) ranges.
+#
+#    Description:
+#    This function merges overlapping and adjacent port ranges.
+#
+#    Revisions:
+#	2026-10-17 - Merge ranges rather than single ports.
+#    
+#########################################################################################################
+def port_ranges(ranges):
+    merged = []
+    for low, high in sorted(ranges):
+        if merged and merged[-1][1] >= low - 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+    return merged
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		prefilter_program
+#
+#    Prototype:	def prefilter_program(sources, targets, exact = True)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    sources - (network, prefix_len, low_port, high_port) tuples from the left-hand side of the
+#              forwarding rules.
+#    targets - (ip, port) pairs from the right-hand side of the forwarding rules.
+#    exact - False to only check the ports, for rule sets too big for an exact program.
+#
+#    Return Values:
+#    A socket filter program.
+#
+#    Description:
+#    This function builds the filter that keeps unrelated TCP traffic away from the forwarder. A packet
+#    is accepted if it's TCP and either matches a rule (source network and destination port) or comes
+#    from a rule's target (source IP and port), which is what every reply to a NAT'd connection does.
+#    Replies can't be matched on the NAT port range instead, since the forwarder keeps a client's
+#    own source port whenever it doesn't collide. Fragments are dropped: the ones after the first
+#    carry no TCP header, and the first (MF set) only part of the segment. With exact False, the IPs
+#    aren't checked.
+#
+#    Revisions:
+#	2026-10-17 - Match source networks and port ranges.
+#	2026-10-17 - Drop first fragments (MF set) too.
+#    
+#########################################################################################################
+def prefilter_program(sources, targets, exact = True):
+    program = [
+        stmt(BPF_LD | BPF_B | BPF_ABS, 9),              # A = IP protocol
+        jump(BPF_JMP | BPF_JEQ | BPF_K, IPPROTO_TCP, 1, 0),
+        stmt(BPF_JMP | BPF_JA, "drop"),
+        stmt(BPF_LD | BPF_H | BPF_ABS, 6),              # A = IP flags and fragment offset
+        jump(BPF_JMP | BPF_JSET | BPF_K, 0x3FFF, 0, 1), # MF or a fragment offset
+        stmt(BPF_JMP | BPF_JA, "drop"),
+        stmt(BPF_LDX | BPF_B | BPF_MSH, 0),             # X = IP header length
+    ]
+
+    if not exact:
+        program.append(stmt(BPF_LD | BPF_H | BPF_IND, 2))  # A = TCP destination port
+        program += goto_if_in_ports([(low, high) for network, prefix_len, low, high in sources], "accept")
+        program.append(stmt(BPF_LD | BPF_H | BPF_IND, 0))  # A = TCP source port
+        program += goto_if_in_ports([(port, port) for ip, port in targets], "accept")
+        program += ["drop", stmt(BPF_RET | BPF_K, 0), "accept", stmt(BPF_RET | BPF_K, ACCEPT)]
+        return program
+
+    # prefix_len -> network -> port ranges
+    source_ports = {}
+    for network, prefix_len, low, high in sources:
+        source_ports.setdefault(prefix_len, {}).setdefault(network, []).append((low, high))
+    target_ports = {}
+    for ip, port in targets:
+        target_ports.setdefault(ip, []).append((port, port))
+
+    # Dispatch on the masked source IP once per prefix length, then on the source IP of the
+    # targets. BPF can only jump forwards, so a network whose ports don't match moves on to the
+    # next prefix length (a shorter prefix may still match), and from there to "targets" and "drop".
+    for prefix_len in sorted(source_ports, reverse=True):
+        mask = (0xFFFFFFFF << (32 - prefix_len)) & 0xFFFFFFFF
+        next_label = "after_" + str(prefix_len)
+        program.append(stmt(BPF_LD | BPF_W | BPF_ABS, 12))     # A = source IP
+        if mask != 0xFFFFFFFF:
+            program.append(stmt(BPF_ALU | BPF_AND | BPF_K, mask))
+        for network in sorted(source_ports[prefix_len]):
+            program += goto_if_equal(network, "source_" + str(prefix_len) + "_" + str(network))
+        program.append(stmt(BPF_JMP | BPF_JA, next_label))
+
+        for network in sorted(source_ports[prefix_len]):
+            program.append("source_" + str(prefix_len) + "_" + str(network))
+            program.append(stmt(BPF_LD | BPF_H | BPF_IND, 2))  # A = TCP destination port
+            program += goto_if_in_ports(source_ports[prefix_len][network], "accept")
+            program.append(stmt(BPF_JMP | BPF_JA, next_label))
+        program.append(next_label)
+
+    program.append(stmt(BPF_LD | BPF_W | BPF_ABS, 12))
+    for ip in sorted(target_ports):
+        program += goto_if_equal(ip, "target_" + str(ip))
+    program.append(stmt(BPF_JMP | BPF_JA, "drop"))
+
+    for ip in sorted(target_ports):
+        program.append("target_" + str(ip))
+        program.append(stmt(BPF_LD | BPF_H | BPF_IND, 0))  # A = TCP source port
+        program += goto_if_in_ports(target_ports[ip], "accept")
+        program.append(stmt(BPF_JMP | BPF_JA, "drop"))
+
+    program += ["drop", stmt(BPF_RET | BPF_K, 0)]
+    program += ["accept", stmt(BPF_RET | BPF_K, ACCEPT)]
+    return program
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		prefilter_code
+#
+#    Prototype:	def prefilter_code(forward_rules, draining = ())
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    forward_rules - the compiled forwarding rules (a rules.RuleTable).
+#    draining - RuleTables of rules that existing connections still use after a reload.
+#
+#    Return Values:
+#    The assembled prefilter, or None if the rules don't fit in one.
+#
+#    Description:
+#    This function compiles the forwarding rules into a prefilter. If the exact program is too long
+#    for the kernel, a ports-only program is returned instead. Every backend of a backend pool is a
+#    target.
+#
+#    Revisions:
+#	2026-10-17 - Include every backend of a backend pool.
+#    
+#########################################################################################################
+def prefilter_code(forward_rules, draining = ()):
+    rules = list(forward_rules.rules)
+    for table in draining:
+        rules += table.rules
+    sources = [rule[:4] for rule in rules]
+    targets = [(backend.ip, backend.port) for rule in rules for backend in rule[4].backends]
+
+    for exact in (True, False):
+        try:
+            return assemble(prefilter_program(sources, targets, exact))
+        except ValueError:
+            continue
+    return None
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		attach_prefilter
+#
+#    Prototype:	def attach_prefilter(sock, forward_rules, draining = ())
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    sock - the forwarder's receive socket.
+#    forward_rules - the compiled forwarding rules (a rules.RuleTable).
+#    draining - RuleTables of rules that existing connections still use after a reload.
+#
+#    Return Values:
+#    True if a filter was attached.
+#
+#    Description:
+#    This function compiles the forwarding rules into a prefilter and attaches it, replacing the
+#    previous one. Call it again whenever the rules change. If the exact program is too long for the
+#    kernel, a ports-only program is used; if even that is too long the socket is left unfiltered.
+#
+#    Revisions:
+#	2026-10-17 - Moved the compilation to prefilter_code.
+#    
+#########################################################################################################
+def attach_prefilter(sock, forward_rules, draining = ()):
+    code = prefilter_code(forward_rules, draining)
+    if code is not None:
+        prog, buffer = fprog(code)
+        sock.setsockopt(SOL_SOCKET, SO_ATTACH_FILTER, prog)
+        return True
+
+    print("Too many forwarding rules for a socket filter; receiving all TCP traffic")
+    try:
+        sock.setsockopt(SOL_SOCKET, SO_DETACH_FILTER, 0)
+    except OSError:
+        pass # No filter attached
+    return False
@@ -0,0 +1,143 @@
+###################################################################################################
+#Name:	classify.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       The user-space twin of the socket prefilter (see bpf.prefilter_program), for traffic that
+#       reaches the forwarder without one: a TUN device, PREFILTER turned off, or a rule set too big
+#       to filter exactly. Before any header is parsed, the engine checks that a packet is an
+#       unfragmented TCP segment and then, if it isn't a cached flow, that it's either going to a
+#       forwarded port or coming from a rule's target (which every reply to a NAT'd connection does).
+#       Anything else is dropped and counted by reason, in a handful of operations.
+#
+#       The ports are checked in a 64K-entry table rather than a set, so the lookup is an index.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+from forwarder.rules import endpoint_key
+
+IPPROTO_TCP = 6
+
+class Classifier:
+    __slots__ = ('forward_ports', 'targets', 'not_tcp', 'fragments', 'short', 'unmatched')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, forward_rules = None, draining = ())
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the classifier
+#    forward_rules - the compiled forwarding rules (a rules.RuleTable), or None to reject everything
+#                    until bind_rules is called.
+#    draining - RuleTables of rules that existing connections still use after a reload.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a classifier for the given rules. forward_ports[port] is nonzero for
+#    every port a rule forwards and targets holds the endpoint_key of every rule's target; the
+#    counters count rejected packets by reason.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, forward_rules = None, draining = ()):
+        self.forward_ports = bytearray(65536)
+        self.targets = frozenset()
+        self.not_tcp = 0
+        self.fragments = 0
+        self.short = 0
+        self.unmatched = 0
+        if forward_rules is not None:
+            self.bind_rules(forward_rules, draining)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		bind_rules
+#
+#    Prototype:	def bind_rules(self, forward_rules, draining = ())
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the classifier
+#    forward_rules - the compiled forwarding rules (a rules.RuleTable).
+#    draining - RuleTables of rules that existing connections still use after a reload.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function rebuilds the tables after the rules change. Draining rules are included, so
+#    connections that still use them aren't cut off. New tables are built and then swapped in, so
+#    the counters carry over.
+#
+#    Revisions:
+#	2026-10-17 - Include every backend of a backend pool.
+#
+#########################################################################################################
+    def bind_rules(self, forward_rules, draining = ()):
+        forward_ports = bytearray(65536)
+        targets = set()
+        for table in [forward_rules] + list(draining):
+            for network, prefix_len, low_port, high_port, target in table.rules:
+                forward_ports[low_port:high_port + 1] = b'\x01' * (high_port - low_port + 1)
+                for backend in target.backends:
+                    targets.add(endpoint_key(backend.ip, backend.port))
+
+        self.forward_ports = forward_ports
+        self.targets = frozenset(targets)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		reject_malformed
+#
+#    Prototype:	def reject_malformed(self, packet)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the classifier
+#    packet - a received IP packet that failed the engine's combined protocol, fragment and length
+#             check (see Engine.handle_batch).
+#
+#    Return Values:
+#	
+#    Description:
+#    This function counts a packet the engine dropped before reading its ports. The engine only
+#    checks whether anything is wrong, so working out what was is left to this (rarely taken) path.
+#    A packet with more fragments to come or a fragment offset counts as a fragment.
+#
+#    Revisions:
+#	2026-10-17 - Count first fragments (MF set) as fragments.
+#
+#########################################################################################################
+    def reject_malformed(self, packet):
+        if len(packet) < 20 or packet[9] != IPPROTO_TCP:
+            self.not_tcp += 1
+        elif (packet[6] & 0x3F) or packet[7]:
+            self.fragments += 1
+        else:
+            self.short += 1
+
+    @property
+    def rejected(self):
+        return self.not_tcp + self.fragments + self.short + self.unmatched
@@ -0,0 +1,307 @@
+###################################################################################################
+#Name:	conntrack.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Connection tracking for the NAT. Every DnatEntry follows a simplified TCP state machine driven
+#       by the SYN/FIN/RST flags seen in each direction, and each state has its own idle timeout.
+#       Entries are put on a TimerWheel once when they're created; when the wheel hands one back,
+#       it's either removed from the NAT table (if it's really idle) or scheduled again for its new
+#       deadline. Refreshing an entry on every packet is just a store, so expiry is amortized O(1).
+#
+#       Connections that haven't reached ESTABLISHED are also kept in the NAT table's embryonic list,
+#       and ones that have closed in its closed list, most recently used last, so it knows which ones
+#       to evict when it's full (see NatTable.make_room).
+#
+#    Revisions:
+#    2026-10-17 - Keep the NAT table's embryonic list up to date.
+#    2026-10-17 - Restore tracked connections saved in a snapshot.
+#    2026-10-17 - Journal state changes for replication.
+#    2026-10-17 - Only establish connections picked up mid-stream once both sides have been seen.
+#
+###################################################################################################
+import enum
+from packet.tcp import TcpHeader
+from forwarder.timerwheel import TimerWheel
+
+FIN = int(TcpHeader.Flags.FIN)
+SYN = int(TcpHeader.Flags.SYN)
+RST = int(TcpHeader.Flags.RST)
+ACK = int(TcpHeader.Flags.ACK)
+
+# DnatEntry.fins bits
+FIN_OUTBOUND = 1 # FIN seen from the "inside" host
+FIN_INBOUND = 2  # FIN seen from the forwarded-to host
+FIN_BOTH = FIN_OUTBOUND | FIN_INBOUND
+SEEN_OUTBOUND = 4 # Picked up mid-stream: a segment seen from the "inside" host
+SEEN_INBOUND = 8  # Picked up mid-stream: a segment seen from the forwarded-to host
+SEEN_BOTH = SEEN_OUTBOUND | SEEN_INBOUND
+
+class TcpState(enum.IntEnum):
+    NONE = 0,
+    SYN_SENT = 1,
+    SYN_RECV = 2,
+    ESTABLISHED = 3,
+    FIN_WAIT = 4,
+    TIME_WAIT = 5,
+    CLOSE = 6
+
+# States below this are embryonic, and from TIME_WAIT on a connection is closed
+ESTABLISHED = int(TcpState.ESTABLISHED)
+TIME_WAIT = int(TcpState.TIME_WAIT)
+
+# TcpState by value, which is quicker than calling TcpState
+STATES = tuple(TcpState)
+
+# Idle timeouts in seconds
+DEFAULT_TIMEOUTS = {
+    TcpState.NONE: 10,
+    TcpState.SYN_SENT: 120,
+    TcpState.SYN_RECV: 60,
+    TcpState.ESTABLISHED: 7200,
+    TcpState.FIN_WAIT: 120,
+    TcpState.TIME_WAIT: 120,
+    TcpState.CLOSE: 10
+}
+
+class ConnTracker:
+    __slots__ = ('nat_table', 'timeouts', 'wheel', 'expired')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, nat_table, now, timeouts = DEFAULT_TIMEOUTS)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the tracker
+#    nat_table - the NatTable whose entries are tracked.
+#    now - the current time.monotonic().
+#    timeouts - maps every TcpState to its idle timeout in seconds.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a tracker for the given NAT table.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def __init__(self, nat_table, now, timeouts = DEFAULT_TIMEOUTS):
+        self.nat_table = nat_table
+        # Indexed by state for speed
+        self.timeouts = [timeouts[state] for state in TcpState]
+        self.wheel = TimerWheel(now)
+        self.expired = 0
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		update
+#
+#    Prototype:	def update(self, entry, flags, outbound, now)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the tracker
+#    entry - the DnatEntry of the connection the packet belongs to.
+#    flags - the TCP flags of the packet.
+#    outbound - True if the packet came from the "inside" host, False if it's a reply.
+#    now - the current time.monotonic().
+#
+#    Return Values:
+#	
+#    Description:
+#    This function advances the connection's state for one packet and pushes back its deadline.
+#    Connections picked up mid-stream (first packet isn't a SYN) stay in NONE, on its short
+#    timeout and in the embryonic list, until segments have been seen in both directions, so a lone
+#    spoofed ACK can't hold an entry for the ESTABLISHED timeout. A new SYN from the "inside" host
+#    reopens a closed connection. A SYN on an embryonic connection
+#    moves it to the back of the NAT table's embryonic list and any other state change takes it off;
+#    a FIN or RST that closes a connection moves it to the back of the closed list. Segments that
+#    don't change an established connection's state don't touch either list. Packets that might
+#    have changed the state are recorded in the NAT table's journal, if it has one, for replication.
+#
+#    Revisions:
+#	2026-10-17 - Update the embryonic and closed lists.
+#	2026-10-17 - Record possible state changes in the NAT table's journal.
+#	2026-10-17 - Wait for both directions before establishing a mid-stream connection.
+#    
+#########################################################################################################
+    def update(self, entry, flags, outbound, now):
+        state = entry.state
+
+        if flags & RST:
+            state = TcpState.CLOSE
+            self.nat_table.embryonic.pop(entry.key, None)
+            self.mark_closed(entry)
+        elif flags & SYN:
+            if outbound and not flags & ACK:
+                if state == TcpState.NONE or state >= TcpState.TIME_WAIT:
+                    state = TcpState.SYN_SENT
+                    entry.fins = 0
+            elif state == TcpState.SYN_SENT:
+                state = TcpState.SYN_RECV
+
+            if state < ESTABLISHED:
+                # Still (or again) being set up; the most recently used go to the back
+                embryonic = self.nat_table.embryonic
+                embryonic[entry.key] = entry
+                embryonic.move_to_end(entry.key)
+                self.nat_table.closed.pop(entry.key, None)
+        elif flags & FIN:
+            entry.fins |= FIN_OUTBOUND if outbound else FIN_INBOUND
+            if entry.fins & FIN_BOTH == FIN_BOTH:
+                state = TcpState.TIME_WAIT
+            elif state < TcpState.TIME_WAIT:
+                state = TcpState.FIN_WAIT
+            self.nat_table.embryonic.pop(entry.key, None)
+            if state >= TIME_WAIT:
+                self.mark_closed(entry)
+        elif state == TcpState.NONE:
+            # Picked up mid-stream; established once both sides have sent something
+            entry.fins |= SEEN_OUTBOUND if outbound else SEEN_INBOUND
+            if entry.fins & SEEN_BOTH == SEEN_BOTH:
+                state = TcpState.ESTABLISHED
+                self.nat_table.embryonic.pop(entry.key, None)
+        elif state == TcpState.SYN_RECV and outbound:
+            state = TcpState.ESTABLISHED
+            self.nat_table.embryonic.pop(entry.key, None)
+        else:
+            # Most segments don't change anything but the deadline
+            entry.expires = now + self.timeouts[state]
+            return
+
+        if entry.expires is None:
+            # New entry; it stays on the wheel until it expires
+            entry.expires = now + self.timeouts[state]
+            self.wheel.schedule(entry, entry.expires)
+        else:
+            entry.expires = now + self.timeouts[state]
+
+        entry.state = state
+        journal = self.nat_table.journal
+        if journal is not None:
+            journal.append((entry.key, entry))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		restore
+#
+#    Prototype:	def restore(self, entry, state, fins, expires)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the tracker
+#    entry - a DnatEntry just restored with NatTable.restore.
+#    state - the connection's saved TcpState.
+#    fins - the connection's saved FIN bits.
+#    expires - the time.monotonic() the connection expires at if it stays idle.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function starts tracking a connection saved before a restart where it left off.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def restore(self, entry, state, fins, expires):
+        entry.state = STATES[state]
+        entry.fins = fins
+        entry.expires = expires
+        self.wheel.schedule(entry, expires)
+
+        if state >= ESTABLISHED:
+            self.nat_table.embryonic.pop(entry.key, None)
+        if state >= TIME_WAIT:
+            self.mark_closed(entry)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		mark_closed
+#
+#    Prototype:	def mark_closed(self, entry)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the tracker
+#    entry - the DnatEntry of a connection a FIN or RST has just closed (or closed again).
+#
+#    Return Values:
+#	
+#    Description:
+#    This function moves the connection to the back of the NAT table's closed list.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def mark_closed(self, entry):
+        closed = self.nat_table.closed
+        closed[entry.key] = entry
+        closed.move_to_end(entry.key)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		expire
+#
+#    Prototype:	def expire(self, now)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the tracker
+#    now - the current time.monotonic().
+#
+#    Return Values:
+#    The number of connections removed.
+#
+#    Description:
+#    This function removes the NAT mappings of every connection that has been idle for longer than
+#    its state's timeout. Only the wheel slots that came due are looked at.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def expire(self, now):
+        dnat_table = self.nat_table.dnat_table
+        removed = 0
+
+        for entry in self.wheel.advance(now):
+            if dnat_table.get(entry.key) is not entry:
+                continue # Already removed
+
+            if entry.expires > now:
+                self.wheel.schedule(entry, entry.expires)
+            else:
+                self.nat_table.remove(entry.key >> 16, entry.key & 0xFFFF)
+                removed += 1
+
+        self.expired += removed
+        return removed
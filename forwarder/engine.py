@@ -0,0 +1,835 @@
+###################################################################################################
+#Name:	engine.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       The forwarding loop: parses received packets, looks them up in the forwarding rules and the
+#       NAT table, rewrites them and queues them for sending. It doesn't open any sockets itself, so the
+#       same Engine runs in the single-process forwarder and in each fanout worker.
+#
+#    Revisions:
+#    2026-10-17 - Forward segments of known flows through the flow cache (see flowcache.py).
+#    2026-10-17 - Swap in reloaded rules between batches and drain the old ones (see reload.py).
+#    2026-10-17 - Added Engine.process for running the engine without sockets (see replay.py).
+#    2026-10-17 - Forward cached flows a batch at a time with NumPy when it's available (see packet/batch.py).
+#    2026-10-17 - Patch forwarded segments in the sender's ring instead of building copies.
+#    2026-10-17 - Time the loop's stages when asked to (see profiling.py).
+#
+###################################################################################################
+import struct
+from time import monotonic, perf_counter, perf_counter_ns
+from packet import batch, ip, tcp
+from packet import checksum as cksum
+from forwarder import ports, reload
+from forwarder.metrics import Metrics
+from forwarder.packetlog import PacketLog, LOG_OFF, LOG_PACKETS
+from forwarder.conntrack import SYN, ACK, ESTABLISHED
+from forwarder.nat import NatLimitReached
+from forwarder.flowcache import Flow, flow_key
+from forwarder.classify import Classifier, IPPROTO_TCP
+from forwarder.profiling import RECV, EXPIRE, CACHED, CLASSIFY, PARSE, LOOKUP, TRACK, REWRITE, SEND
+
+# The IP addresses (at offset 12 of the IP header) and the ports (at offset 0 of the TCP header)
+ADDRESSES = struct.Struct('!II')
+PORTS = struct.Struct('!HH')
+CHECKSUM = struct.Struct('!H')
+TCP_CHECKSUM_OFFSET = 16
+TCP_FLAGS_OFFSET = 13
+TCP_HEADER_LEN = 20
+
+# How often (in seconds) to check whether the connections using draining rules have all closed
+DRAIN_CHECK_INTERVAL = 5.0
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		forward_segment
+#
+#    Prototype:	def forward_segment(sender, response, ip_header, tcp_header, src_port, dst_port, src_ip, dst_ip)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    sender - where the rewritten segment is queued (see batchio.BatchSender).
+#    response - the raw IP packet as received (any bytes-like object).
+#    ip_header - the parsed IP header of response.
+#    tcp_header - the parsed TCP header of response.
+#    src_port - the source port to put on the forwarded segment.
+#    dst_port - the destination port to put on the forwarded segment.
+#    src_ip - the IP (as a big-endian integer) the segment will be sent from.
+#    dst_ip - the IP (as a big-endian integer) the segment will be sent to.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function forwards a received segment in either direction with new ports. The new
+#    pseudo-header is (src_ip, dst_ip) and the checksum is adjusted from the received one rather
+#    than recomputed over the payload. Only the ports and the checksum change, so they're patched
+#    into the sender's copy of the segment (see batchio.BatchSender.queue_rewrite) instead of the
+#    header being rebuilt.
+#
+#    Revisions:
+#	2026-10-17 - Queue the segment and patch it in the sender's ring instead of returning a rebuilt
+#	             copy (was rewrite_segment).
+#
+#########################################################################################################
+def forward_segment(sender, response, ip_header, tcp_header, src_port, dst_port, src_ip, dst_ip):
+    data = None
+    if tcp.TcpHeader.verify_checksums:
+        data = response[ip_header.header_len + tcp_header.data_off:]
+
+    tcp_header.src_port = src_port
+    tcp_header.dst_port = dst_port
+    checksum = tcp_header.update_checksum(src_ip, dst_ip, data, ip_header.src_ip, ip_header.dst_ip)
+    sender.queue_rewrite(response[ip_header.header_len:], dst_ip, src_port, dst_port, checksum)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		forward_flow
+#
+#    Prototype:	def forward_flow(sender, response, header_len, flow)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    sender - where the rewritten segment is queued (see batchio.BatchSender).
+#    response - the raw IP packet as received (any bytes-like object).
+#    header_len - the length of response's IP header.
+#    flow - the cached Flow response belongs to.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function is the fast-path version of forward_segment: the checksum is adjusted with the
+#    flow's precomputed delta, without parsing the headers.
+#
+#    Revisions:
+#	2026-10-17 - Queue the segment and patch it in the sender's ring instead of returning a copy
+#	             (was rewrite_flow).
+#
+#########################################################################################################
+def forward_flow(sender, response, header_len, flow):
+    checksum = CHECKSUM.unpack_from(response, header_len + TCP_CHECKSUM_OFFSET)[0]
+    sender.queue_rewrite(response[header_len:], flow.dst_ip, flow.src_port, flow.dst_port, cksum.apply_delta(checksum, flow.delta))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		make_flow
+#
+#    Prototype:	def make_flow(nat_entry, outbound, ip_header, orig_src_port, orig_dst_port, src_ip, src_port, dst_port, dst_ip, counters = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    nat_entry - the connection's DnatEntry.
+#    outbound - True if the segment goes from the "inside" host to the target.
+#    ip_header - the parsed IP header of the received segment.
+#    orig_src_port - the received source port.
+#    orig_dst_port - the received destination port.
+#    src_ip - the IP (as a big-endian integer) the forwarded segment is sent from.
+#    src_port - the forwarded source port.
+#    dst_port - the forwarded destination port.
+#    dst_ip - the IP (as a big-endian integer) the forwarded segment is sent to.
+#    counters - the metrics.Counter to count the flow's packets in, or None.
+#
+#    Return Values:
+#    A Flow for the rest of the segment's flow.
+#
+#    Description:
+#    This function precomputes the rewrite the slow path just did, so it can be cached.
+#
+#    Revisions:
+#	2026-10-17 - Added counters.
+#
+#########################################################################################################
+def make_flow(nat_entry, outbound, ip_header, orig_src_port, orig_dst_port, src_ip, src_port, dst_port, dst_ip, counters = None):
+    old_sum = cksum.tuple_sum(ip_header.src_ip, ip_header.dst_ip, orig_src_port, orig_dst_port)
+    new_sum = cksum.tuple_sum(src_ip, dst_ip, src_port, dst_port)
+    return Flow(nat_entry, outbound, src_port, dst_port, dst_ip, cksum.delta(old_sum, new_sum), counters)
+
+class PacketCollector:
+    __slots__ = ('packets', 'source')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, source = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the collector
+#    source - the IP (as a big-endian integer) forwarded segments are sent from, or None to use
+#             the address each packet was received on.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a sender that keeps the forwarded segments in a list instead of sending
+#    them. It has the same interface as batchio.BatchSender.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def __init__(self, source = None):
+        self.packets = []
+        self.source = source
+
+    def queue(self, data, dst_ip):
+        self.packets.append((bytes(data), dst_ip))
+        return True
+
+    def queue_rewrite(self, data, dst_ip, src_port, dst_port, checksum):
+        segment = bytearray(data)
+        tcp.patch_header(segment, 0, src_port, dst_port, checksum)
+        self.packets.append((bytes(segment), dst_ip))
+
+    def flush(self):
+        pass
+
+    def source_ip(self, dst_ip, default):
+        return default if self.source is None else self.source
+
+class Engine:
+    __slots__ = ('forward_rules', 'draining', 'nat_table', 'tracker', 'flow_cache', 'packet_log', 'metrics', 'packet_batch', 'classifier', 'syn_limiter', 'timer')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, forward_rules, nat_table, tracker, flow_cache = None, packet_log = None, metrics = None, packet_batch = None, syn_limiter = None, timer = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the engine
+#    forward_rules - the compiled rules (a rules.RuleTable) from rules.load_rules.
+#    nat_table - the NatTable to create and look up mappings in.
+#    tracker - the ConnTracker for nat_table.
+#    flow_cache - a FlowCache for nat_table, or None to send every segment through the slow path.
+#    packet_log - a started packetlog.PacketLog, or None to log nothing.
+#    metrics - the metrics.Metrics to count in, or None for a new one.
+#    packet_batch - a batch.PacketBatch to forward cached flows through a batch at a time, or None to
+#                   forward every packet on its own.
+#    syn_limiter - an admission.SynLimiter for new connections, or None to let every SYN through.
+#    timer - a profiling.StageTimer to time the stages of the loop in while it's enabled, or None.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a forwarding engine over the given state.
+#
+#    Revisions:
+#	2026-10-17 - Added the flow cache.
+#	2026-10-17 - Added the draining rules.
+#	2026-10-17 - Added the packet log.
+#	2026-10-17 - Added the metrics.
+#	2026-10-17 - Added the packet batch.
+#	2026-10-17 - Added the classifier.
+#	2026-10-17 - Added the SYN limiter.
+#	2026-10-17 - Added the stage timer.
+#    
+#########################################################################################################
+    def __init__(self, forward_rules, nat_table, tracker, flow_cache = None, packet_log = None, metrics = None, packet_batch = None, syn_limiter = None, timer = None):
+        self.forward_rules = forward_rules
+        self.draining = []
+        self.nat_table = nat_table
+        self.tracker = tracker
+        self.flow_cache = flow_cache
+        self.packet_log = packet_log if packet_log is not None else PacketLog(LOG_OFF)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.bind_rules(forward_rules)
+        self.packet_batch = packet_batch
+        self.classifier = Classifier(forward_rules)
+        self.syn_limiter = syn_limiter
+        self.timer = timer
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		handle_batch
+#
+#    Prototype:	def handle_batch(self, packets, sender, now)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the engine
+#    packets - received IP packets (bytes-like objects).
+#    sender - where rewritten segments are queued (see batchio.BatchSender).
+#    now - the current time.monotonic().
+#
+#    Return Values:
+#	
+#    Description:
+#    This function forwards a batch of packets. Packets that match a forwarding rule are sent on to
+#    the rule's target with a NAT'd source port; replies to a NAT'd port are sent back to the "inside"
+#    host. Everything else is ignored.
+#    Segments of a flow that's already been set up are forwarded from the flow cache: only the
+#    tuple is read and the connection tracking updated, and the rules, the NAT tables and the
+#    header classes are skipped. The cache is bypassed while checksums are being verified.
+#    After a reload, segments of connections set up under a rule that has since been removed or
+#    changed keep going to the connection's old target; new connections only use the current rules.
+#    A rule with a backend pool picks the backend here (see rules.BackendPool.select).
+#    New connections are rate limited per client (see admission.py) and can be refused when the NAT
+#    table is full (see NatTable.make_room). Only a SYN creates a NAT mapping; other segments that
+#    match a rule but no existing connection are dropped. Flows are only cached once their connection is
+#    established, so a flood of SYNs (and the targets' answers to them) can't push the established
+#    flows out of the cache.
+#    Forwarded packets are only logged (sampled) at packetlog.LOG_PACKETS; the level is checked
+#    once per batch, and formatting happens on the log's own thread. Packets and bytes are counted
+#    per rule and direction, and the batch is timed (see metrics.Metrics.observe_batch).
+#    With a packet batch, the cached flows are forwarded first, all together (see forward_cached),
+#    and only the rest go through the loop, without another cache lookup.
+#    Before anything else, packets that aren't unfragmented TCP segments are dropped, and before the
+#    headers are parsed, so is anything the classifier rules out (see classify.py). Anything received
+#    past the IP total length (link-layer padding) is cut off first, and packets shorter than their
+#    total length are dropped.
+#    While the stage timer is enabled, each packet's stages are timed (see profiling.py); whether
+#    it is is only checked once per batch, and otherwise each packet costs a test of a local.
+#
+#    Revisions:
+#	2026-10-17 - Added the flow cache fast path.
+#	2026-10-17 - Keep existing connections on draining rules.
+#	2026-10-17 - Replaced the header printing with the packet log.
+#	2026-10-17 - Added the metrics.
+#	2026-10-17 - Forward cached flows through the packet batch.
+#	2026-10-17 - Reject unrelated traffic before parsing it.
+#	2026-10-17 - Pick a backend for rules with backend pools.
+#	2026-10-17 - Added the SYN limiter and NAT limits; only cache established flows.
+#	2026-10-17 - Added the stage timings.
+#	2026-10-17 - Trim packets to the IP total length.
+#	2026-10-17 - Drop first fragments (MF set) too.
+#	2026-10-17 - Count the packets dropped by the NAT limits.
+#	2026-10-17 - Only create NAT mappings for SYNs.
+#    
+#########################################################################################################
+    def handle_batch(self, packets, sender, now):
+        start = perf_counter()
+        forward_rules = self.forward_rules
+        draining = self.draining
+        nat_table = self.nat_table
+        tracker = self.tracker
+        flow_cache = self.flow_cache
+        packet_batch = self.packet_batch
+        batched = (packet_batch is not None and flow_cache is not None and batch.MIN_BATCH <= len(packets) <= packet_batch.capacity and
+                   max(map(len, packets)) <= packet_batch.size)
+        if tcp.TcpHeader.verify_checksums and not batched:
+            flow_cache = None
+        packet_log = self.packet_log
+        log_packets = packet_log.level >= LOG_PACKETS
+        metrics = self.metrics
+        rule_stats = metrics.targets
+        classifier = self.classifier
+        forward_ports = classifier.forward_ports
+        targets = classifier.targets
+        syn_limiter = self.syn_limiter
+        count = len(packets)
+        timer = self.timer
+        timing = timer is not None and timer.enabled
+
+        if batched:
+            if timing:
+                started = perf_counter_ns()
+            packets = self.forward_cached(packets, sender, now)
+            if timing and count > len(packets):
+                timer.record(CACHED, perf_counter_ns() - started, count - len(packets))
+
+        for packet in packets:
+            if timing:
+                started = perf_counter_ns()
+
+            # Only unfragmented TCP segments with a whole header get any further; the first fragment
+            # has the TCP header but not the whole segment, so the MF bit counts as well as the offset
+            header_len = (packet[0] & 0x0F) << 2
+            if len(packet) < header_len + TCP_HEADER_LEN or packet[9] != IPPROTO_TCP or (packet[6] & 0x3F) or packet[7]:
+                classifier.reject_malformed(packet)
+                continue
+
+            # Frames from a packet socket can be padded past the end of the packet (to the Ethernet minimum)
+            total_len = packet[2] << 8 | packet[3]
+            if total_len != len(packet):
+                if total_len > len(packet) or total_len < header_len + TCP_HEADER_LEN:
+                    classifier.reject_malformed(packet)
+                    continue
+                packet = packet[:total_len]
+
+            src_ip, dst_ip = ADDRESSES.unpack_from(packet, 12)
+            src_port, dst_port = PORTS.unpack_from(packet, header_len)
+            if flow_cache is not None:
+                key = flow_key(src_ip, dst_ip, src_port, dst_port)
+
+                flow = None if batched else flow_cache.get(key)
+                if flow is not None:
+                    tracker.update(flow.nat_entry, packet[header_len + TCP_FLAGS_OFFSET], flow.outbound, now)
+                    counters = flow.counters
+                    if counters is not None:
+                        counters.packets += 1
+                        counters.bytes += len(packet)
+                    if log_packets:
+                        packet_log.packet(now, flow.outbound, packet, flow.dst_ip, flow.dst_port)
+                    forward_flow(sender, packet, header_len, flow)
+                    if timing:
+                        timer.record(CACHED, perf_counter_ns() - started)
+                    continue
+
+            # Anything that isn't going to a forwarded port or coming from a target can't be ours
+            if not forward_ports[dst_port] and ((src_ip << 16) | src_port) not in targets:
+                classifier.unmatched += 1
+                continue
+
+            if timing:
+                parsing = perf_counter_ns()
+                timer.record(CLASSIFY, parsing - started)
+
+            # The headers are views of the receive buffer, so nothing is copied
+            ip_header = ip.IpHeader(packet)
+            tcp_header = tcp.TcpHeader(packet[ip_header.header_len:])
+            if timing:
+                looking_up = perf_counter_ns()
+                timer.record(PARSE, looking_up - parsing)
+            orig_src_port = tcp_header.src_port
+            orig_dst_port = tcp_header.dst_port
+
+            src_ip = ip_header.src_ip
+            target = forward_rules.get((src_ip << 16) | tcp_header.dst_port)
+            new_connection = (tcp_header.flags & (SYN | ACK)) == SYN
+
+            if draining and not new_connection:
+                # Not a new connection, so it may belong to a rule that's draining
+                for table in draining:
+                    old_target = table.get((src_ip << 16) | tcp_header.dst_port)
+                    if old_target is not None and old_target is not target:
+                        backend = old_target.pinned(nat_table, src_ip, tcp_header.src_port)
+                        if backend is not None:
+                            target = backend
+                            break
+
+            if target is not None:
+                if new_connection and syn_limiter is not None and not syn_limiter.allow(src_ip, now):
+                    continue # Counted by the limiter; not logged, since it's what a flood looks like
+
+                target = target.select(nat_table, src_ip, tcp_header.src_port, new_connection)
+                metrics.rule_hits += 1
+                if new_connection:
+                    try:
+                        dnat_entry = nat_table.map_source(src_ip, tcp_header.src_port, tcp_header.dst_port, target.ip, target.port)
+                    except ports.PortPoolExhausted as e:
+                        metrics.nat_exhausted += 1
+                        packet_log.drop(now, e)
+                        continue
+                    except NatLimitReached as e:
+                        metrics.nat_limited += 1
+                        packet_log.drop(now, e)
+                        continue
+                else:
+                    # Only a SYN opens a mapping, so a flood of spoofed ACKs can't fill the table
+                    # (or get past the SYN limiter); anything else has to belong to a mapped connection
+                    dnat_entry = nat_table.find_source(src_ip, tcp_header.src_port, target.ip)
+                    if dnat_entry is None:
+                        metrics.nat_unmapped += 1
+                        continue
+
+                if timing:
+                    tracking = perf_counter_ns()
+                    timer.record(LOOKUP, tracking - looking_up)
+                tracker.update(dnat_entry, tcp_header.flags, True, now)
+                stats = rule_stats.get(target)
+                counters = None
+                if stats is not None:
+                    dnat_entry.stats = stats
+                    counters = stats.outbound
+                    counters.packets += 1
+                    counters.bytes += len(packet)
+                if log_packets:
+                    packet_log.packet(now, True, packet, target.ip, target.port)
+                if timing:
+                    rewriting = perf_counter_ns()
+                    timer.record(TRACK, rewriting - tracking)
+
+                src_ip = sender.source_ip(target.ip, ip_header.dst_ip)
+                forward_segment(sender, packet, ip_header, tcp_header, dnat_entry.nat_port, target.port, src_ip, target.ip)
+
+                if flow_cache is not None and dnat_entry.state >= ESTABLISHED:
+                    flow_cache.add(key, make_flow(dnat_entry, True, ip_header, orig_src_port, orig_dst_port, src_ip, dnat_entry.nat_port, target.port, target.ip, counters))
+                if timing:
+                    timer.record(REWRITE, perf_counter_ns() - rewriting)
+            else:
+                metrics.rule_misses += 1
+
+                # Is this traffic a response from a dest IP?
+                dnat_entry = nat_table.dnat_entry(src_ip, tcp_header.dst_port)
+
+                if dnat_entry is None:
+                    metrics.dnat_misses += 1
+                else:
+                    metrics.dnat_hits += 1
+                    if timing:
+                        tracking = perf_counter_ns()
+                        timer.record(LOOKUP, tracking - looking_up)
+                    tracker.update(dnat_entry, tcp_header.flags, False, now)
+                    counters = None
+                    if dnat_entry.stats is not None:
+                        counters = dnat_entry.stats.inbound
+                        counters.packets += 1
+                        counters.bytes += len(packet)
+                    if log_packets:
+                        packet_log.packet(now, False, packet, dnat_entry.ip, dnat_entry.dst_port)
+                    if timing:
+                        rewriting = perf_counter_ns()
+                        timer.record(TRACK, rewriting - tracking)
+
+                    src_ip = sender.source_ip(dnat_entry.ip, ip_header.dst_ip)
+                    forward_segment(sender, packet, ip_header, tcp_header, dnat_entry.src_port, dnat_entry.dst_port, src_ip, dnat_entry.ip)
+
+                    if flow_cache is not None and dnat_entry.state >= ESTABLISHED:
+                        flow_cache.add(key, make_flow(dnat_entry, False, ip_header, orig_src_port, orig_dst_port, src_ip, dnat_entry.src_port, dnat_entry.dst_port, dnat_entry.ip, counters))
+                    if timing:
+                        timer.record(REWRITE, perf_counter_ns() - rewriting)
+
+        if count:
+            metrics.observe_batch(count, perf_counter() - start)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		forward_cached
+#
+#    Prototype:	def forward_cached(self, packets, sender, now)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the engine
+#    packets - received IP packets (bytes-like objects); no more than the packet batch holds.
+#    sender - where rewritten segments are queued (see batchio.BatchSender).
+#    now - the current time.monotonic().
+#
+#    Return Values:
+#    The packets that aren't in the flow cache (or aren't TCP), in the order they were received.
+#
+#    Description:
+#    This function is handle_batch's flow cache path for a whole batch: the packets are loaded
+#    into the packet batch, their tuples and flags decoded together, and the cached ones rewritten
+#    in place together, so only the cache lookup and the connection tracking are done per packet.
+#    Packets that aren't unfragmented TCP segments, or are shorter than their IP total length, aren't
+#    looked up; they're returned with the misses for handle_batch to reject. The segments sent end at
+#    the IP total length (see PacketBatch.load), so any padding after it is left behind.
+#    A flow's packets are either all cached or all not (nothing is added to the cache until the
+#    rest go through the slow path), so forwarding the cached ones first doesn't reorder any flow.
+#    When checksums are being verified, the adjusted checksums are checked against full ones,
+#    also computed for the whole batch.
+#
+#    Revisions:
+#	2026-10-17 - Trim packets to the IP total length.
+#    
+#########################################################################################################
+    def forward_cached(self, packets, sender, now):
+        packet_batch = self.packet_batch
+        flow_cache = self.flow_cache
+        tracker = self.tracker
+        packet_log = self.packet_log
+        log_packets = packet_log.level >= LOG_PACKETS
+
+        packet_batch.load(packets)
+        ip_headers = packet_batch.ip
+        tcp_headers = packet_batch.tcp
+        tuples = zip(packet_batch.tcp_segments().tolist(), ip_headers['src_ip'].tolist(), ip_headers['dst_ip'].tolist(),
+                     tcp_headers['src_port'].tolist(), tcp_headers['dst_port'].tolist(),
+                     (tcp_headers['off_flags'] & 0xFF).tolist(), packet_batch.lengths.tolist())
+
+        misses = []
+        hits = []
+        flows = []
+        for index, (packet, (is_tcp, src_ip, dst_ip, src_port, dst_port, flags, length)) in enumerate(zip(packets, tuples)):
+            flow = flow_cache.get(flow_key(src_ip, dst_ip, src_port, dst_port)) if is_tcp else None
+            if flow is None:
+                misses.append(packet)
+                continue
+
+            tracker.update(flow.nat_entry, flags, flow.outbound, now)
+            counters = flow.counters
+            if counters is not None:
+                counters.packets += 1
+                counters.bytes += length
+            if log_packets:
+                packet_log.packet(now, flow.outbound, packet[:length], flow.dst_ip, flow.dst_port)
+            hits.append(index)
+            flows.append(flow)
+
+        if hits:
+            packet_batch.rewrite(hits, [flow.src_port for flow in flows], [flow.dst_port for flow in flows], [flow.delta for flow in flows])
+            if tcp.TcpHeader.verify_checksums:
+                self.verify_cached(hits, flows, sender)
+
+            segments = packet_batch.segments()
+            for index, flow in zip(hits, flows):
+                sender.queue(segments[index], flow.dst_ip)
+
+        return misses
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		verify_cached
+#
+#    Prototype:	def verify_cached(self, hits, flows, sender)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the engine
+#    hits - the indexes of the packet batch's rows that were rewritten.
+#    flows - the Flow each of those rows was rewritten for.
+#    sender - where the segments will be queued; it knows the address they'll be sent from.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function checks the checksums forward_cached adjusted against full checksums over the
+#    pseudo-headers the segments will be sent with, like TcpHeader.to_bytes does for the slow path,
+#    and fixes any that don't match.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def verify_cached(self, hits, flows, sender):
+        packet_batch = self.packet_batch
+        dst_ips = packet_batch.ip['dst_ip'].tolist()
+        src_ips = list(dst_ips)
+        for index, flow in zip(hits, flows):
+            src_ips[index] = sender.source_ip(flow.dst_ip, dst_ips[index])
+            dst_ips[index] = flow.dst_ip
+
+        full_checksums = packet_batch.tcp_checksums(src_ips, dst_ips)
+        checksums = packet_batch.tcp['checksum']
+        wrong = [index for index in hits if full_checksums[index] != checksums[index]]
+        for index in wrong:
+            print("Checksum mismatch: incremental " + str(checksums[index]) + ", full " + str(full_checksums[index]))
+        if wrong:
+            packet_batch.replace_checksums(wrong, full_checksums[wrong])
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		process
+#
+#    Prototype:	def process(self, packets, now = None, source = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the engine
+#    packets - raw IP packets (bytes-like objects), as they'd be received.
+#    now - the time.monotonic() to process them at (defaults to the current time).
+#    source - the IP (as a big-endian integer) to forward from; see PacketCollector.
+#
+#    Return Values:
+#    A list of (segment, dst_ip) pairs: each forwarded TCP segment (what would be handed to sendto
+#    on the raw socket) and the IP it would be sent to, as a big-endian integer.
+#
+#    Description:
+#    This function runs one batch through the engine without any sockets, for tests and for
+#    offline replays. Expired connections are removed first, as in run.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def process(self, packets, now = None, source = None):
+        if now is None:
+            now = monotonic()
+        self.tracker.expire(now)
+
+        collector = PacketCollector(source)
+        self.handle_batch(packets, collector, now)
+        return collector.packets
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		update_rules
+#
+#    Prototype:	def update_rules(self, forward_rules)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the engine
+#    forward_rules - the new RuleTable.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function replaces the rules between batches. The NAT tables are kept as they are; the
+#    rules that were removed or changed are kept as draining rules until their connections close
+#    (see reload.draining_rules). Cached flows are dropped so their next segment is looked up again.
+#
+#    Revisions:
+#	2026-10-17 - Rebind the rule metrics.
+#	2026-10-17 - Rebuild the classifier.
+#    
+#########################################################################################################
+    def update_rules(self, forward_rules):
+        self.draining = reload.draining_rules(self.forward_rules, forward_rules, self.draining)
+        self.forward_rules = forward_rules
+        self.metrics.bind_rules(forward_rules, self.draining)
+        self.classifier.bind_rules(forward_rules, self.draining)
+        if self.flow_cache is not None:
+            self.flow_cache.clear()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		check_draining
+#
+#    Prototype:	def check_draining(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the engine
+#
+#    Return Values:
+#    True if any draining rules were dropped.
+#
+#    Description:
+#    This function drops each reload's draining rules once no connection is using them, i.e. no NAT
+#    entry is forwarded to one of their targets unless the current rules would send it there too. It
+#    walks the whole DNAT table, so it's only called every DRAIN_CHECK_INTERVAL seconds.
+#
+#    Revisions:
+#	2026-10-17 - Rebind the rule metrics.
+#	2026-10-17 - Rebuild the classifier.
+#	2026-10-17 - Check every backend of a backend pool.
+#    
+#########################################################################################################
+    def check_draining(self):
+        draining = self.draining
+        forward_rules = self.forward_rules
+        in_use = set()
+
+        for entry in self.nat_table.dnat_table.values():
+            key = (entry.ip << 16) | entry.src_port
+            target = forward_rules.get(key)
+            if target is not None and target.has_backend(entry.key >> 16, entry.forward_port):
+                continue # The current rules still cover it
+
+            for index, table in enumerate(draining):
+                old_target = table.get(key)
+                if old_target is not None and old_target.has_backend(entry.key >> 16, entry.forward_port):
+                    in_use.add(index)
+                    break
+
+        if len(in_use) == len(draining):
+            return False
+
+        self.draining = [table for index, table in enumerate(draining) if index in in_use]
+        self.metrics.bind_rules(forward_rules, self.draining)
+        self.classifier.bind_rules(forward_rules, self.draining)
+        return True
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		run
+#
+#    Prototype:	def run(self, receiver, sender, expiry_interval, watcher = None, on_rules_changed = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the engine
+#    receiver - where packets come from (see batchio.BatchReceiver).
+#    sender - where rewritten segments go (see batchio.BatchSender).
+#    expiry_interval - the longest time to wait for packets before expiring idle connections.
+#    watcher - a started reload.RuleWatcher, or None to keep the rules the engine was created with.
+#    on_rules_changed - called with (forward_rules, draining) whenever either changes, e.g. to
+#                       regenerate the socket filters; or None.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function forwards packets forever, one batch at a time. Everything a batch produces is
+#    sent together at the end of the batch. Reloaded rules are swapped in between batches.
+#    While the stage timer is enabled, receiving, the housekeeping between batches and sending are
+#    timed too.
+#
+#    Revisions:
+#	2026-10-17 - Added the rule reloads.
+#	2026-10-17 - Added the stage timings.
+#    
+#########################################################################################################
+    def run(self, receiver, sender, expiry_interval, watcher = None, on_rules_changed = None):
+        next_drain_check = monotonic() + DRAIN_CHECK_INTERVAL
+        timer = self.timer
+
+        while True:
+            timing = timer is not None and timer.enabled
+            if timing:
+                started = perf_counter_ns()
+            packets = receiver.recv(expiry_interval)
+            if timing:
+                received = perf_counter_ns()
+                timer.record(RECV, received - started)
+
+            now = monotonic()
+            self.tracker.expire(now)
+
+            if watcher is not None:
+                changed = False
+                forward_rules = watcher.take()
+                if forward_rules is not None:
+                    self.update_rules(forward_rules)
+                    changed = True
+                    print("Reloaded " + str(len(forward_rules)) + " forwarding rules")
+
+                if self.draining and now >= next_drain_check:
+                    next_drain_check = now + DRAIN_CHECK_INTERVAL
+                    changed = self.check_draining() or changed
+
+                if changed and on_rules_changed is not None:
+                    on_rules_changed(self.forward_rules, self.draining)
+            if timing:
+                timer.record(EXPIRE, perf_counter_ns() - received)
+
+            self.handle_batch(packets, sender, now)
+            if timing:
+                sending = perf_counter_ns()
+            sender.flush()
+            if timing:
+                timer.record(SEND, perf_counter_ns() - sending)
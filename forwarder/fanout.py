@@ -0,0 +1,434 @@
+###################################################################################################
+#Name:	fanout.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Multi-process forwarding. Each worker owns an AF_PACKET socket in a PACKET_FANOUT group and its
+#       own shard of the NAT state, so workers never share anything and need no locking. The group uses
+#       PACKET_FANOUT_CBPF with the program from bpf.fanout_program rather than PACKET_FANOUT_HASH:
+#       the kernel's flow hash keeps a 5-tuple on one worker, but a forwarded connection's replies
+#       arrive with a different tuple (the NAT'd one), so the hash would scatter them. Keying on the
+#       NAT port keeps both directions of a connection on the same worker.
+#
+#       The sockets are created and joined to the group in the parent, in worker order, before the
+#       workers are forked: the kernel picks a member by its position in the group, which has to
+#       match the NAT port shard the worker allocates from.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+import os
+import signal
+import multiprocessing
+import multiprocessing.connection
+import socket
+from socket import AF_INET, AF_PACKET, SOCK_DGRAM, SOCK_RAW, IPPROTO_TCP
+from time import monotonic
+from forwarder import batchio, bpf, conntrack, health, metrics, nat, profiling, reload, replication, snapshot
+from forwarder.admission import SynLimiter
+from forwarder.packetlog import PacketLog
+from forwarder.engine import Engine
+from forwarder.flowcache import FlowCache
+from packet.batch import PacketBatch
+
+ETH_P_IP = 0x0800
+
+# linux/if_packet.h
+SOL_PACKET = 263
+PACKET_FANOUT = 18
+PACKET_FANOUT_DATA = 22
+PACKET_IGNORE_OUTGOING = 23
+PACKET_FANOUT_CBPF = 6
+
+# How long (in seconds) the workers get to save their state and exit before they're killed
+WORKER_EXIT_TIMEOUT = 5.0
+
+# Signals the parent passes on to every worker (see profiling.install_signals)
+PROFILING_SIGNALS = (signal.SIGUSR1, signal.SIGUSR2)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		open_fanout_sockets
+#
+#    Prototype:	def open_fanout_sockets(worker_count, group_id, forward_ports, interface = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    worker_count - the number of sockets (one per worker).
+#    group_id - the fanout group id; must be unique on the host.
+#    forward_ports - (low, high) ranges of the ports on the left-hand side of the forwarding rules.
+#    interface - the interface to listen on, or None for all of them.
+#
+#    Return Values:
+#    A list of AF_PACKET sockets, in group order.
+#
+#    Description:
+#    This function creates the workers' receive sockets and joins them to one fanout group. The
+#    sockets deliver IP packets (SOCK_DGRAM strips the link-layer header) and ignore packets the
+#    host sends, including the forwarder's own output.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def open_fanout_sockets(worker_count, group_id, forward_ports, interface = None):
+    sockets = []
+    for i in range(worker_count):
+        s = socket.socket(AF_PACKET, SOCK_DGRAM, socket.htons(ETH_P_IP))
+        if interface:
+            s.bind((interface, ETH_P_IP))
+        s.setsockopt(SOL_PACKET, PACKET_IGNORE_OUTGOING, 1)
+        s.setsockopt(SOL_PACKET, PACKET_FANOUT, (group_id & 0xFFFF) | (PACKET_FANOUT_CBPF << 16))
+        sockets.append(s)
+
+    # The selector belongs to the group, so setting it once is enough
+    set_fanout_program(sockets[0], forward_ports)
+    return sockets
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		set_fanout_program
+#
+#    Prototype:	def set_fanout_program(sock, forward_ports)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    sock - any socket in the fanout group.
+#    forward_ports - (low, high) ranges of the ports on the left-hand side of the forwarding rules.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function sets (or replaces) the fanout group's selector (see bpf.fanout_program).
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def set_fanout_program(sock, forward_ports):
+    prog, buffer = bpf.fprog(bpf.assemble(bpf.fanout_program(forward_ports)))
+    sock.setsockopt(SOL_PACKET, PACKET_FANOUT_DATA, prog)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		open_send_socket
+#
+#    Prototype:	def open_send_socket(mark = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    mark - the SO_MARK to put on forwarded packets, or None.
+#
+#    Return Values:
+#    A raw TCP socket for sending forwarded segments.
+#
+#    Description:
+#    This function creates a worker's send socket. As in the single-process forwarder the kernel
+#    builds the IP header and routes the segment. A raw TCP socket also gets a copy of every TCP
+#    packet on the host, so a filter that drops everything is attached.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def open_send_socket(mark = None):
+    s = socket.socket(AF_INET, SOCK_RAW, IPPROTO_TCP)
+    bpf.attach_filter(s, bpf.drop_all_program())
+    if mark is not None:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_MARK, mark)
+    return s
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		run_worker
+#
+#    Prototype:	def run_worker(index, sockets, forward_rules, config)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    index - this worker's position in the fanout group.
+#    sockets - every worker's AF_PACKET socket, in group order.
+#    forward_rules - the compiled forwarding rules.
+#    config - a WorkerConfig.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function is a worker's main loop. It runs the same Engine as the single-process forwarder
+#    over its own NAT table, which only hands out ports in this worker's shard. The other workers'
+#    sockets are closed first so a worker that dies really leaves the group.
+#    Each worker watches the rules file itself (threads don't survive the fork) and regenerates its
+#    socket filter when the rules change. The group's selector is shared and the workers reload
+#    independently, so it only ever gains ports: dropping a port while another worker still drains
+#    connections on it would send their segments to the wrong worker.
+#
+#    Revisions:
+#	2026-10-17 - Reload the rules while running.
+#	2026-10-17 - Log through a per-worker packet log.
+#	2026-10-17 - Serve per-worker metrics.
+#	2026-10-17 - Forward cached flows a batch at a time if batch_headers is set.
+#	2026-10-17 - Health check pooled backends if config.health_check_interval is set.
+#	2026-10-17 - Apply the NAT and SYN limits; each worker gets an even share of the NAT limit.
+#	2026-10-17 - Restore and save the worker's NAT snapshot if config.snapshot_path is set.
+#	2026-10-17 - Stand by for, or replicate to, the same worker of another forwarder.
+#	2026-10-17 - Time the worker's stages and profile it on the signals run_workers passes on.
+#    
+#########################################################################################################
+def run_worker(index, sockets, forward_rules, config):
+    worker_count = len(sockets)
+    recv_socket = sockets[index]
+    for i, s in enumerate(sockets):
+        if i != index:
+            s.close()
+
+    # run_workers blocked the profiling signals before forking, so none arrived before the handlers
+    label = "worker " + str(index)
+    timer = profiling.StageTimer(label)
+    profile_path = config.profile_path
+    if profile_path:
+        profile_path = profile_path + "." + str(index)
+    profiling.install_signals(timer, profiling.SamplingProfiler(config.profile_interval, config.profile_seconds, profile_path, label))
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, PROFILING_SIGNALS)
+    if config.profile_stages:
+        timer.enable()
+
+    checkpointer = None
+    replicator = None
+    try:
+        max_entries = config.nat_max_entries
+        if max_entries is not None:
+            max_entries = max(1, max_entries // worker_count)
+        nat_table = nat.NatTable(config.port_range, (index, worker_count), max_entries, config.nat_max_per_source)
+        tracker = conntrack.ConnTracker(nat_table, monotonic(), config.timeouts)
+
+        # Each worker saves and restores its own shard of the NAT table
+        snapshot_path = config.snapshot_path
+        if snapshot_path:
+            snapshot_path = snapshot.worker_path(snapshot_path, index)
+            snapshot.restore(snapshot_path, nat_table, tracker)
+
+        # Each worker replicates its own shard to the same worker of the standby
+        if config.standby_address:
+            replication.Standby(nat_table, tracker, metrics.worker_address(config.standby_address, index), config.failover_timeout).run()
+        if snapshot_path:
+            checkpointer = snapshot.Checkpointer(snapshot_path, nat_table, config.snapshot_interval)
+            checkpointer.start()
+        if config.replicate_to:
+            replicator = replication.Replicator(nat_table, metrics.worker_address(config.replicate_to, index), config.replication_interval, config.heartbeat_interval)
+            replicator.start()
+
+        flow_cache = FlowCache(nat_table, config.flow_cache_size) if config.flow_cache_size else None
+        packet_log = PacketLog(config.log_level, config.log_sample)
+        packet_log.start()
+        packet_batch = PacketBatch(config.batch_size, config.buffer_size) if config.batch_headers else None
+        syn_limiter = SynLimiter(config.syn_rate, config.syn_burst) if config.syn_rate else None
+        engine = Engine(forward_rules, nat_table, tracker, flow_cache, packet_log, packet_batch=packet_batch, syn_limiter=syn_limiter, timer=timer)
+
+        watcher = None
+        if config.reload_interval:
+            watcher = reload.RuleWatcher(config.rules_path, config.reload_interval)
+            watcher.start()
+
+        # Each worker ejects backends on its own probes, like it reloads on its own
+        health_checker = None
+        if config.health_check_interval:
+            health_checker = health.HealthChecker(lambda: [engine.forward_rules] + list(engine.draining), config.health_check_interval,
+                                                  config.health_check_timeout, config.health_fall, config.health_rise, config.send_mark)
+            health_checker.start()
+
+        selector_ports = set((rule[2], rule[3]) for rule in forward_rules.rules)
+
+        def on_rules_changed(forward_rules, draining):
+            if config.prefilter:
+                bpf.attach_prefilter(recv_socket, forward_rules, draining)
+
+            rules = list(forward_rules.rules)
+            for table in draining:
+                rules += table.rules
+            forward_ports = set((rule[2], rule[3]) for rule in rules)
+            if not forward_ports <= selector_ports:
+                selector_ports.update(forward_ports)
+                set_fanout_program(recv_socket, selector_ports)
+
+        receiver = batchio.BatchReceiver(recv_socket, config.batch_size, config.buffer_size, config.use_mmsg)
+        sender = batchio.BatchSender(open_send_socket(config.send_mark), config.batch_size, config.buffer_size, config.use_mmsg)
+
+        if config.metrics_address:
+            metrics.start_server(metrics.worker_address(config.metrics_address, index), lambda: metrics.render(engine, receiver, sender, watcher, packet_log, health_checker, checkpointer, replicator))
+
+        engine.run(receiver, sender, config.expiry_interval, watcher, on_rules_changed)
+    except KeyboardInterrupt:
+        # Ctrl-C reaches the workers and then run_workers passes it on; don't let that cut the save short
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if checkpointer is not None:
+            checkpointer.stop()
+        if replicator is not None:
+            replicator.stop()
+        if timer.enabled:
+            print(timer.report())
+
+class WorkerConfig:
+    __slots__ = ('port_range', 'timeouts', 'batch_size', 'buffer_size', 'use_mmsg', 'expiry_interval', 'send_mark', 'flow_cache_size',
+                 'rules_path', 'reload_interval', 'prefilter', 'log_level', 'log_sample', 'metrics_address', 'batch_headers',
+                 'health_check_interval', 'health_check_timeout', 'health_fall', 'health_rise',
+                 'nat_max_entries', 'nat_max_per_source', 'syn_rate', 'syn_burst',
+                 'snapshot_path', 'snapshot_interval',
+                 'replicate_to', 'standby_address', 'replication_interval', 'heartbeat_interval', 'failover_timeout',
+                 'profile_stages', 'profile_path', 'profile_seconds', 'profile_interval')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, **settings)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the config
+#    settings - every one of the names in __slots__, as keyword arguments. Most are the settings of
+#               the same (upper case) names in main.py; rules_path is the rules file to watch,
+#               send_mark the --mark, metrics_address the --metrics address, replicate_to and
+#               standby_address the --replicate-to and --standby addresses (either can be None),
+#               and snapshot_path the --snapshot path (None turns the snapshots off). Each worker
+#               writes its profiles to profile_path plus ".<index>".
+#
+#    Return Values:
+#	
+#    Description:
+#    This function bundles the settings every worker needs. They're only taken by name, and a
+#    missing or unknown one raises TypeError, so adding a setting can't shift the others.
+#
+#    Revisions:
+#	2026-10-17 - Added flow_cache_size.
+#	2026-10-17 - Added rules_path, reload_interval and prefilter.
+#	2026-10-17 - Added log_level and log_sample.
+#	2026-10-17 - Added metrics_address.
+#	2026-10-17 - Added batch_headers.
+#	2026-10-17 - Added health_check.
+#	2026-10-17 - Added limits.
+#	2026-10-17 - Added snapshot.
+#	2026-10-17 - Added replication.
+#	2026-10-17 - Added profiling.
+#	2026-10-17 - Take the settings by name only, with the tuples split into named settings.
+#    
+#########################################################################################################
+    def __init__(self, **settings):
+        missing = [name for name in self.__slots__ if name not in settings]
+        unknown = [name for name in settings if name not in self.__slots__]
+        if missing or unknown:
+            raise TypeError("WorkerConfig: missing " + (", ".join(missing) or "nothing") + "; unknown " + (", ".join(unknown) or "nothing"))
+        for name, value in settings.items():
+            setattr(self, name, value)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		run_workers
+#
+#    Prototype:	def run_workers(worker_count, forward_rules, config, group_id = None, interface = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    worker_count - the number of worker processes.
+#    forward_rules - the compiled forwarding rules.
+#    config - a WorkerConfig.
+#    group_id - the fanout group id (defaults to one derived from the pid).
+#    interface - the interface to listen on, or None for all of them.
+#
+#    Return Values:
+#    The exit code for the forwarder.
+#
+#    Description:
+#    This function forks the workers and waits for them. Workers can't be replaced individually
+#    (the group order decides which NAT shard gets which packets), so if one dies the rest are
+#    stopped too. Workers are stopped with SIGINT, like Ctrl-C stops a single process, and only
+#    killed if they haven't exited WORKER_EXIT_TIMEOUT seconds later.
+#    SIGUSR1 and SIGUSR2 are passed on to every worker, so they toggle the stage timings and capture
+#    profiles of all of them.
+#
+#    Revisions:
+#	2026-10-17 - Attach the rules' prefilter to every worker socket.
+#	2026-10-17 - Give the workers time to save their NAT snapshots before killing them.
+#	2026-10-17 - Pass the profiling signals on to the workers.
+#    
+#########################################################################################################
+def run_workers(worker_count, forward_rules, config, group_id = None, interface = None):
+    if group_id is None:
+        group_id = os.getpid() & 0xFFFF
+
+    forward_ports = [(rule[2], rule[3]) for rule in forward_rules.rules]
+    sockets = open_fanout_sockets(worker_count, group_id, forward_ports, interface)
+    if config.prefilter:
+        # The fanout selector only sees packets that get past each socket's own filter
+        for s in sockets:
+            bpf.attach_prefilter(s, forward_rules)
+
+    # Held back until each side has its handlers; by default they'd kill the process
+    signal.pthread_sigmask(signal.SIG_BLOCK, PROFILING_SIGNALS)
+    context = multiprocessing.get_context('fork')
+    workers = []
+    for index in range(worker_count):
+        worker = context.Process(target=run_worker, args=(index, sockets, forward_rules, config), name="forwarder-" + str(index))
+        worker.start()
+        workers.append(worker)
+
+    def pass_on(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signum)
+    for signum in PROFILING_SIGNALS:
+        signal.signal(signum, pass_on)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, PROFILING_SIGNALS)
+
+    # The workers have their own copies now
+    for s in sockets:
+        s.close()
+
+    exit_code = 0
+    try:
+        multiprocessing.connection.wait([worker.sentinel for worker in workers])
+        print("A worker exited; stopping the others")
+        exit_code = 1
+    except KeyboardInterrupt:
+        pass
+
+    # Another Ctrl-C while the workers are saving their state would only leave a traceback
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for worker in workers:
+        if worker.is_alive():
+            os.kill(worker.pid, signal.SIGINT)
+    deadline = monotonic() + WORKER_EXIT_TIMEOUT
+    for worker in workers:
+        worker.join(max(0, deadline - monotonic()))
+        if worker.is_alive():
+            worker.terminate()
+            worker.join()
+
+    return exit_code
@@ -0,0 +1,232 @@
+###################################################################################################
+#Name:	flowcache.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       A cache of per-flow rewrites. Once the first segment of a flow has gone through the rules
+#       and the NAT table, everything needed to forward the rest of the flow (the new ports, the
+#       destination and the checksum delta) is stored under the flow's tuple, so later segments
+#       skip rule evaluation and header parsing. The protocol is always TCP, so the key is just
+#       (src_ip, dst_ip, src_port, dst_port) packed into one integer (see flow_key).
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+from collections import OrderedDict
+
+DEFAULT_CAPACITY = 65536
+
+class Flow:
+    __slots__ = ('nat_entry', 'outbound', 'src_port', 'dst_port', 'dst_ip', 'delta', 'counters')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, nat_entry, outbound, src_port, dst_port, dst_ip, delta, counters = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the flow
+#    nat_entry - the connection's DnatEntry.
+#    outbound - True if the flow goes from the "inside" host to the target.
+#    src_port - the source port to put on forwarded segments.
+#    dst_port - the destination port to put on forwarded segments.
+#    dst_ip - the IP (as a big-endian integer) forwarded segments are sent to.
+#    delta - the checksum delta for the rewrite (see checksum.delta).
+#    counters - the metrics.Counter the flow's packets are counted in, or None.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates the precomputed rewrite for one direction of a connection.
+#
+#    Revisions:
+#	2026-10-17 - Added counters.
+#
+#########################################################################################################
+    def __init__(self, nat_entry, outbound, src_port, dst_port, dst_ip, delta, counters = None):
+        self.nat_entry = nat_entry
+        self.outbound = outbound
+        self.src_port = src_port
+        self.dst_port = dst_port
+        self.dst_ip = dst_ip
+        self.delta = delta
+        self.counters = counters
+
+class FlowCache:
+    __slots__ = ('dnat_table', 'capacity', 'flows', 'hits', 'misses', 'evictions')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, nat_table, capacity = DEFAULT_CAPACITY)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the cache
+#    nat_table - the NatTable the cached flows belong to.
+#    capacity - the most flows to keep; the least recently used one is evicted beyond that.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates an empty flow cache. hits, misses and evictions count lookups since the
+#    cache was created.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, nat_table, capacity = DEFAULT_CAPACITY):
+        self.dnat_table = nat_table.dnat_table
+        self.capacity = capacity
+        self.flows = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.flows)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		get
+#
+#    Prototype:	def get(self, key)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the cache
+#    key - the flow_key of a received segment.
+#
+#    Return Values:
+#    The segment's Flow, or None if it has to go through the slow path.
+#
+#    Description:
+#    This function looks up a flow and marks it as recently used. A flow whose NAT entry has been
+#    removed (the connection closed or expired) is dropped here rather than when the entry is
+#    removed, the same way the timer wheel drops stale entries.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def get(self, key):
+        flow = self.flows.get(key)
+        if flow is not None:
+            nat_entry = flow.nat_entry
+            if self.dnat_table.get(nat_entry.key) is nat_entry:
+                self.flows.move_to_end(key)
+                self.hits += 1
+                return flow
+            del self.flows[key]
+
+        self.misses += 1
+        return None
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		add
+#
+#    Prototype:	def add(self, key, flow)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the cache
+#    key - the flow_key of the flow's segments.
+#    flow - the Flow to cache.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function caches a flow, evicting the least recently used one if the cache is full.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def add(self, key, flow):
+        flows = self.flows
+        flows[key] = flow
+        flows.move_to_end(key)
+        if len(flows) > self.capacity:
+            flows.popitem(last=False)
+            self.evictions += 1
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		clear
+#
+#    Prototype:	def clear(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the cache
+#
+#    Return Values:
+#	
+#    Description:
+#    This function forgets every flow, e.g. after the forwarding rules change. The counters are kept.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def clear(self):
+        self.flows.clear()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		flow_key
+#
+#    Prototype:	def flow_key(src_ip, dst_ip, src_port, dst_port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    src_ip - the segment's source IP as a big-endian integer.
+#    dst_ip - the segment's destination IP as a big-endian integer.
+#    src_port - the segment's source port.
+#    dst_port - the segment's destination port.
+#
+#    Return Values:
+#    A single integer identifying the flow.
+#
+#    Description:
+#    This function packs a TCP flow's tuple into a cache key.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def flow_key(src_ip, dst_ip, src_port, dst_port):
+    return (src_ip << 64) | (dst_ip << 32) | (src_port << 16) | dst_port
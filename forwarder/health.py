@@ -0,0 +1,268 @@
+###################################################################################################
+#Name:	health.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Optional health checks for backend pools (see rules.BackendPool). A HealthChecker thread
+#       opens a TCP connection to every pool backend each interval; after enough failed probes in a
+#       row a backend is marked unhealthy and new connections hash past it, and after enough good
+#       ones it's put back. Connections already on a backend are left alone either way. Rules with a
+#       single target aren't probed, since there's nowhere else to send their connections.
+#
+#       The probes are ordinary connections from the host, so any local server can stand in for a
+#       backend, e.g. "python3 -m http.server 8080" started and stopped by hand.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+import socket
+import threading
+
+# How often (in seconds) every backend is probed, and how long a probe waits for a connection
+DEFAULT_CHECK_INTERVAL = 2.0
+DEFAULT_CHECK_TIMEOUT = 1.0
+
+# Failed probes in a row before a backend is ejected, and good ones before it's put back
+DEFAULT_FALL = 3
+DEFAULT_RISE = 2
+
+class HealthChecker:
+    __slots__ = ('get_tables', 'interval', 'timeout', 'fall', 'rise', 'mark', 'probe', 'ejections', 'thread', '_states', '_stop')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, get_tables, interval = DEFAULT_CHECK_INTERVAL, timeout = DEFAULT_CHECK_TIMEOUT, fall = DEFAULT_FALL, rise = DEFAULT_RISE, mark = None, probe = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the checker
+#    get_tables - called with no arguments for the RuleTables whose backends are checked; it's
+#                 called every round, so reloaded rules are picked up.
+#    interval - how often to probe, in seconds.
+#    timeout - how long a probe waits, in seconds.
+#    fall - failed probes in a row before a backend is ejected.
+#    rise - good probes in a row before an ejected backend is put back.
+#    mark - the SO_MARK to put on the probes, or None; give it the forwarded packets' mark so the
+#           probes take the same route they do.
+#    probe - called with (address, timeout, mark), returns True if the backend is up; defaults to
+#            probe_connect.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a checker. The state of each backend is kept by address rather than on
+#    its ForwardTarget, so it carries over to the new targets a reload creates.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, get_tables, interval = DEFAULT_CHECK_INTERVAL, timeout = DEFAULT_CHECK_TIMEOUT, fall = DEFAULT_FALL, rise = DEFAULT_RISE, mark = None, probe = None):
+        self.get_tables = get_tables
+        self.interval = interval
+        self.timeout = timeout
+        self.fall = max(1, fall)
+        self.rise = max(1, rise)
+        self.mark = mark
+        self.probe = probe if probe is not None else probe_connect
+        self.ejections = 0
+        self.thread = None
+        self._states = {} # address -> [healthy, probes in a row that disagree with healthy]
+        self._stop = threading.Event()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		start
+#
+#    Prototype:	def start(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the checker
+#
+#    Return Values:
+#	
+#    Description:
+#    This function starts the probing thread. It's a daemon thread, so it doesn't keep the
+#    forwarder alive. Threads don't survive fork, so each fanout worker starts its own checker.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="health-checker", daemon=True)
+        self.thread.start()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		stop
+#
+#    Prototype:	def stop(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the checker
+#
+#    Return Values:
+#	
+#    Description:
+#    This function stops the probing thread.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def stop(self):
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(self.interval)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		check
+#
+#    Prototype:	def check(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the checker
+#
+#    Return Values:
+#	
+#    Description:
+#    This function probes every pool backend once and updates their healthy flags. The engine reads
+#    the flags without a lock; each is a single attribute, so it sees either the old value or the
+#    new one. Backends that are no longer in any rule are forgotten.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def check(self):
+        backends = pool_backends(self.get_tables())
+        states = {}
+        for address in backends:
+            state = self._states.get(address)
+            if state is None:
+                state = [True, 0]
+            states[address] = state
+
+            if self.probe(address, self.timeout, self.mark) == state[0]:
+                state[1] = 0
+            else:
+                state[1] += 1
+                if state[1] >= (self.fall if state[0] else self.rise):
+                    state[0] = not state[0]
+                    state[1] = 0
+                    if state[0]:
+                        print("Backend " + address[0] + ":" + str(address[1]) + " is back up")
+                    else:
+                        self.ejections += 1
+                        print("Backend " + address[0] + ":" + str(address[1]) + " is down; no new connections go to it")
+
+            for backend in backends[address]:
+                backend.healthy = state[0]
+        self._states = states
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		pool_backends
+#
+#    Prototype:	def pool_backends(tables)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    tables - RuleTables.
+#
+#    Return Values:
+#    A dict mapping each pool backend's address to its ForwardTargets.
+#
+#    Description:
+#    This function collects the backends of every backend pool in the tables. The same address can
+#    be a backend of several rules, or of a rule and the draining rule it replaced, and each of
+#    those has its own ForwardTarget.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def pool_backends(tables):
+    backends = {}
+    for table in tables:
+        for network, prefix_len, low_port, high_port, target in table.rules:
+            if len(target.backends) > 1:
+                for backend in target.backends:
+                    backends.setdefault(backend.address, []).append(backend)
+    return backends
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		probe_connect
+#
+#    Prototype:	def probe_connect(address, timeout, mark = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    address - the backend's (ip, port).
+#    timeout - how long to wait for the connection, in seconds.
+#    mark - the SO_MARK to put on the connection, or None.
+#
+#    Return Values:
+#    True if the backend accepted a connection.
+#
+#    Description:
+#    This function probes a backend by connecting to it and closing the connection straight away.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def probe_connect(address, timeout, mark = None):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        if mark is not None:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_MARK, mark)
+        s.settimeout(timeout)
+        s.connect(address)
+    except OSError:
+        return False
+    finally:
+        s.close()
+    return True
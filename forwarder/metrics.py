@@ -0,0 +1,523 @@
+###################################################################################################
+#Name:	metrics.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Counters, gauges and histograms for finding where the forwarder saturates. Everything is kept
+#       as plain integer attributes that the engine bumps as it goes (per-rule packet and byte
+#       counts, lookup hits and misses, per-batch timings); the table sizes and the counters other
+#       objects already keep (NAT collisions, flow cache hits, conntrack expiries, I/O drops) are
+#       read only when the metrics are scraped. The scrape is served in the Prometheus text format
+#       over HTTP, on a TCP port or a Unix socket, by a background thread.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+import bisect
+import os
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socket import inet_ntop
+from socket import AF_INET
+
+# Histogram bucket upper bounds, in seconds
+PACKET_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3)
+BATCH_BUCKETS = (1e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 5e-2, 1e-1)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class Counter:
+    __slots__ = ('packets', 'bytes')
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+
+class RuleStats:
+    __slots__ = ('source', 'target', 'outbound', 'inbound')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, source, target)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the stats
+#    source - the rule's left-hand side, as written in the rules file (see rule_source).
+#    target - the rule's target as "ip:port".
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates the counters for one forwarding rule: outbound counts what was forwarded
+#    to the target, inbound the replies sent back.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.outbound = Counter()
+        self.inbound = Counter()
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, bounds)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the histogram
+#    bounds - the buckets' upper bounds, ascending. Larger values only go in the +Inf bucket.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates an empty histogram. counts holds each bucket's own count (not the
+#    cumulative one Prometheus wants; see render).
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value, weight = 1):
+        self.counts[bisect.bisect_left(self.bounds, value)] += weight
+        self.sum += value * weight
+        self.count += weight
+
+class Metrics:
+    __slots__ = ('rules', 'rule_hits', 'rule_misses', 'dnat_hits', 'dnat_misses', 'nat_exhausted', 'nat_limited', 'nat_unmapped',
+                 'packet_seconds', 'batch_seconds', 'targets')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the metrics
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a set of zeroed metrics. rules holds a RuleStats per (source, target)
+#    pair, so a rule's counters carry on across reloads that don't change it; targets maps the
+#    ForwardTargets of the rules in use to their RuleStats (see bind_rules).
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self):
+        self.rules = {}
+        self.rule_hits = 0
+        self.rule_misses = 0
+        self.dnat_hits = 0
+        self.dnat_misses = 0
+        self.nat_exhausted = 0
+        self.nat_limited = 0
+        self.nat_unmapped = 0
+        self.packet_seconds = Histogram(PACKET_BUCKETS)
+        self.batch_seconds = Histogram(BATCH_BUCKETS)
+        self.targets = {}
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		bind_rules
+#
+#    Prototype:	def bind_rules(self, forward_rules, draining = ())
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the metrics
+#    forward_rules - the RuleTable in use.
+#    draining - the RuleTables still draining.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function points each rule's ForwardTarget at the rule's counters, so the engine can find
+#    them with the target a lookup returns. Call it whenever the rules change. Each backend of a
+#    backend pool has its own counters.
+#
+#    Revisions:
+#	2026-10-17 - Count each backend of a backend pool separately.
+#
+#########################################################################################################
+    def bind_rules(self, forward_rules, draining = ()):
+        targets = {}
+        for table in [forward_rules] + list(draining):
+            for network, prefix_len, low_port, high_port, target in table.rules:
+                source = rule_source(network, prefix_len, low_port, high_port)
+                for backend in target.backends:
+                    key = (source, backend.address[0] + ":" + str(backend.address[1]))
+                    stats = self.rules.get(key)
+                    if stats is None:
+                        stats = RuleStats(key[0], key[1])
+                        self.rules[key] = stats
+                    targets[backend] = stats
+        self.targets = targets
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		observe_batch
+#
+#    Prototype:	def observe_batch(self, packet_count, seconds)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the metrics
+#    packet_count - the number of packets in the batch.
+#    seconds - how long the engine spent on the batch.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function records a batch's processing time. Timing every packet would cost about as much
+#    as forwarding it, so the per-packet histogram gets the batch's average once per packet.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def observe_batch(self, packet_count, seconds):
+        self.batch_seconds.observe(seconds)
+        if packet_count:
+            self.packet_seconds.observe(seconds / packet_count, packet_count)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		rule_source
+#
+#    Prototype:	def rule_source(network, prefix_len, low_port, high_port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    network - the rule's network as a big-endian integer.
+#    prefix_len - the network's prefix length.
+#    low_port - the lowest port the rule covers.
+#    high_port - the highest port the rule covers.
+#
+#    Return Values:
+#    The rule's left-hand side in the rules file's syntax (see rules.parse_source).
+#
+#    Description:
+#    This function formats a rule's source for the metric labels.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def rule_source(network, prefix_len, low_port, high_port):
+    source = inet_ntop(AF_INET, network.to_bytes(4, 'big'))
+    if prefix_len != 32:
+        source += "/" + str(prefix_len)
+    source += ":" + str(low_port)
+    if high_port != low_port:
+        source += "-" + str(high_port)
+    return source
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		render
+#
+#    Prototype:	def render(engine, receiver = None, sender = None, watcher = None, packet_log = None, health_checker = None, checkpointer = None, replicator = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    engine - the Engine whose metrics, NAT table, tracker and flow cache are reported.
+#    receiver - the engine's receiver, for its truncated and ENOBUFS counts; or None.
+#    sender - the engine's sender, for its dropped count; or None.
+#    watcher - the reload.RuleWatcher, for its reload count; or None.
+#    packet_log - the packetlog.PacketLog, for its dropped count; or None.
+#    health_checker - the health.HealthChecker, for its ejection count; or None.
+#    checkpointer - the snapshot.Checkpointer, for its writes; or None.
+#    replicator - the replication.Replicator, for what it has sent; or None.
+#
+#    Return Values:
+#    The metrics in the Prometheus text exposition format.
+#
+#    Description:
+#    This function renders a scrape. It runs on the server's thread while the engine keeps going,
+#    so it only reads single values and takes snapshots of the collections it walks.
+#
+#    Revisions:
+#	2026-10-17 - Added the classifier's drop counts.
+#	2026-10-17 - Added the backend pools' health.
+#	2026-10-17 - Added the NAT limits and the SYN limiter.
+#	2026-10-17 - Added the NAT snapshots.
+#	2026-10-17 - Added replication.
+#	2026-10-17 - Added the receiver's ENOBUFS count.
+#	2026-10-17 - Added the packets dropped by the NAT limits.
+#	2026-10-17 - Added the non-SYN packets dropped for having no NAT mapping.
+#
+#########################################################################################################
+def render(engine, receiver = None, sender = None, watcher = None, packet_log = None, health_checker = None, checkpointer = None, replicator = None):
+    metrics = engine.metrics
+    nat_table = engine.nat_table
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " " + kind)
+        for labels, value in samples:
+            lines.append(name + labels + " " + str(value))
+
+    def histogram(name, help_text, hist):
+        samples = []
+        total = 0
+        counts = list(hist.counts)
+        for bound, count in zip(hist.bounds, counts):
+            total += count
+            samples.append(("_bucket{le=\"" + repr(bound) + "\"}", total))
+        total += counts[-1]
+        samples.append(("_bucket{le=\"+Inf\"}", total))
+        samples.append(("_sum", hist.sum))
+        samples.append(("_count", total))
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " histogram")
+        for suffix, value in samples:
+            lines.append(name + suffix + " " + str(value))
+
+    rule_stats = list(metrics.rules.values())
+    for unit, attribute in (("packets", "packets"), ("bytes", "bytes")):
+        samples = []
+        for stats in rule_stats:
+            labels = "rule=\"" + stats.source + "\",target=\"" + stats.target + "\""
+            samples.append(("{" + labels + ",direction=\"out\"}", getattr(stats.outbound, attribute)))
+            samples.append(("{" + labels + ",direction=\"in\"}", getattr(stats.inbound, attribute)))
+        metric("forwarder_rule_" + unit + "_total", "counter", "Forwarded " + unit + " per rule; out is towards the target, in is the replies.", samples)
+
+    metric("forwarder_rule_lookups_total", "counter", "Forwarding rule lookups on the slow path.",
+           [("{result=\"hit\"}", metrics.rule_hits), ("{result=\"miss\"}", metrics.rule_misses)])
+    metric("forwarder_dnat_lookups_total", "counter", "DNAT table lookups for segments that matched no rule.",
+           [("{result=\"hit\"}", metrics.dnat_hits), ("{result=\"miss\"}", metrics.dnat_misses)])
+    classifier = engine.classifier
+    metric("forwarder_rejected_packets_total", "counter", "Packets dropped before parsing: not TCP, fragments, truncated headers, or unrelated to any rule.",
+           [("{reason=\"not_tcp\"}", classifier.not_tcp), ("{reason=\"fragment\"}", classifier.fragments),
+            ("{reason=\"short\"}", classifier.short), ("{reason=\"unmatched\"}", classifier.unmatched)])
+
+    pools = list(nat_table.port_pools.values())
+    metric("forwarder_nat_collisions_total", "counter", "New connections whose source port was taken and had to be remapped.", [("", nat_table.collisions)])
+    metric("forwarder_nat_port_retries_total", "counter", "Ports skipped while allocating because they were already in use.", [("", sum(pool.retries for pool in pools))])
+    metric("forwarder_nat_exhausted_total", "counter", "Packets dropped because no NAT port was free.", [("", metrics.nat_exhausted)])
+    metric("forwarder_nat_limited_total", "counter", "Packets dropped because the NAT table or per-source limits refused their connection.", [("", metrics.nat_limited)])
+    metric("forwarder_nat_unmapped_total", "counter", "Packets dropped for matching a rule but no connection without being a SYN.", [("", metrics.nat_unmapped)])
+    metric("forwarder_nat_evictions_total", "counter", "Closed or half-open connections evicted to make room in a full NAT table.", [("", nat_table.evictions)])
+    metric("forwarder_nat_refused_total", "counter", "New connections refused by the NAT table or per-source limits.", [("", nat_table.refused)])
+    metric("forwarder_nat_entries", "gauge", "Connections in the NAT table.", [("", len(nat_table.dnat_table))])
+    metric("forwarder_nat_embryonic_entries", "gauge", "Connections in the NAT table that haven't finished their handshake.", [("", len(nat_table.embryonic))])
+    metric("forwarder_nat_ports_in_use", "gauge", "Ports in use from the NAT port range, over all targets.", [("", sum(pool.in_use for pool in pools))])
+    if engine.syn_limiter is not None:
+        metric("forwarder_syn_limited_total", "counter", "SYNs dropped by the per-client rate limit.", [("", engine.syn_limiter.limited)])
+    metric("forwarder_conntrack_expired_total", "counter", "Connections removed by the connection tracker.", [("", engine.tracker.expired)])
+    metric("forwarder_rules", "gauge", "Forwarding rules in use.", [("", len(engine.forward_rules))])
+    metric("forwarder_draining_rules", "gauge", "Rules kept for connections set up before a reload.", [("", sum(len(table) for table in list(engine.draining)))])
+
+    backends = {}
+    for network, prefix_len, low_port, high_port, target in list(engine.forward_rules.rules):
+        if len(target.backends) > 1:
+            for backend in target.backends:
+                backends[backend.address[0] + ":" + str(backend.address[1])] = backend.healthy
+    if backends:
+        metric("forwarder_backend_up", "gauge", "Whether a backend pool's backend is taking new connections.",
+               [("{target=\"" + name + "\"}", int(healthy)) for name, healthy in sorted(backends.items())])
+    if health_checker is not None:
+        metric("forwarder_backend_ejections_total", "counter", "Times a backend failed its health checks and was ejected.", [("", health_checker.ejections)])
+
+    flow_cache = engine.flow_cache
+    if flow_cache is not None:
+        metric("forwarder_flow_cache_lookups_total", "counter", "Flow cache lookups.",
+               [("{result=\"hit\"}", flow_cache.hits), ("{result=\"miss\"}", flow_cache.misses)])
+        metric("forwarder_flow_cache_evictions_total", "counter", "Flows evicted from the flow cache.", [("", flow_cache.evictions)])
+        metric("forwarder_flow_cache_entries", "gauge", "Flows in the flow cache.", [("", len(flow_cache))])
+        metric("forwarder_flow_cache_capacity", "gauge", "Most flows the flow cache holds.", [("", flow_cache.capacity)])
+
+    if receiver is not None:
+        metric("forwarder_receive_truncated_total", "counter", "Received packets dropped for not fitting in a buffer.", [("", receiver.truncated)])
+        metric("forwarder_receive_no_buffers_total", "counter", "Receive calls that failed because the kernel ran out of buffers (ENOBUFS).", [("", receiver.no_buffers)])
+    if sender is not None:
+        metric("forwarder_send_dropped_total", "counter", "Forwarded packets the kernel or device wouldn't take.", [("", sender.dropped)])
+    if watcher is not None:
+        metric("forwarder_rule_reloads_total", "counter", "Times the rules file was reloaded.", [("", watcher.reloads)])
+    if checkpointer is not None:
+        metric("forwarder_snapshot_writes_total", "counter", "NAT snapshots written.", [("", checkpointer.writes)])
+        metric("forwarder_snapshot_seconds", "gauge", "How long the latest NAT snapshot took to write.", [("", checkpointer.last_seconds)])
+        metric("forwarder_snapshot_entries", "gauge", "Connections in the latest NAT snapshot.", [("", checkpointer.last_count)])
+    if replicator is not None:
+        metric("forwarder_replication_datagrams_total", "counter", "Datagrams sent to the standby.", [("", replicator.datagrams)])
+        metric("forwarder_replication_updates_total", "counter", "Connection records sent to the standby.", [("", replicator.updates)])
+        metric("forwarder_replication_resyncs_total", "counter", "Times the whole NAT table was sent to the standby.", [("", replicator.resyncs)])
+        metric("forwarder_replication_send_errors_total", "counter", "Datagrams that couldn't be sent to the standby.", [("", replicator.send_errors)])
+    if packet_log is not None:
+        metric("forwarder_log_dropped_total", "counter", "Packet log records dropped because the writer fell behind.", [("", packet_log.dropped)])
+
+    histogram("forwarder_packet_seconds", "Processing time per packet (the average over its batch).", metrics.packet_seconds)
+    histogram("forwarder_batch_seconds", "Processing time per batch, not counting the send.", metrics.batch_seconds)
+
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		do_GET
+#
+#    Prototype:	def do_GET(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the handler
+#
+#    Return Values:
+#	
+#    Description:
+#    This function answers a scrape of /metrics (or /) with the output of the server's collect
+#    function.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def do_GET(self):
+        if self.path not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+
+        body = self.server.collect().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes would drown out everything else on stdout
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		start_server
+#
+#    Prototype:	def start_server(address, collect)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    address - "host:port" to listen on TCP, or the path of a Unix socket (anything with a "/").
+#    collect - called with no arguments for each scrape; returns the text to serve (see render).
+#
+#    Return Values:
+#    The server, already serving on a daemon thread; call shutdown() on it to stop.
+#
+#    Description:
+#    This function starts the metrics endpoint. A stale Unix socket left by an earlier run is
+#    replaced.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def start_server(address, collect):
+    if "/" in address:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = UnixHTTPServer(address, MetricsHandler)
+    else:
+        host, port = address.rsplit(":", 1)
+        server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+        server.daemon_threads = True
+
+    server.collect = collect
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		worker_address
+#
+#    Prototype:	def worker_address(address, index)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    address - the metrics address given on the command line (see start_server).
+#    index - the fanout worker's index.
+#
+#    Return Values:
+#    The address the worker serves its own metrics on.
+#
+#    Description:
+#    This function gives each fanout worker its own endpoint, since the workers share nothing: the
+#    TCP port plus the worker's index, or the Unix socket path with ".<index>" appended.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def worker_address(address, index):
+    if "/" in address:
+        return address + "." + str(index)
+    host, port = address.rsplit(":", 1)
+    return host + ":" + str(int(port) + index)
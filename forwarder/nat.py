@@ -0,0 +1,527 @@
+###################################################################################################
+#Name:	nat.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       The forwarder's NAT state. Both tables are keyed by rules.endpoint_key, i.e. (ip << 16) | port
+#       with the IP as a big-endian integer, so no strings are built per packet.
+#
+#       The SNAT table is used to forward traffic from the "inside" to the "outside". Its keys are
+#       (forwarded_src_ip, src_port) for some "internal" host, and map to the source port the
+#       forwarder uses for that host.
+#
+#       The DNAT table is used to forward traffic coming from the "outside" back to the "inside".
+#       Its keys are (forward_dst_ip, dst_port), where "forward_dst_ip" is an IP to which packets are
+#       forwarded (right-hand side of a forwarding rule) and "dst_port" is the source port assigned
+#       by the forwarder for the "inside" machine. The values are DnatEntry records.
+#
+#       The table can be capped, in total and per "inside" IP, so a flood of SYNs can't use up the
+#       forwarder's memory or ports. Connections that haven't finished their handshake ("embryonic",
+#       tracked by conntrack.py) are kept in least recently used order, and so are the ones that have
+#       closed but are waiting out TIME_WAIT; when the table is full, the oldest closed connection is
+#       evicted to make room, then the oldest embryonic one, and only if there are none is the new
+#       connection refused.
+#
+#    Revisions:
+#    2026-10-17 - Added the entry limits and embryonic eviction.
+#    2026-10-17 - Restore connections saved in a snapshot.
+#    2026-10-17 - Journal changes for replication.
+#
+###################################################################################################
+from collections import OrderedDict
+from socket import inet_ntop
+from socket import AF_INET
+from forwarder.rules import endpoint_key
+from forwarder.ports import PortAllocator, DEFAULT_PORT_RANGE
+
+class NatLimitReached(Exception):
+    # Raised with (src_ip, None) when a client has too many connections, or (None, max_entries) when
+    # the table is full. The message is only formatted if something prints it (the packet log does
+    # that on its own thread), not for every refused packet of a flood.
+    def __str__(self):
+        src_ip, max_entries = self.args
+        if src_ip is not None:
+            return "too many connections from " + inet_ntop(AF_INET, src_ip.to_bytes(4, 'big'))
+        return "NAT table full (" + str(max_entries) + " open connections)"
+
+class DnatEntry:
+    __slots__ = ('key', 'ip', 'dst_port', 'src_port', 'forward_port', 'state', 'fins', 'expires', 'stats')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, key, ip, dst_port, src_port, forward_port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the entry
+#    key - the entry's DNAT table key, endpoint_key(forward_ip, nat_port).
+#    ip - the "inside" host's IP as a big-endian integer.
+#    dst_port - the "inside" host's port (replies are sent there).
+#    src_port - the port the "inside" host originally connected to on the forwarder.
+#    forward_port - the port the connection is forwarded to.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a DNAT table entry. The connection tracking fields (see conntrack.py)
+#    start out as TcpState.NONE with no deadline. stats is the forwarding rule's metrics.RuleStats,
+#    which the engine fills in.
+#
+#    Revisions:
+#	2026-10-17 - Added forward_port, so a connection's target is known after the rules change.
+#	2026-10-17 - Added stats.
+#    
+#########################################################################################################
+    def __init__(self, key, ip, dst_port, src_port, forward_port):
+        self.key = key
+        self.ip = ip
+        self.dst_port = dst_port
+        self.src_port = src_port
+        self.forward_port = forward_port
+        self.state = 0 # TcpState.NONE
+        self.fins = 0
+        self.expires = None
+        self.stats = None
+
+    @property
+    def nat_port(self):
+        return self.key & 0xFFFF
+
+class NatTable:
+    __slots__ = ('snat_table', 'dnat_table', 'port_range', 'port_shard', 'port_pools', 'collisions',
+                 'max_entries', 'max_per_source', 'source_counts', 'embryonic', 'closed', 'evictions', 'refused', 'journal')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, port_range = DEFAULT_PORT_RANGE, port_shard = (0, 1), max_entries = None, max_per_source = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the table
+#    port_range - (low, high) range of source ports handed out when a client's own port collides.
+#    port_shard - (index, count): only hand out ports with port % count == index (fanout workers).
+#    max_entries - the most connections in the table, or None for no limit.
+#    max_per_source - the most connections from one "inside" IP, or None for no limit.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates an empty NAT table. A PortAllocator is created for each forwarded-to IP
+#    the first time it's needed. embryonic maps the keys of the connections still being set up to
+#    their entries, least recently used first, and closed does the same for the connections in
+#    TIME_WAIT or CLOSE; the ConnTracker keeps both up to date. source_counts
+#    counts the connections from each "inside" IP, and is only kept when max_per_source is set.
+#    journal is None, or a deque that every change to a connection is appended to as a (key,
+#    entry) pair, with None for the entry when it's removed (see replication.py).
+#
+#    Revisions:
+#	2026-10-17 - Added max_entries and max_per_source.
+#	2026-10-17 - Added journal.
+#    
+#########################################################################################################
+    def __init__(self, port_range = DEFAULT_PORT_RANGE, port_shard = (0, 1), max_entries = None, max_per_source = None):
+        self.snat_table = {}
+        self.dnat_table = {}
+        self.port_range = port_range
+        self.port_shard = port_shard
+        self.port_pools = {}
+        self.collisions = 0
+        self.max_entries = max_entries
+        self.max_per_source = max_per_source
+        self.source_counts = {}
+        self.embryonic = OrderedDict()
+        self.closed = OrderedDict()
+        self.evictions = 0
+        self.refused = 0
+        self.journal = None
+
+    def __len__(self):
+        return len(self.dnat_table)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		snat_port
+#
+#    Prototype:	def snat_port(self, src_ip, src_port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the table
+#    src_ip - the "inside" host's IP as a big-endian integer.
+#    src_port - the "inside" host's source port.
+#
+#    Return Values:
+#    The source port the forwarder uses for this host, or None if there's no mapping yet.
+#
+#    Description:
+#    This function looks up the SNAT mapping for an "inside" endpoint.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def snat_port(self, src_ip, src_port):
+        return self.snat_table.get((src_ip << 16) | src_port)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		dnat_entry
+#
+#    Prototype:	def dnat_entry(self, forward_ip, port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the table
+#    forward_ip - the forwarded-to IP as a big-endian integer.
+#    port - the source port the forwarder used towards forward_ip.
+#
+#    Return Values:
+#    The DnatEntry for the mapping, or None.
+#
+#    Description:
+#    This function looks up the DNAT mapping for a reply. It's also how collisions are detected:
+#    a port is free towards forward_ip if there's no entry for it.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def dnat_entry(self, forward_ip, port):
+        return self.dnat_table.get((forward_ip << 16) | port)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		find_source
+#
+#    Prototype:	def find_source(self, src_ip, src_port, forward_ip)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the table
+#    src_ip - the "inside" host's IP as a big-endian integer.
+#    src_port - the "inside" host's source port.
+#    forward_ip - the forwarded-to IP as a big-endian integer.
+#
+#    Return Values:
+#    The existing DnatEntry for the endpoint towards forward_ip, or None.
+#
+#    Description:
+#    This function looks up a mapping without creating one.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def find_source(self, src_ip, src_port, forward_ip):
+        nat_port = self.snat_table.get((src_ip << 16) | src_port)
+        if nat_port is not None:
+            entry = self.dnat_table.get((forward_ip << 16) | nat_port)
+            if entry is not None and entry.ip == src_ip and entry.dst_port == src_port:
+                return entry
+        return None
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		map_source
+#
+#    Prototype:	def map_source(self, src_ip, src_port, orig_dst_port, forward_ip, forward_port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the table
+#    src_ip - the "inside" host's IP as a big-endian integer.
+#    src_port - the "inside" host's source port.
+#    orig_dst_port - the port the "inside" host connected to on the forwarder.
+#    forward_ip - the forwarded-to IP as a big-endian integer.
+#    forward_port - the forwarded-to port (only used for new mappings).
+#
+#    Return Values:
+#    The connection's DnatEntry; its nat_port is the source port to use towards forward_ip.
+#
+#    Description:
+#    This function returns the existing mapping for an "inside" endpoint or creates one. The host's own
+#    source port is reused unless another host already uses it towards forward_ip, in which case
+#    a port is taken from forward_ip's pool. Raises ports.PortPoolExhausted if the pool is empty, or
+#    NatLimitReached if there's no room for another connection (see make_room). The port is found
+#    before any room is made, so a connection that can't get one doesn't cost another its entry.
+#
+#    Revisions:
+#	2026-10-17 - Added forward_port and moved the lookup into find_source.
+#	2026-10-17 - Enforce the entry limits.
+#	2026-10-17 - Moved creating the port pool into port_pool.
+#	2026-10-17 - Take the port before evicting anything.
+#    
+#########################################################################################################
+    def map_source(self, src_ip, src_port, orig_dst_port, forward_ip, forward_port):
+        # If there's already a NAT entry for this source IP:port pair towards forward_ip, just use it.
+        entry = self.find_source(src_ip, src_port, forward_ip)
+        if entry is not None:
+            return entry
+
+        pool = self.port_pool(forward_ip)
+        if ((forward_ip << 16) | src_port) not in self.dnat_table and pool.reserve(src_port):
+            # No other host is forwarding to the same dest IP with the same source port,
+            # so just reuse the source port.
+            nat_port = src_port
+        else:
+            # There was a collision; take a free port from the pool instead.
+            self.collisions += 1
+            nat_port = pool.allocate()
+
+        # The port is taken before making room, so nothing is evicted for a connection that then
+        # can't get a port; if the connection is refused, the port goes back.
+        if self.max_entries is not None or self.max_per_source is not None:
+            try:
+                self.make_room(src_ip)
+            except NatLimitReached:
+                pool.release(nat_port)
+                raise
+
+        return self.add(src_ip, src_port, orig_dst_port, forward_ip, forward_port, nat_port)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		port_pool
+#
+#    Prototype:	def port_pool(self, forward_ip)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the table
+#    forward_ip - the forwarded-to IP as a big-endian integer.
+#
+#    Return Values:
+#    The PortAllocator for forward_ip.
+#
+#    Description:
+#    This function returns forward_ip's port pool, creating it the first time.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def port_pool(self, forward_ip):
+        pool = self.port_pools.get(forward_ip)
+        if pool is None:
+            pool = PortAllocator(self.port_range[0], self.port_range[1], self.port_shard[1], self.port_shard[0])
+            self.port_pools[forward_ip] = pool
+        return pool
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		restore
+#
+#    Prototype:	def restore(self, src_ip, src_port, orig_dst_port, forward_ip, forward_port, nat_port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the table
+#    src_ip - the "inside" host's IP as a big-endian integer.
+#    src_port - the "inside" host's source port.
+#    orig_dst_port - the port the "inside" host connected to on the forwarder.
+#    forward_ip - the forwarded-to IP as a big-endian integer.
+#    forward_port - the forwarded-to port.
+#    nat_port - the source port the connection used towards forward_ip.
+#
+#    Return Values:
+#    The new DnatEntry, or None if it couldn't be restored.
+#
+#    Description:
+#    This function puts back a mapping saved before a restart (see snapshot.py) with the same NAT
+#    port, so the connection carries on as if nothing happened. It's skipped if the port is already
+#    taken or the table is full.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def restore(self, src_ip, src_port, orig_dst_port, forward_ip, forward_port, nat_port):
+        if self.max_entries is not None and len(self.dnat_table) >= self.max_entries:
+            return None
+        if ((forward_ip << 16) | nat_port) in self.dnat_table or not self.port_pool(forward_ip).reserve(nat_port):
+            return None
+        return self.add(src_ip, src_port, orig_dst_port, forward_ip, forward_port, nat_port)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		make_room
+#
+#    Prototype:	def make_room(self, src_ip)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the table
+#    src_ip - the "inside" host's IP as a big-endian integer.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function checks the limits before a new connection from src_ip is added. If the host
+#    already has max_per_source connections, the new one is refused. If the table is full, the least
+#    recently closed connection is evicted, or failing that the least recently used embryonic one;
+#    with neither to evict, the new one is refused. Closed connections go first since they're done
+#    with; evicting a half-open one can cost a real client a SYN retransmit. Established connections
+#    are never evicted, so a SYN flood can only push out other half-open (and closed) connections.
+#    Raises NatLimitReached when a connection is refused.
+#
+#    Revisions:
+#	2026-10-17 - Raise NatLimitReached with the raw values; it formats its own message.
+#    
+#########################################################################################################
+    def make_room(self, src_ip):
+        if self.max_per_source is not None and self.source_counts.get(src_ip, 0) >= self.max_per_source:
+            self.refused += 1
+            raise NatLimitReached(src_ip, None)
+
+        if self.max_entries is not None and len(self.dnat_table) >= self.max_entries:
+            if self.closed:
+                key, entry = self.closed.popitem(last=False)
+            elif self.embryonic:
+                key, entry = self.embryonic.popitem(last=False)
+            else:
+                self.refused += 1
+                raise NatLimitReached(None, self.max_entries)
+
+            self.remove(key >> 16, key & 0xFFFF)
+            self.evictions += 1
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		add
+#
+#    Prototype:	def add(self, src_ip, src_port, orig_dst_port, forward_ip, forward_port, nat_port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the table
+#    src_ip - the "inside" host's IP as a big-endian integer.
+#    src_port - the "inside" host's source port.
+#    orig_dst_port - the port the "inside" host connected to on the forwarder.
+#    forward_ip - the forwarded-to IP as a big-endian integer.
+#    forward_port - the forwarded-to port.
+#    nat_port - the source port the forwarder will use towards forward_ip.
+#
+#    Return Values:
+#    The new DnatEntry.
+#
+#    Description:
+#    This function creates the SNAT and DNAT mappings for a new connection. It doesn't check the
+#    limits; map_source does that first.
+#
+#    Revisions:
+#	2026-10-17 - Record the forwarded-to port.
+#	2026-10-17 - Track embryonic connections and count connections per source.
+#	2026-10-17 - Record the new connection in the journal.
+#    
+#########################################################################################################
+    def add(self, src_ip, src_port, orig_dst_port, forward_ip, forward_port, nat_port):
+        key = endpoint_key(forward_ip, nat_port)
+        entry = DnatEntry(key, src_ip, src_port, orig_dst_port, forward_port)
+        self.snat_table[endpoint_key(src_ip, src_port)] = nat_port
+        self.dnat_table[key] = entry
+        self.embryonic[key] = entry
+        if self.max_per_source is not None:
+            self.source_counts[src_ip] = self.source_counts.get(src_ip, 0) + 1
+        if self.journal is not None:
+            self.journal.append((key, entry))
+        return entry
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		remove
+#
+#    Prototype:	def remove(self, forward_ip, nat_port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the table
+#    forward_ip - the forwarded-to IP as a big-endian integer.
+#    nat_port - the source port the forwarder used towards forward_ip.
+#
+#    Return Values:
+#    The removed DnatEntry, or None if there was no such mapping.
+#
+#    Description:
+#    This function deletes both mappings of a connection and returns its port to the pool.
+#
+#    Revisions:
+#	2026-10-17 - Forget embryonic and closed connections and count connections per source.
+#	2026-10-17 - Record the removal in the journal.
+#    
+#########################################################################################################
+    def remove(self, forward_ip, nat_port):
+        entry = self.dnat_table.pop((forward_ip << 16) | nat_port, None)
+        if entry is None:
+            return None
+
+        snat_key = (entry.ip << 16) | entry.dst_port
+        if self.snat_table.get(snat_key) == nat_port:
+            del self.snat_table[snat_key]
+
+        self.embryonic.pop(entry.key, None)
+        self.closed.pop(entry.key, None)
+        if self.max_per_source is not None:
+            count = self.source_counts.get(entry.ip, 0) - 1
+            if count > 0:
+                self.source_counts[entry.ip] = count
+            else:
+                self.source_counts.pop(entry.ip, None)
+
+        pool = self.port_pools.get(forward_ip)
+        if pool is not None:
+            pool.release(nat_port)
+
+        if self.journal is not None:
+            self.journal.append((entry.key, None))
+        return entry
@@ -0,0 +1,380 @@
+###################################################################################################
+#Name:	packetlog.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Packet logging that stays off the forwarding path. The engine only checks the level and, for
+#       the packets that are sampled, copies the header fields it wants into a tuple and queues it;
+#       turning the tuple into text and writing it out happens on a background thread. If the writer
+#       falls behind, the queue fills up and records are dropped (and counted) instead of the
+#       forwarder waiting for it.
+#
+#       Each record is one line of key=value pairs, e.g.
+#           packet t=12.345678 dir=out 10.0.1.2:40000 -> 10.0.1.1:8005 fwd=10.0.2.2:8080 flags=SYN,ACK ...
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+import queue
+import struct
+import sys
+import threading
+from socket import inet_ntop
+from socket import AF_INET
+
+# Levels: nothing; dropped packets and other problems; also forwarded packets (sampled)
+LOG_OFF = 0
+LOG_DROPS = 1
+LOG_PACKETS = 2
+LEVELS = {'off': LOG_OFF, 'drops': LOG_DROPS, 'packets': LOG_PACKETS}
+
+# At LOG_PACKETS, one in this many forwarded packets is logged
+DEFAULT_SAMPLE_EVERY = 1000
+
+# Records waiting to be written; beyond this they're dropped
+DEFAULT_QUEUE_SIZE = 4096
+
+# The logged IP fields (total length, ID, TTL, source, destination) and TCP fields (ports, sequence
+# and ack numbers, data offset and flags, window)
+IP_FIELDS = struct.Struct('!2xHH2xB3xII')
+TCP_FIELDS = struct.Struct('!HHIIHH')
+
+# TCP flag bits, lowest first
+FLAG_NAMES = ('FIN', 'SYN', 'RST', 'PSH', 'ACK', 'URG')
+
+class PacketLog:
+    __slots__ = ('level', 'sample_every', 'dropped', 'stream', '_countdown', '_queue', '_thread')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, level = LOG_DROPS, sample_every = DEFAULT_SAMPLE_EVERY, stream = None, queue_size = DEFAULT_QUEUE_SIZE)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the log
+#    level - LOG_OFF, LOG_DROPS or LOG_PACKETS.
+#    sample_every - at LOG_PACKETS, log one in this many forwarded packets (1 logs them all).
+#    stream - where to write the records (defaults to stdout).
+#    queue_size - the most records waiting to be written.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a packet log. Nothing is written until start is called; records logged
+#    before that wait in the queue.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, level = LOG_DROPS, sample_every = DEFAULT_SAMPLE_EVERY, stream = None, queue_size = DEFAULT_QUEUE_SIZE):
+        self.level = level
+        self.sample_every = max(1, sample_every)
+        self.dropped = 0
+        self.stream = stream
+        self._countdown = 1 # The first packet is always logged
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		start
+#
+#    Prototype:	def start(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the log
+#
+#    Return Values:
+#	
+#    Description:
+#    This function starts the writer thread, unless the log is off. It's a daemon thread, so it
+#    doesn't keep the forwarder alive; call stop to write out what's queued.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def start(self):
+        if self.level == LOG_OFF or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self.write, name="packet-log", daemon=True)
+        self._thread.start()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		stop
+#
+#    Prototype:	def stop(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the log
+#
+#    Return Values:
+#	
+#    Description:
+#    This function writes out everything queued so far and stops the writer thread.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def stop(self):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		packet
+#
+#    Prototype:	def packet(self, now, outbound, packet, fwd_ip, fwd_port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the log
+#    now - the time.monotonic() the packet's batch was received at.
+#    outbound - True if the packet goes from a client to a target, False for a reply.
+#    packet - the received IP packet, before it's rewritten.
+#    fwd_ip - the IP (as a big-endian integer) the packet is forwarded to.
+#    fwd_port - the port the packet is forwarded to.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function logs a forwarded packet if it's sampled. The caller checks the level first (see
+#    Engine.handle_batch), so this is only called at LOG_PACKETS, and unsampled packets cost a
+#    counter decrement. The fields are copied out of the packet, since its buffer is reused once
+#    the batch is done; this works the same on the flow cache path, where no headers are parsed.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def packet(self, now, outbound, packet, fwd_ip, fwd_port):
+        self._countdown -= 1
+        if self._countdown:
+            return
+        self._countdown = self.sample_every
+
+        total_len, ip_id, ttl, src_ip, dst_ip = IP_FIELDS.unpack_from(packet)
+        src_port, dst_port, seq_num, ack_num, data_off_and_flags, win_size = TCP_FIELDS.unpack_from(packet, (packet[0] & 0x0F) << 2)
+        self.put((format_packet, (now, outbound, src_ip, src_port, dst_ip, dst_port, fwd_ip, fwd_port,
+                                  data_off_and_flags & 0x3F, seq_num, ack_num, win_size, total_len, ttl, ip_id)))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		drop
+#
+#    Prototype:	def drop(self, now, reason)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the log
+#    now - the time.monotonic() the packet's batch was received at.
+#    reason - why the packet was dropped; anything str() accepts, formatted on the writer thread.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function logs a dropped packet at LOG_DROPS and above. Drops aren't sampled, but they
+#    still go through the bounded queue.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def drop(self, now, reason):
+        if self.level >= LOG_DROPS:
+            self.put((format_drop, (now, reason)))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		put
+#
+#    Prototype:	def put(self, record)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the log
+#    record - a (formatter, fields) pair; the writer thread writes formatter(fields).
+#
+#    Return Values:
+#	
+#    Description:
+#    This function queues a record without blocking. If the queue is full the record is dropped.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def put(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		write
+#
+#    Prototype:	def write(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the log
+#
+#    Return Values:
+#	
+#    Description:
+#    This function is the writer thread. It formats and writes records until stop is called, and
+#    flushes the stream whenever it runs out of records.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def write(self):
+        records = self._queue
+        stream = self.stream if self.stream is not None else sys.stdout
+
+        while True:
+            record = records.get()
+            if record is None:
+                break
+
+            formatter, fields = record
+            stream.write(formatter(fields) + "\n")
+            if records.empty():
+                stream.flush()
+
+        stream.flush()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		format_packet
+#
+#    Prototype:	def format_packet(fields)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    fields - the tuple PacketLog.packet queued.
+#
+#    Return Values:
+#    The record as one line of text.
+#
+#    Description:
+#    This function formats a forwarded packet's record.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def format_packet(fields):
+    (now, outbound, src_ip, src_port, dst_ip, dst_port, fwd_ip, fwd_port,
+     flags, seq_num, ack_num, win_size, total_len, ttl, ip_id) = fields
+
+    flag_names = [name for bit, name in enumerate(FLAG_NAMES) if flags & (1 << bit)]
+    return ("packet t=" + format(now, '.6f') + " dir=" + ("out" if outbound else "in") +
+            " " + endpoint_str(src_ip, src_port) + " -> " + endpoint_str(dst_ip, dst_port) +
+            " fwd=" + endpoint_str(fwd_ip, fwd_port) + " flags=" + (",".join(flag_names) or "-") +
+            " seq=" + str(seq_num) + " ack=" + str(ack_num) + " win=" + str(win_size) +
+            " len=" + str(total_len) + " ttl=" + str(ttl) + " id=" + str(ip_id))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		format_drop
+#
+#    Prototype:	def format_drop(fields)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    fields - the tuple PacketLog.drop queued.
+#
+#    Return Values:
+#    The record as one line of text.
+#
+#    Description:
+#    This function formats a dropped packet's record.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def format_drop(fields):
+    now, reason = fields
+    return "drop t=" + format(now, '.6f') + " reason=\"" + str(reason) + "\""
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		endpoint_str
+#
+#    Prototype:	def endpoint_str(ip, port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    ip - an IP as a big-endian integer.
+#    port - a port.
+#
+#    Return Values:
+#    "ip:port".
+#
+#    Description:
+#    This function formats an endpoint for the log.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def endpoint_str(ip, port):
+    return inet_ntop(AF_INET, ip.to_bytes(4, 'big')) + ":" + str(port)
@@ -0,0 +1,215 @@
+###################################################################################################
+#Name:	ports.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Source port allocation for the NAT. There's one PortAllocator per forwarded-to IP, since a
+#       port only has to be unique towards a given destination. Allocating and releasing are O(1)
+#       (amortized): ports that have never been handed out are taken from a cursor that walks the
+#       range once, and released ports go on a free stack. A bytearray records the state of each port.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+
+DEFAULT_PORT_RANGE = (49152, 65535)
+
+# Per-port state bits
+PORT_USED = 1
+PORT_QUEUED = 2 # Port is on the free stack
+
+class PortPoolExhausted(Exception):
+    pass
+
+class PortAllocator:
+    __slots__ = ('low', 'high', 'step', 'in_use', 'retries', '_first', '_state', '_free', '_next')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, low = DEFAULT_PORT_RANGE[0], high = DEFAULT_PORT_RANGE[1], step = 1, offset = 0)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the allocator
+#    low - the first port in the pool.
+#    high - the last port in the pool (inclusive).
+#    step - only ports with port % step == offset belong to the pool.
+#    offset - see step.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a pool with every port in [low, high] free. step and offset split the
+#    range between fanout workers, so the port alone says which worker owns a mapping. retries
+#    counts the ports allocate had to skip because they'd been reserved in the meantime.
+#
+#    Revisions:
+#	2026-10-17 - Added step and offset.
+#	2026-10-17 - Added retries.
+#    
+#########################################################################################################
+    def __init__(self, low = DEFAULT_PORT_RANGE[0], high = DEFAULT_PORT_RANGE[1], step = 1, offset = 0):
+        if not (0 < low <= high <= 65535) or not (0 <= offset < step):
+            raise ValueError("Invalid port range " + str(low) + "-" + str(high))
+
+        first = low + (offset - low) % step
+        if first > high:
+            raise ValueError("No ports in " + str(low) + "-" + str(high) + " for shard " + str(offset) + "/" + str(step))
+
+        self.low = low
+        self.high = high
+        self.step = step
+        self.in_use = 0
+        self.retries = 0
+        self._first = first
+        self._state = bytearray((high - first) // step + 1)
+        self._free = []
+        self._next = first
+
+    def __contains__(self, port):
+        return self.low <= port <= self.high and (port - self._first) % self.step == 0
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		allocate
+#
+#    Prototype:	def allocate(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the allocator
+#
+#    Return Values:
+#    A port from the pool, now marked as in use.
+#
+#    Description:
+#    This function hands out a free port, preferring recently released ones. Raises
+#    PortPoolExhausted if every port in the range is in use.
+#
+#    Revisions:
+#	2026-10-17 - Count the ports that had to be skipped.
+#    
+#########################################################################################################
+    def allocate(self):
+        state = self._state
+        first = self._first
+        step = self.step
+
+        while self._free:
+            port = self._free.pop()
+            index = (port - first) // step
+            state[index] &= ~PORT_QUEUED
+            if not state[index] & PORT_USED:
+                state[index] |= PORT_USED
+                self.in_use += 1
+                return port
+            self.retries += 1
+
+        while self._next <= self.high:
+            port = self._next
+            self._next += step
+            index = (port - first) // step
+            if not state[index] & PORT_USED:
+                state[index] |= PORT_USED
+                self.in_use += 1
+                return port
+            self.retries += 1
+
+        raise PortPoolExhausted("No free ports in " + str(self.low) + "-" + str(self.high) + (" (shard " + str(first % step) + "/" + str(step) + ")" if step > 1 else ""))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		reserve
+#
+#    Prototype:	def reserve(self, port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the allocator
+#    port - the port to take.
+#
+#    Return Values:
+#    True if the port was free (or outside the pool) and is now taken, False if it was already in use.
+#
+#    Description:
+#    This function claims a specific port, e.g. when the forwarder keeps a client's own source port.
+#    Ports outside the pool aren't tracked here.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def reserve(self, port):
+        if port not in self:
+            return True
+
+        index = (port - self._first) // self.step
+        if self._state[index] & PORT_USED:
+            return False
+
+        # If the port is still on the free stack, allocate will skip it when it's popped
+        self._state[index] |= PORT_USED
+        self.in_use += 1
+        return True
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		release
+#
+#    Prototype:	def release(self, port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the allocator
+#    port - a port previously returned by allocate or taken with reserve.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function returns a port to the pool. Releasing a free port or one outside the pool does nothing.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def release(self, port):
+        if port not in self:
+            return
+
+        index = (port - self._first) // self.step
+        state = self._state[index]
+        if not state & PORT_USED:
+            return
+
+        state &= ~PORT_USED
+        self.in_use -= 1
+
+        # Ports the cursor hasn't reached yet will be found by it; the rest go on the free stack
+        # (at most once, so the stack never grows past the size of the range).
+        if port < self._next and not state & PORT_QUEUED:
+            state |= PORT_QUEUED
+            self._free.append(port)
+
+        self._state[index] = state
@@ -0,0 +1,554 @@
+###################################################################################################
+#Name:	profiling.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Tools for finding where the forwarding loop's time goes, both switched on and off while the
+#       forwarder runs:
+#
+#       - A StageTimer times each stage of the loop (receiving, expiring connections and reloading
+#         rules, the flow cache path, classifying, parsing, the rule and NAT lookups, connection
+#         tracking, rewriting and checksumming, and sending) with perf_counter_ns, into a fixed-size
+#         histogram per stage. SIGUSR1 starts it, and the next SIGUSR1 stops it and prints the
+#         breakdown. While it's off the engine only tests a local flag a few times per packet.
+#       - A SamplingProfiler records the engine's Python stack every few milliseconds of CPU time
+#         for a while, then prints the functions the most samples were in and, optionally, writes
+#         every stack in the collapsed format flamegraph.pl and speedscope read. SIGUSR2 starts a
+#         capture. It costs nothing until then, and a few microseconds per sample while it runs.
+#
+#       With fanout, the parent passes both signals on to every worker, and each worker reports on
+#       its own loop.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+import signal
+import threading
+from time import perf_counter_ns
+
+# The stages the loop is timed in. Each packet is timed either as CACHED (everything for a
+# cached flow) or as the slow path's CLASSIFY, PARSE, LOOKUP, TRACK and REWRITE; RECV, EXPIRE and
+# SEND are timed once per batch.
+STAGES = ('recv', 'expire', 'cached', 'classify', 'parse', 'lookup', 'track', 'rewrite', 'send')
+RECV, EXPIRE, CACHED, CLASSIFY, PARSE, LOOKUP, TRACK, REWRITE, SEND = range(len(STAGES))
+
+# Histogram buckets: bucket i counts times of less than 2**i ns, down to the previous bucket's
+# limit. The last one takes anything longer (about 4.6 minutes and up).
+BUCKETS = 39
+
+# Percentiles in the breakdown
+PERCENTILES = (50, 99)
+
+# How often (in seconds of CPU time) the sampling profiler takes a sample, and for how long (in
+# seconds) it keeps at it
+DEFAULT_SAMPLE_INTERVAL = 0.005
+DEFAULT_SAMPLE_SECONDS = 10.0
+
+# Functions listed after a capture
+TOP_FUNCTIONS = 15
+
+class StageTimer:
+    __slots__ = ('enabled', 'counts', 'totals', 'started', 'label')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, label = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the timer
+#    label - what to call the loop in the breakdown (e.g. "worker 1"), or None.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a timer that's switched off. counts holds a histogram per stage and
+#    totals the time spent in each, in nanoseconds.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, label = None):
+        self.enabled = False
+        self.counts = [[0] * BUCKETS for stage in STAGES]
+        self.totals = [0] * len(STAGES)
+        self.started = 0
+        self.label = label
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		enable
+#
+#    Prototype:	def enable(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the timer
+#
+#    Return Values:
+#	
+#    Description:
+#    This function clears the histograms and starts timing. The engine reads enabled once per
+#    batch, so timing starts with the next one.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def enable(self):
+        self.counts = [[0] * BUCKETS for stage in STAGES]
+        self.totals = [0] * len(STAGES)
+        self.started = perf_counter_ns()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		record
+#
+#    Prototype:	def record(self, stage, ns, count = 1)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the timer
+#    stage - one of the stage indexes (e.g. PARSE).
+#    ns - how long the stage took, in nanoseconds.
+#    count - how many packets that covers, for a stage timed a batch at a time; each is counted
+#            with the average.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function records one timing. The bucket is the time's bit length, so there's no search.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def record(self, stage, ns, count = 1):
+        self.counts[stage][min((ns // count).bit_length(), BUCKETS - 1)] += count
+        self.totals[stage] += ns
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		report
+#
+#    Prototype:	def report(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the timer
+#
+#    Return Values:
+#    The breakdown, as text.
+#
+#    Description:
+#    This function breaks down the time recorded since the timer was enabled: for each stage, the
+#    number of timings, the total time, its share of the time the loop was busy, the mean and the
+#    percentiles. The percentiles are the upper limits of their buckets, so they're within a factor
+#    of two. recv includes the wait for the first packet of a batch, so it isn't counted as busy.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def report(self):
+        elapsed = (perf_counter_ns() - self.started) / 1e9
+        busy = sum(self.totals) - self.totals[RECV]
+        lines = ["Stage timings" + (" for " + self.label if self.label else "") + " over " + str(round(elapsed, 1)) + " s:",
+                 "%-10s %10s %10s %7s %10s" % ("stage", "count", "total ms", "busy", "mean ns") + "".join(" %9s" % ("p" + str(p) + " ns") for p in PERCENTILES)]
+
+        for stage, name in enumerate(STAGES):
+            counts = self.counts[stage]
+            count = sum(counts)
+            if not count:
+                continue
+            total = self.totals[stage]
+            share = "-" if stage == RECV or not busy else "%.1f%%" % (total * 100 / busy)
+            line = "%-10s %10d %10.1f %7s %10d" % (name, count, total / 1e6, share, total // count)
+            for p in PERCENTILES:
+                line += " %9d" % percentile(counts, count, p)
+            lines.append(line)
+        return "\n".join(lines)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		toggle
+#
+#    Prototype:	def toggle(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the timer
+#
+#    Return Values:
+#	
+#    Description:
+#    This function is the SIGUSR1 handler: it starts timing, or stops it and prints the breakdown.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def toggle(self):
+        if self.enabled:
+            self.disable()
+            print(self.report())
+        else:
+            self.enable()
+            print("Timing the forwarding stages" + (" for " + self.label if self.label else "") + "; send SIGUSR1 again for the breakdown")
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		percentile
+#
+#    Prototype:	def percentile(counts, count, p)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    counts - a StageTimer histogram.
+#    count - the sum of counts.
+#    p - the percentile, 0 to 100.
+#
+#    Return Values:
+#    The upper limit of the bucket the percentile falls in, in nanoseconds.
+#
+#    Description:
+#    This function reads a percentile off a histogram.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def percentile(counts, count, p):
+    rank = count * p / 100
+    seen = 0
+    for bucket, bucket_count in enumerate(counts):
+        seen += bucket_count
+        if seen >= rank:
+            return 1 << bucket
+    return 1 << (len(counts) - 1)
+
+class SamplingProfiler:
+    __slots__ = ('interval', 'seconds', 'path', 'label', 'stacks', 'timer')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, interval = DEFAULT_SAMPLE_INTERVAL, seconds = DEFAULT_SAMPLE_SECONDS, path = None, label = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the profiler
+#    interval - the CPU time between samples, in seconds.
+#    seconds - how long a capture lasts.
+#    path - where to write each capture's stacks in collapsed format, or None to only print the
+#           top functions.
+#    label - what to call the loop in the results (e.g. "worker 1"), or None.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a profiler. Nothing runs until capture is called. stacks counts the
+#    samples of each stack while a capture is running, and is None otherwise.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, interval = DEFAULT_SAMPLE_INTERVAL, seconds = DEFAULT_SAMPLE_SECONDS, path = None, label = None):
+        self.interval = interval
+        self.seconds = seconds
+        self.path = path
+        self.label = label
+        self.stacks = None
+        self.timer = None
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		capture
+#
+#    Prototype:	def capture(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the profiler
+#
+#    Return Values:
+#	
+#    Description:
+#    This function is the SIGUSR2 handler: it starts a capture, unless one is already running.
+#    Samples are taken by a SIGPROF handler on an interval timer of the process's CPU time, so the
+#    stack sampled is the one the main thread (the engine) was running at the time, and time spent
+#    waiting for packets isn't sampled at all. (A sampling thread would only get the interpreter
+#    when the engine let go of it, i.e. in its system calls, and never see it parsing anything.)
+#    Interrupted system calls are restarted, so the engine's sends aren't cut short. A timer thread
+#    ends the capture, since the interval timer doesn't run while the forwarder is idle.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def capture(self):
+        if self.stacks is not None:
+            print("A profile is already being captured")
+            return
+        print("Profiling" + (" " + self.label if self.label else "") + " for " + str(self.seconds) + " s")
+        self.stacks = {}
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.timer = threading.Timer(self.seconds, self.finish)
+        self.timer.daemon = True
+        self.timer.start()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		sample
+#
+#    Prototype:	def sample(self, signum, frame)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the profiler
+#    signum - SIGPROF.
+#    frame - the main thread's frame when the signal arrived.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function is the SIGPROF handler, and takes one sample. Only code objects are kept while
+#    sampling; they're turned into names once the capture is over.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def sample(self, signum, frame):
+        stacks = self.stacks
+        if stacks is None:
+            return # A signal still on its way when the capture finished
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        stack = tuple(reversed(stack))
+        stacks[stack] = stacks.get(stack, 0) + 1
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		finish
+#
+#    Prototype:	def finish(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the profiler
+#
+#    Return Values:
+#	
+#    Description:
+#    This function ends a capture, on the timer thread: it stops the interval timer, prints the top
+#    functions and writes the stacks if there's a path. The stacks are copied first, since a
+#    signal already on its way may still add to them.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def finish(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        stacks = dict(self.stacks)
+        self.stacks = None
+        print(summarize(stacks, self.label))
+        if self.path is not None:
+            try:
+                write_collapsed(self.path, stacks)
+            except OSError as e:
+                print("Couldn't write the profile " + self.path + ": " + str(e))
+                return
+            print("Wrote the profile to " + self.path)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		function_name
+#
+#    Prototype:	def function_name(code)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    code - a code object.
+#
+#    Return Values:
+#    "file.py:name" for the function.
+#
+#    Description:
+#    This function names a function in a stack, by its qualified name where there is one.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def function_name(code):
+    filename = code.co_filename.rsplit('/', 1)[-1]
+    return filename + ":" + getattr(code, 'co_qualname', code.co_name)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		summarize
+#
+#    Prototype:	def summarize(stacks, label = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    stacks - a SamplingProfiler's stacks: a dict mapping each stack, a tuple of code objects from
+#             the outermost call in, to its number of samples.
+#    label - what to call the loop, or None.
+#
+#    Return Values:
+#    The top functions, as text.
+#
+#    Description:
+#    This function lists the TOP_FUNCTIONS functions the most samples were in, with the share of
+#    samples each was running in itself ("self") and the share it was anywhere on the stack
+#    ("total").
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def summarize(stacks, label = None):
+    samples = sum(stacks.values())
+    if not samples:
+        return "No samples" + (" of " + label if label else "") + "; the loop was idle"
+
+    own = {}
+    inclusive = {}
+    for stack, count in stacks.items():
+        own[stack[-1]] = own.get(stack[-1], 0) + count
+        for code in set(stack):
+            inclusive[code] = inclusive.get(code, 0) + count
+
+    lines = ["Profile" + (" of " + label if label else "") + ", " + str(samples) + " samples:",
+             "%7s %7s  %s" % ("self", "total", "function")]
+    for code in sorted(inclusive, key=lambda code: (own.get(code, 0), inclusive[code]), reverse=True)[:TOP_FUNCTIONS]:
+        lines.append("%6.1f%% %6.1f%%  %s" % (own.get(code, 0) * 100 / samples, inclusive[code] * 100 / samples, function_name(code)))
+    return "\n".join(lines)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		write_collapsed
+#
+#    Prototype:	def write_collapsed(path, stacks)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    path - the file to write.
+#    stacks - a SamplingProfiler's stacks (see summarize).
+#
+#    Return Values:
+#	
+#    Description:
+#    This function writes the stacks in collapsed format, one "outer;...;inner count" line per
+#    stack, which flamegraph.pl and speedscope read as they are.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def write_collapsed(path, stacks):
+    with open(path, "w") as f:
+        for stack, count in sorted(stacks.items(), key=lambda item: item[1], reverse=True):
+            f.write(";".join(function_name(code) for code in stack) + " " + str(count) + "\n")
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		install_signals
+#
+#    Prototype:	def install_signals(timer, profiler)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    timer - the engine's StageTimer.
+#    profiler - a SamplingProfiler for the engine's thread.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function makes SIGUSR1 toggle the stage timings and SIGUSR2 capture a profile. It has to
+#    be called on the main thread, which is where the handlers run. The engine only reads the
+#    timer's flag between batches, so it never records half a packet.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def install_signals(timer, profiler):
+    signal.signal(signal.SIGUSR1, lambda signum, frame: timer.toggle())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.capture())
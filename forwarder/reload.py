@@ -0,0 +1,273 @@
+###################################################################################################
+#Name:	reload.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Reloads the forwarding rules while the forwarder is running. A RuleWatcher thread polls the
+#       rules file and compiles it whenever it changes; the engine picks the new RuleTable up between
+#       batches (see Engine.update_rules), so the packet loop never waits for a reload. Connections
+#       set up under a rule that has since been removed or changed keep their old target until they
+#       close: the old rules are kept as a "draining" table that only existing connections use.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+import os
+import threading
+from forwarder.rules import RuleTable, load_rules
+
+# How often (in seconds) the rules file is checked for changes
+DEFAULT_POLL_INTERVAL = 2.0
+
+class RuleWatcher:
+    __slots__ = ('path', 'interval', 'pending', 'reloads', 'thread', '_signature', '_stop', '_lock')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, path, interval = DEFAULT_POLL_INTERVAL)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the watcher
+#    path - the rules file the running rules were loaded from.
+#    interval - how often to check the file, in seconds.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a watcher for a rules file. The file's current state is taken as the
+#    one already loaded, so nothing is reloaded until it changes.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, path, interval = DEFAULT_POLL_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.pending = None
+        self.reloads = 0
+        self.thread = None
+        self._signature = file_signature(path)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		start
+#
+#    Prototype:	def start(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the watcher
+#
+#    Return Values:
+#	
+#    Description:
+#    This function starts the polling thread. It's a daemon thread, so it doesn't keep the
+#    forwarder alive. Threads don't survive fork, so each fanout worker starts its own watcher.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def start(self):
+        self.thread = threading.Thread(target=self.poll, name="rule-watcher", daemon=True)
+        self.thread.start()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		stop
+#
+#    Prototype:	def stop(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the watcher
+#
+#    Return Values:
+#	
+#    Description:
+#    This function stops the polling thread.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def stop(self):
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		poll
+#
+#    Prototype:	def poll(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the watcher
+#
+#    Return Values:
+#	
+#    Description:
+#    This function is the polling thread. When the file's size, modification time or inode changes
+#    (editors often replace the file rather than write to it) the file is compiled here, off the
+#    packet loop, and handed over through pending. A file that fails to load is reported and the
+#    running rules are kept; it's tried again once it changes.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def poll(self):
+        while not self._stop.wait(self.interval):
+            signature = file_signature(self.path)
+            if signature == self._signature:
+                continue
+            self._signature = signature
+
+            try:
+                forward_rules = load_rules(self.path)
+            except (ValueError, OSError) as e:
+                print("Not reloading " + self.path + ": " + str(e))
+                continue
+
+            with self._lock:
+                self.pending = forward_rules
+                self.reloads += 1
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		take
+#
+#    Prototype:	def take(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the watcher
+#
+#    Return Values:
+#    The newest compiled RuleTable, or None if the file hasn't changed since the last call.
+#
+#    Description:
+#    This function hands the latest reload to the engine. If the file changed more than once in
+#    between, only the newest rules are returned.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def take(self):
+        if self.pending is None:
+            return None # Checked without the lock; this is called once per batch
+
+        with self._lock:
+            forward_rules = self.pending
+            self.pending = None
+        return forward_rules
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		file_signature
+#
+#    Prototype:	def file_signature(path)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    path - the file to look at.
+#
+#    Return Values:
+#    A tuple that changes whenever the file does, or None if the file can't be read.
+#
+#    Description:
+#    This function returns the stat fields used to notice changes to the rules file.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		draining_rules
+#
+#    Prototype:	def draining_rules(old_rules, new_rules, draining = ())
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    old_rules - the RuleTable that was in use.
+#    new_rules - the RuleTable replacing it.
+#    draining - the RuleTables that were already draining, newest first.
+#
+#    Return Values:
+#    A list of RuleTables existing connections may still be using, newest first.
+#
+#    Description:
+#    This function works out which rules have to keep draining after a reload: every old rule that
+#    was removed or now forwards somewhere else, plus the rules that were draining before and still
+#    aren't in the new table. Each reload's rules stay in their own table, since a rule can be
+#    changed again while connections still use an older version of it.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def draining_rules(old_rules, new_rules, draining = ()):
+    current = set()
+    for network, prefix_len, low_port, high_port, target in new_rules.rules:
+        current.add((network, prefix_len, low_port, high_port, target.address))
+
+    result = []
+    for rules in [old_rules] + list(draining):
+        table = RuleTable()
+        for network, prefix_len, low_port, high_port, target in rules.rules:
+            if (network, prefix_len, low_port, high_port, target.address) not in current:
+                table.add(network, prefix_len, low_port, high_port, target)
+        if len(table):
+            result.append(table)
+
+    return result
@@ -0,0 +1,450 @@
+###################################################################################################
+#Name:	replay.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Offline replays for measuring the forwarder without root, interfaces or live traffic. Packets
+#       come from a pcap file or from a synthetic mix of flows, are run through an Engine in batches
+#       (see Engine.process) and the throughput and per-batch latency are reported. The entry point
+#       is replay.py in the top-level directory.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+import random
+import struct
+from time import monotonic, perf_counter_ns
+from packet import checksum as cksum
+
+PCAP_HEADER = struct.Struct('IHHiIII')
+PCAP_RECORD = struct.Struct('IIII')
+
+# pcap magic numbers (microsecond and nanosecond timestamps), as read in native byte order
+PCAP_MAGIC = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+
+# Link-layer types read_pcap understands
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IP = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88A8)
+IPPROTO_TCP = 6
+
+# Percentiles reported for the batch latency
+PERCENTILES = (50, 90, 99, 99.9)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		read_pcap
+#
+#    Prototype:	def read_pcap(path)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    path - a pcap file (not pcapng).
+#
+#    Return Values:
+#    A list of the IPv4 TCP packets in the file, without their link-layer headers.
+#
+#    Description:
+#    This function loads a capture for replaying. Ethernet (with or without VLAN tags), raw IP,
+#    BSD loopback and Linux cooked captures are understood. Packets that aren't IPv4 TCP, or were
+#    cut short by the capture's snap length, are skipped. Raises ValueError if the file isn't a pcap
+#    file or uses another link type.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def read_pcap(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if len(data) < PCAP_HEADER.size:
+        raise ValueError(path + " is not a pcap file")
+    for order in ('<', '>'):
+        magic = struct.unpack_from(order + 'I', data)[0]
+        if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+            break
+    else:
+        raise ValueError(path + " is not a pcap file (pcapng isn't supported)")
+
+    header = struct.Struct(order + PCAP_HEADER.format)
+    record = struct.Struct(order + PCAP_RECORD.format)
+    link_type = header.unpack_from(data)[6] & 0xFFFF
+
+    packets = []
+    offset = header.size
+    while offset + record.size <= len(data):
+        seconds, fraction, captured_len, original_len = record.unpack_from(data, offset)
+        offset += record.size
+        frame = data[offset:offset + captured_len]
+        offset += captured_len
+
+        if captured_len < original_len:
+            continue # Truncated by the snap length
+
+        ip_packet = strip_link_layer(frame, link_type)
+        if ip_packet is not None and len(ip_packet) >= 40 and ip_packet[0] >> 4 == 4 and ip_packet[9] == IPPROTO_TCP:
+            packets.append(ip_packet)
+
+    return packets
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		strip_link_layer
+#
+#    Prototype:	def strip_link_layer(frame, link_type)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    frame - one captured frame.
+#    link_type - the capture's link-layer type.
+#
+#    Return Values:
+#    The IP packet in the frame, or None if it doesn't hold an IPv4 packet.
+#
+#    Description:
+#    This function removes the link-layer header from a captured frame. Raises ValueError for
+#    link types it doesn't know.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def strip_link_layer(frame, link_type):
+    if link_type in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        return frame
+    elif link_type == LINKTYPE_ETHERNET:
+        offset = 12
+        ethertype = int.from_bytes(frame[offset:offset + 2], 'big')
+        while ethertype in ETHERTYPE_VLAN:
+            offset += 4
+            ethertype = int.from_bytes(frame[offset:offset + 2], 'big')
+        return frame[offset + 2:] if ethertype == ETHERTYPE_IP else None
+    elif link_type == LINKTYPE_LINUX_SLL:
+        return frame[16:] if int.from_bytes(frame[14:16], 'big') == ETHERTYPE_IP else None
+    elif link_type == LINKTYPE_LINUX_SLL2:
+        return frame[20:] if int.from_bytes(frame[0:2], 'big') == ETHERTYPE_IP else None
+    elif link_type == LINKTYPE_NULL:
+        # The address family is in the capturing host's byte order; AF_INET is 2 everywhere
+        return frame[4:] if frame[0:4] in (b'\x02\x00\x00\x00', b'\x00\x00\x00\x02') else None
+
+    raise ValueError("Unsupported pcap link type " + str(link_type))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		build_packet
+#
+#    Prototype:	def build_packet(src_ip, dst_ip, src_port, dst_port, flags, payload, seq_num = 0, ack_num = 0)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    src_ip - the source IP as a big-endian integer.
+#    dst_ip - the destination IP as a big-endian integer.
+#    src_port - the TCP source port.
+#    dst_port - the TCP destination port.
+#    flags - the TCP flags.
+#    payload - the TCP payload.
+#    seq_num - the sequence number.
+#    ack_num - the acknowledgement number.
+#
+#    Return Values:
+#    A bytes object holding the IP packet.
+#
+#    Description:
+#    This function builds an IPv4/TCP packet with a valid TCP checksum (the IP checksum is left
+#    zero; the engine never looks at it).
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def build_packet(src_ip, dst_ip, src_port, dst_port, flags, payload, seq_num = 0, ack_num = 0):
+    tcp_len = 20 + len(payload)
+    segment = bytearray(struct.pack('!HHIIBBHHH', src_port, dst_port, seq_num, ack_num, 5 << 4, flags, 65535, 0, 0))
+    segment += payload
+
+    padded = segment + b'\x00' * (len(segment) & 1)
+    total = sum(struct.unpack('!%dH' % (len(padded) // 2), padded))
+    total += cksum.tuple_sum(src_ip, dst_ip, 0, 0) + IPPROTO_TCP + tcp_len
+    struct.pack_into('!H', segment, 16, ~cksum.fold(total) & 0xFFFF)
+
+    ip_header = struct.pack('!BBHHHBBHII', 0x45, 0, 20 + tcp_len, 0, 0x4000, 64, IPPROTO_TCP, 0, src_ip, dst_ip)
+    return ip_header + bytes(segment)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		synthetic_packets
+#
+#    Prototype:	def synthetic_packets(sources, forwarder_ip, flow_count, packets_per_flow, payload_sizes, seed = 0)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    sources - (network, prefix_len, low_port, high_port) rule sources to generate clients for.
+#    forwarder_ip - the forwarder's IP as a big-endian integer (the clients' destination).
+#    flow_count - the number of connections.
+#    packets_per_flow - the number of client packets per connection, including the SYN.
+#    payload_sizes - a (min, max) range of payload sizes for the data packets.
+#    seed - the random seed, so mixes are reproducible.
+#
+#    Return Values:
+#    A list of IP packets.
+#
+#    Description:
+#    This function builds a mix of client connections. Each flow picks a rule and a client address
+#    and port inside it, opens with a SYN and then sends data; the flows' packets are interleaved
+#    at random, as they would be on a busy link.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def synthetic_packets(sources, forwarder_ip, flow_count, packets_per_flow, payload_sizes, seed = 0):
+    rng = random.Random(seed)
+    payload = bytes(rng.getrandbits(8) for i in range(payload_sizes[1]))
+
+    flows = []
+    for i in range(flow_count):
+        network, prefix_len, low_port, high_port = rng.choice(sources)
+        host_bits = (1 << (32 - prefix_len)) - 1
+        src_ip = network | (rng.getrandbits(32) & host_bits)
+        flows.append([src_ip, rng.randrange(1024, 65536), rng.randint(low_port, high_port), 0])
+
+    # Every flow appears packets_per_flow times, in a random order
+    order = [i for i in range(flow_count) for j in range(packets_per_flow)]
+    rng.shuffle(order)
+
+    packets = []
+    for i in order:
+        flow = flows[i]
+        src_ip, src_port, dst_port, sent = flow
+        if sent == 0:
+            packets.append(build_packet(src_ip, forwarder_ip, src_port, dst_port, 0x02, b'', 1000))
+        else:
+            size = rng.randint(payload_sizes[0], payload_sizes[1])
+            packets.append(build_packet(src_ip, forwarder_ip, src_port, dst_port, 0x18, payload[:size], 1001 + sent, 1))
+        flow[3] = sent + 1
+
+    return packets
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		reply_to
+#
+#    Prototype:	def reply_to(segment, src_ip, dst_ip)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    segment - a TCP segment the engine forwarded.
+#    src_ip - the IP the segment was sent from, as a big-endian integer.
+#    dst_ip - the IP the segment was sent to, as a big-endian integer.
+#
+#    Return Values:
+#    An IP packet answering the segment, as if sent by its destination.
+#
+#    Description:
+#    This function builds the target's answer to a forwarded segment: ports swapped, the same
+#    payload size and a SYN-ACK for a SYN.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def reply_to(segment, src_ip, dst_ip):
+    src_port, dst_port = struct.unpack_from('!HH', segment)
+    data_off = (segment[12] >> 4) * 4
+    flags = 0x12 if segment[13] & 0x02 else 0x10
+    return build_packet(dst_ip, src_ip, dst_port, src_port, flags, segment[data_off:], 5000, 1)
+
+class ReplayResult:
+    __slots__ = ('packets_in', 'packets_out', 'bytes_in', 'elapsed_ns', 'batch_latencies_ns')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the result
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates an empty set of replay measurements.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self):
+        self.packets_in = 0
+        self.packets_out = 0
+        self.bytes_in = 0
+        self.elapsed_ns = 0
+        self.batch_latencies_ns = []
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		percentile
+#
+#    Prototype:	def percentile(self, p)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the result
+#    p - the percentile, from 0 to 100.
+#
+#    Return Values:
+#    The batch latency at that percentile, in nanoseconds (nearest rank).
+#
+#    Description:
+#    This function reads a percentile off the measured batch latencies.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def percentile(self, p):
+        latencies = sorted(self.batch_latencies_ns)
+        if not latencies:
+            return 0
+        rank = max(0, min(len(latencies) - 1, int(round(p / 100.0 * len(latencies))) - 1))
+        return latencies[rank]
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__str__
+#
+#    Prototype:	def __str__(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the result
+#
+#    Return Values:
+#    A printable report.
+#
+#    Description:
+#    This function formats the throughput and the batch latency percentiles.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __str__(self):
+        seconds = self.elapsed_ns / 1e9 or 1e-9
+        lines = [
+            "Packets:    " + str(self.packets_in) + " in, " + str(self.packets_out) + " out",
+            "Elapsed:    " + format(seconds, '.3f') + " s",
+            "Throughput: " + format(self.packets_in / seconds, ',.0f') + " packets/s, " + format(self.bytes_in / seconds / 1e6, ',.2f') + " MB/s",
+            "Batch latency (us): " + ", ".join("p" + format(p, 'g') + " " + format(self.percentile(p) / 1000.0, '.1f') for p in PERCENTILES)
+                + ", max " + format(max(self.batch_latencies_ns or [0]) / 1000.0, '.1f')
+        ]
+        return "\n".join(lines)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		replay
+#
+#    Prototype:	def replay(engine, packets, batch_size, source = None, targets = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    engine - the Engine to run the packets through.
+#    packets - the IP packets to replay, in order.
+#    batch_size - the number of packets per batch, like the receive batch of the live forwarder.
+#    source - the forwarder's IP (as a big-endian integer), or None to forward from whichever
+#             address each packet was sent to.
+#    targets - the rules' target IPs, to answer every segment forwarded to them as the target would
+#              (see reply_to), or None. The answers are fed back in ahead of the next packets, so
+#              both directions are measured. Needs source.
+#
+#    Return Values:
+#    A ReplayResult.
+#
+#    Description:
+#    This function replays packets through an engine as fast as it can and times every batch.
+#    Building the replies isn't counted in the elapsed time.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def replay(engine, packets, batch_size, source = None, targets = None):
+    result = ReplayResult()
+    pending = []
+    index = 0
+
+    while index < len(packets) or pending:
+        # Replies go first, like segments that were already queued when the batch was read
+        batch = pending[:batch_size]
+        del pending[:batch_size]
+        room = batch_size - len(batch)
+        if room:
+            batch += packets[index:index + room]
+            index += room
+
+        start = perf_counter_ns()
+        forwarded = engine.process(batch, monotonic(), source)
+        latency = perf_counter_ns() - start
+
+        result.elapsed_ns += latency
+        result.batch_latencies_ns.append(latency)
+        result.packets_in += len(batch)
+        result.packets_out += len(forwarded)
+        result.bytes_in += sum(len(packet) for packet in batch)
+
+        if targets is not None:
+            for segment, dst_ip in forwarded:
+                if dst_ip in targets and not segment[13] & 0x04: # Nothing answers a RST
+                    pending.append(reply_to(segment, source, dst_ip))
+
+    return result
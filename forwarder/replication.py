@@ -0,0 +1,632 @@
+###################################################################################################
+#Name:	replication.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Active/standby replication of the NAT table, so a second forwarder can take over from the
+#       first without dropping its connections. The active forwarder's Replicator sends every change
+#       to the table (a connection created, changing state or removed) to the standby in batches over
+#       a UDP socket ("host:port") or a Unix datagram socket (a path). The Standby applies them to its
+#       own table and, once the active forwarder has gone quiet for a while, starts forwarding with it.
+#
+#       The engine only appends (key, entry) pairs to the NAT table's journal (see NatTable); a
+#       Replicator thread drains it every interval, keeps the last change of each connection and
+#       sends the connection as it is at that moment. Datagrams are numbered, and a standby that sees
+#       a gap (a lost datagram, or an active forwarder that restarted) asks for the whole table
+#       again, which is sent as a datagram flagged FLAG_RESET followed by ordinary ones. The whole
+#       table is also sent first thing, and whenever the journal overflowed. An idle active forwarder
+#       sends empty datagrams as heartbeats.
+#
+#       The standby only takes over once it has heard from the active forwarder, so start the active
+#       one first. Nothing stops the old active forwarder from forwarding again if it comes back;
+#       restart it as the new standby (--standby), with the new active one replicating to it.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+import os
+import select
+import socket
+import struct
+import threading
+from collections import deque
+from time import monotonic
+
+MAGIC = b'FWDREP\x00\x01'
+
+# magic, sequence number, record count, flags
+HEADER = struct.Struct('!8sIHB')
+
+# forward_ip, nat_port, ip, dst_port, src_port, forward_port, state, fins
+UPDATE = struct.Struct('!IHIHHHBB')
+
+# The state of a record that removes its connection
+REMOVED = 0xFF
+
+FLAG_RESET = 1  # The records that follow are the whole table; forget the rest
+FLAG_RESYNC = 2 # Sent by the standby: send the whole table
+
+# Records per datagram; 64 keeps a datagram inside a 1500 byte MTU
+MAX_RECORDS = 64
+
+# How often (in seconds) the changes are sent, how long the active forwarder can go without sending
+# anything before it sends a heartbeat, and how long the standby waits without hearing from it
+# before taking over
+DEFAULT_FLUSH_INTERVAL = 0.05
+DEFAULT_HEARTBEAT_INTERVAL = 0.5
+DEFAULT_FAILOVER_TIMEOUT = 2.0
+
+# The most changes queued between sends; if more pile up, the whole table is sent instead
+DEFAULT_JOURNAL_SIZE = 65536
+
+# How often (in seconds) a standby that's out of sync asks for the whole table
+RESYNC_RETRY_INTERVAL = 1.0
+
+class Replicator:
+    __slots__ = ('nat_table', 'peer', 'interval', 'heartbeat', 'journal', 'sequence', 'datagrams', 'updates', 'resyncs', 'send_errors',
+                 'thread', '_sock', '_reset', '_last_send', '_stop')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, nat_table, peer, interval = DEFAULT_FLUSH_INTERVAL, heartbeat = DEFAULT_HEARTBEAT_INTERVAL, journal_size = DEFAULT_JOURNAL_SIZE)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the replicator
+#    nat_table - the NatTable to replicate.
+#    peer - the standby's address: "host:port" for UDP, or the path of a Unix datagram socket.
+#    interval - how often to send the changes, in seconds.
+#    heartbeat - the longest to go without sending anything, in seconds.
+#    journal_size - the most changes queued between sends.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a replicator. Nothing is journalled or sent until it's started. The
+#    counters count the datagrams and connection records sent, the times the whole table was sent
+#    and the datagrams that couldn't be sent.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, nat_table, peer, interval = DEFAULT_FLUSH_INTERVAL, heartbeat = DEFAULT_HEARTBEAT_INTERVAL, journal_size = DEFAULT_JOURNAL_SIZE):
+        self.nat_table = nat_table
+        self.peer = socket_address(peer)
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.journal = deque(maxlen=journal_size)
+        self.sequence = 0
+        self.datagrams = 0
+        self.updates = 0
+        self.resyncs = 0
+        self.send_errors = 0
+        self.thread = None
+        self._sock = None
+        self._reset = True # The standby gets the whole table first
+        self._last_send = 0.0
+        self._stop = threading.Event()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		start
+#
+#    Prototype:	def start(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the replicator
+#
+#    Return Values:
+#	
+#    Description:
+#    This function hooks the journal up to the NAT table and starts the sending thread. It's a
+#    daemon thread, so it doesn't keep the forwarder alive. Threads don't survive fork, so each
+#    fanout worker starts its own replicator.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def start(self):
+        family, address = self.peer
+        self._sock = socket.socket(family, socket.SOCK_DGRAM)
+        if family == socket.AF_UNIX:
+            self._sock.bind("") # An abstract address, so the standby can answer
+        self._sock.settimeout(self.heartbeat)
+        self.nat_table.journal = self.journal
+        self.thread = threading.Thread(target=self.run, name="replicator", daemon=True)
+        self.thread.start()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		stop
+#
+#    Prototype:	def stop(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the replicator
+#
+#    Return Values:
+#	
+#    Description:
+#    This function stops the sending thread after sending whatever changes are left.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def stop(self):
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+            self.flush(monotonic())
+            self.nat_table.journal = None
+            self._sock.close()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		run
+#
+#    Prototype:	def run(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the replicator
+#
+#    Return Values:
+#	
+#    Description:
+#    This function is the sending thread. Between sends it waits for the standby's requests for
+#    the whole table; anything else arriving on the socket is ignored.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def run(self):
+        sock = self._sock
+        while not self._stop.is_set():
+            readable, writable, failed = select.select([sock], [], [], self.interval)
+            if readable:
+                try:
+                    data = sock.recv(HEADER.size)
+                except OSError:
+                    data = b''
+                if len(data) == HEADER.size:
+                    magic, sequence, count, flags = HEADER.unpack(data)
+                    if magic == MAGIC and flags & FLAG_RESYNC:
+                        self._reset = True
+            self.flush(monotonic())
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		flush
+#
+#    Prototype:	def flush(self, now)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the replicator
+#    now - the current time.monotonic().
+#
+#    Return Values:
+#	
+#    Description:
+#    This function sends the changes journalled since the last call, or the whole table if the
+#    standby asked for it or the journal overflowed (it drops the oldest changes when it's full).
+#    The journal is emptied before the table is copied, so a change made in between is either in
+#    the copy or still in the journal for the next send; sending a connection twice does no harm.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def flush(self, now):
+        journal = self.journal
+        dnat_table = self.nat_table.dnat_table
+
+        if self._reset or len(journal) == journal.maxlen:
+            self._reset = False
+            journal.clear()
+            changes = [(entry.key, entry) for entry in list(dnat_table.values())]
+            self.resyncs += 1
+            flags = FLAG_RESET
+        else:
+            changes = {}
+            while journal:
+                key, entry = journal.popleft()
+                changes[key] = entry
+            changes = changes.items()
+            flags = 0
+
+        records = []
+        for key, entry in changes:
+            if entry is None:
+                records.append(UPDATE.pack(key >> 16, key & 0xFFFF, 0, 0, 0, 0, REMOVED, 0))
+            elif dnat_table.get(key) is entry:
+                records.append(UPDATE.pack(key >> 16, key & 0xFFFF, entry.ip, entry.dst_port, entry.src_port, entry.forward_port, entry.state, entry.fins))
+            # Otherwise it's been removed or replaced since, and that's in the journal too
+
+        for i in range(0, len(records), MAX_RECORDS):
+            self.send(records[i:i + MAX_RECORDS], flags if i == 0 else 0, now)
+        if flags and not records:
+            self.send([], flags, now)
+        elif now - self._last_send >= self.heartbeat:
+            self.send([], 0, now)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		send
+#
+#    Prototype:	def send(self, records, flags, now)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the replicator
+#    records - packed UPDATE records, at most MAX_RECORDS of them.
+#    flags - the datagram's flags.
+#    now - the current time.monotonic().
+#
+#    Return Values:
+#	
+#    Description:
+#    This function sends one datagram to the standby. If the standby's socket is full, it waits up
+#    to a heartbeat interval for room (a Unix socket only queues a handful of datagrams, fewer than
+#    a large table takes); the engine keeps going meanwhile. A datagram that can't be sent is
+#    counted and skipped, and the gap in the sequence numbers gets the standby to ask for the whole
+#    table.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def send(self, records, flags, now):
+        datagram = HEADER.pack(MAGIC, self.sequence, len(records), flags) + b''.join(records)
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        self._last_send = now
+        try:
+            self._sock.sendto(datagram, self.peer[1])
+        except OSError:
+            self.send_errors += 1
+            return
+        self.datagrams += 1
+        self.updates += len(records)
+
+class Standby:
+    __slots__ = ('nat_table', 'tracker', 'address', 'timeout', 'sequence', 'synced', 'updates', 'resets', 'resync_requests',
+                 '_sock', '_last_heard', '_last_request')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, nat_table, tracker, address, timeout = DEFAULT_FAILOVER_TIMEOUT)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the standby
+#    nat_table - the NatTable to keep in step with the active forwarder's.
+#    tracker - the table's ConnTracker.
+#    address - the address to receive on: "host:port" for UDP, or the path of a Unix datagram
+#              socket.
+#    timeout - how long to go without hearing from the active forwarder before taking over, in
+#              seconds.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a standby. sequence is the number of the next datagram expected, and
+#    synced is True once the whole table has been received and no datagram has gone missing since.
+#    The counters count the connection records applied, the times the whole table was received
+#    and the times it was asked for.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, nat_table, tracker, address, timeout = DEFAULT_FAILOVER_TIMEOUT):
+        self.nat_table = nat_table
+        self.tracker = tracker
+        self.address = socket_address(address)
+        self.timeout = timeout
+        self.sequence = None
+        self.synced = False
+        self.updates = 0
+        self.resets = 0
+        self.resync_requests = 0
+        self._sock = None
+        self._last_heard = None
+        self._last_request = None
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		run
+#
+#    Prototype:	def run(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the standby
+#
+#    Return Values:
+#    The number of connections taken over.
+#
+#    Description:
+#    This function mirrors the active forwarder's NAT table until it goes quiet, then takes over.
+#    It runs on the forwarder's main thread before the engine starts, so the table is never shared.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def run(self):
+        family, address = self.address
+        self._sock = socket.socket(family, socket.SOCK_DGRAM)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+        self._sock.bind(address)
+        print("Standing by on " + format_address(self.address))
+
+        try:
+            while True:
+                readable, writable, failed = select.select([self._sock], [], [], self.timeout)
+                if readable:
+                    data, sender = self._sock.recvfrom(65535)
+                    self.receive(data, sender, monotonic())
+                if self._last_heard is not None and monotonic() - self._last_heard >= self.timeout:
+                    break
+        finally:
+            self._sock.close()
+            if family == socket.AF_UNIX:
+                os.unlink(address)
+
+        return self.take_over(monotonic())
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		receive
+#
+#    Prototype:	def receive(self, data, sender, now)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the standby
+#    data - a received datagram.
+#    sender - the address it came from.
+#    now - the current time.monotonic().
+#
+#    Return Values:
+#    True if it was a valid datagram from the active forwarder.
+#
+#    Description:
+#    This function applies a datagram from the active forwarder. The changes are applied even when
+#    one or more datagrams before it went missing, since each record holds a connection's whole
+#    state, but the standby isn't in sync again until it has had the whole table.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def receive(self, data, sender, now):
+        if len(data) < HEADER.size:
+            return False
+        magic, sequence, count, flags = HEADER.unpack_from(data)
+        if magic != MAGIC or len(data) != HEADER.size + count * UPDATE.size:
+            return False
+        self._last_heard = now
+
+        if flags & FLAG_RESET:
+            nat_table = self.nat_table
+            for key in list(nat_table.dnat_table):
+                nat_table.remove(key >> 16, key & 0xFFFF)
+            self.resets += 1
+            if self.resets == 1:
+                print("Replicating the NAT table from " + format_address((self._sock.family, sender)))
+            self.synced = True
+        elif sequence != self.sequence:
+            self.synced = False
+
+        if not self.synced and (self._last_request is None or now - self._last_request >= RESYNC_RETRY_INTERVAL):
+            self._last_request = now
+            self.resync_requests += 1
+            try:
+                self._sock.sendto(HEADER.pack(MAGIC, 0, 0, FLAG_RESYNC), sender)
+            except OSError:
+                pass
+
+        self.sequence = (sequence + 1) & 0xFFFFFFFF
+        self.apply(memoryview(data)[HEADER.size:])
+        return True
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		apply
+#
+#    Prototype:	def apply(self, records)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the standby
+#    records - packed UPDATE records.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function applies connection records to the table. A connection whose key now belongs to
+#    a different client is replaced. The connections aren't tracked until the standby takes over,
+#    since the traffic that keeps them alive goes to the active forwarder.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def apply(self, records):
+        nat_table = self.nat_table
+        dnat_table = nat_table.dnat_table
+        for forward_ip, nat_port, ip, dst_port, src_port, forward_port, state, fins in UPDATE.iter_unpack(records):
+            self.updates += 1
+            if state == REMOVED:
+                nat_table.remove(forward_ip, nat_port)
+                continue
+
+            entry = dnat_table.get((forward_ip << 16) | nat_port)
+            if entry is not None and (entry.ip != ip or entry.dst_port != dst_port):
+                nat_table.remove(forward_ip, nat_port)
+                entry = None
+            if entry is None:
+                entry = nat_table.restore(ip, dst_port, src_port, forward_ip, forward_port, nat_port)
+                if entry is None:
+                    continue
+            entry.state = state
+            entry.fins = fins
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		take_over
+#
+#    Prototype:	def take_over(self, now)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the standby
+#    now - the current time.monotonic().
+#
+#    Return Values:
+#    The number of connections taken over.
+#
+#    Description:
+#    This function starts tracking every mirrored connection, each with a full idle timeout for
+#    its state since the standby never saw how long it had been idle.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def take_over(self, now):
+        tracker = self.tracker
+        timeouts = tracker.timeouts
+        count = 0
+        for entry in list(self.nat_table.dnat_table.values()):
+            if entry.state < len(timeouts):
+                tracker.restore(entry, entry.state, entry.fins, now + timeouts[entry.state])
+                count += 1
+            else:
+                self.nat_table.remove(entry.key >> 16, entry.key & 0xFFFF)
+
+        print("No word from the active forwarder in " + str(self.timeout) + " s; taking over " + str(count) + " connections")
+        return count
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		socket_address
+#
+#    Prototype:	def socket_address(address)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    address - "host:port", or the path of a Unix socket.
+#
+#    Return Values:
+#    The (family, address) to open and address a datagram socket with.
+#
+#    Description:
+#    This function parses a replication address the way metrics addresses are parsed: anything
+#    with a "/" in it is a Unix socket path.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def socket_address(address):
+    if "/" in address:
+        return (socket.AF_UNIX, address)
+    host, port = address.rsplit(":", 1)
+    return (socket.AF_INET, (host, int(port)))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		format_address
+#
+#    Prototype:	def format_address(address)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    address - a (family, address) pair, as returned by socket_address.
+#
+#    Return Values:
+#    The address as text, for messages.
+#
+#    Description:
+#    This function formats an address for the standby's messages. The active forwarder's Unix
+#    socket has an abstract address, which is shown as the bytes it is.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def format_address(address):
+    family, address = address
+    if family == socket.AF_UNIX:
+        return address if isinstance(address, str) else repr(address)
+    return address[0] + ":" + str(address[1])
@@ -0,0 +1,659 @@
+###################################################################################################
+#Name:	rules.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Loads the forwarding rules from forward.json and compiles them into integer-keyed form.
+#       A rule "src_ip:port" -> {"ip", "port"} becomes (src_ip << 16) | port -> ForwardTarget,
+#       with the IPs as big-endian integers exactly as they come out of IpHeader. Rules can also
+#       name a network and a port range, e.g. "10.0.0.0/8:8000-8100"; those are compiled into a
+#       longest-prefix-match index next to the exact rules (see RuleTable).
+#
+#       A rule can also list several weighted backends instead of one target, e.g.
+#           "10.0.1.2:8005": [{"ip": "10.0.2.2", "port": 8080, "weight": 2},
+#                             {"ip": "10.0.2.3", "port": 8080}]
+#       which compiles to a BackendPool. New connections are spread over the backends by consistent
+#       hashing on the client's address and port, and stay on the backend they started on.
+#
+#    Revisions:
+#    2026-10-17 - Added CIDR and port-range rules.
+#    2026-10-17 - Added weighted backend pools.
+#
+###################################################################################################
+import hashlib
+import json
+from bisect import bisect_right
+from socket import inet_pton
+from socket import AF_INET
+
+# Points on a backend pool's hash ring per unit of weight; more points spread the clients more
+# evenly at the cost of a bigger ring
+RING_POINTS = 160
+
+class ForwardTarget:
+    __slots__ = ('ip', 'port', 'address', 'weight', 'healthy', 'backends')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, ip_str, port, weight = 1)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the target
+#    ip_str - the dotted-quad IP packets are forwarded to.
+#    port - the port packets are forwarded to.
+#    weight - the target's share of its pool's connections (see BackendPool).
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates the destination of a forwarding rule, or one backend of a BackendPool.
+#    address is the (ip, port) tuple handed to sendto, so it's only built once per rule. healthy is
+#    cleared by a health.HealthChecker while the target isn't accepting connections. backends is the
+#    target on its own, so code that needs every backend of a rule handles both kinds the same way.
+#
+#    Revisions:
+#	2026-10-17 - Added the weight, healthy and backends attributes for backend pools.
+#    
+#########################################################################################################
+    def __init__(self, ip_str, port, weight = 1):
+        self.ip = ip_to_int(ip_str)
+        self.port = port
+        self.address = (ip_str, port)
+        self.weight = weight
+        self.healthy = True
+        self.backends = (self,)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		select
+#
+#    Prototype:	def select(self, nat_table, src_ip, src_port, new_connection)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the target
+#    nat_table - the NAT table.
+#    src_ip - the client's IP as a big-endian integer.
+#    src_port - the client's port.
+#    new_connection - True if the segment is a SYN.
+#
+#    Return Values:
+#    The target itself.
+#
+#    Description:
+#    This function picks the backend a client's segment goes to. A single target is its own only
+#    backend; see BackendPool.select.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def select(self, nat_table, src_ip, src_port, new_connection):
+        return self
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		pinned
+#
+#    Prototype:	def pinned(self, nat_table, src_ip, src_port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the target
+#    nat_table - the NAT table.
+#    src_ip - the client's IP as a big-endian integer.
+#    src_port - the client's port.
+#
+#    Return Values:
+#    The target if the client already has a connection to it, otherwise None.
+#
+#    Description:
+#    This function looks for a client's existing NAT entry to this target.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def pinned(self, nat_table, src_ip, src_port):
+        dnat_entry = nat_table.find_source(src_ip, src_port, self.ip)
+        if dnat_entry is not None and dnat_entry.forward_port == self.port:
+            return self
+        return None
+
+    def has_backend(self, ip, port):
+        return self.ip == ip and self.port == port
+
+class BackendPool:
+    __slots__ = ('backends', 'address', 'ring_points', 'ring_backends')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, backends)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the pool
+#    backends - the ForwardTargets to spread connections over; their weights set each one's share.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates the destination of a rule with several backends. Each backend gets
+#    weight * RING_POINTS points on a hash ring, placed by hashing its address, so a backend's
+#    points don't depend on which other backends are in the pool: adding or removing one only moves
+#    the clients whose hashes fall next to its points, about 1/n of them. address identifies the
+#    pool when rules are reloaded (see reload.draining_rules).
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def __init__(self, backends):
+        self.backends = tuple(backends)
+        self.address = tuple(sorted((backend.address, backend.weight) for backend in self.backends))
+
+        points = []
+        for backend in self.backends:
+            ip_str, port = backend.address
+            for i in range(backend.weight * RING_POINTS):
+                digest = hashlib.md5((ip_str + ":" + str(port) + "#" + str(i)).encode()).digest()
+                points.append((int.from_bytes(digest[:8], 'big'), backend.address, backend))
+        points.sort(key=lambda point: point[:2])
+        self.ring_points = [point[0] for point in points]
+        self.ring_backends = [point[2] for point in points]
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		select
+#
+#    Prototype:	def select(self, nat_table, src_ip, src_port, new_connection)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the pool
+#    nat_table - the NAT table.
+#    src_ip - the client's IP as a big-endian integer.
+#    src_port - the client's port.
+#    new_connection - True if the segment is a SYN.
+#
+#    Return Values:
+#    The ForwardTarget the segment goes to.
+#
+#    Description:
+#    This function picks the backend a client's segment goes to. A connection stays on the backend
+#    its NAT entry was made for, even if the pool or the backends' health has changed since, so only
+#    a SYN is hashed without looking for one first.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def select(self, nat_table, src_ip, src_port, new_connection):
+        if not new_connection:
+            backend = self.pinned(nat_table, src_ip, src_port)
+            if backend is not None:
+                return backend
+        return self.pick(src_ip, src_port)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		pick
+#
+#    Prototype:	def pick(self, src_ip, src_port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the pool
+#    src_ip - the client's IP as a big-endian integer.
+#    src_port - the client's port.
+#
+#    Return Values:
+#    The ForwardTarget for a new connection from the client.
+#
+#    Description:
+#    This function hashes the client's address and port onto the ring and takes the first healthy
+#    backend at or after it. An ejected backend's clients move to the next point along, which
+#    spreads them over the others in proportion to their weights; everyone else stays put. If every
+#    backend is down, the hash picks as if they were all up.
+#
+#    Revisions:
+#	2026-10-17 - Walk the ring by index instead of slicing it.
+#    
+#########################################################################################################
+    def pick(self, src_ip, src_port):
+        ring_backends = self.ring_backends
+        i = bisect_right(self.ring_points, client_hash(src_ip, src_port))
+        if i == len(ring_backends):
+            i = 0
+        backend = ring_backends[i]
+        if backend.healthy:
+            return backend
+
+        # Walk round the ring in place rather than slicing a copy of it for every ejected hit
+        points = len(ring_backends)
+        for k in range(1, points):
+            backend = ring_backends[(i + k) % points]
+            if backend.healthy:
+                return backend
+        return ring_backends[i]
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		pinned
+#
+#    Prototype:	def pinned(self, nat_table, src_ip, src_port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the pool
+#    nat_table - the NAT table.
+#    src_ip - the client's IP as a big-endian integer.
+#    src_port - the client's port.
+#
+#    Return Values:
+#    The backend the client already has a connection to, or None.
+#
+#    Description:
+#    This function looks for a client's existing NAT entry to any of the pool's backends.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def pinned(self, nat_table, src_ip, src_port):
+        for backend in self.backends:
+            if backend.pinned(nat_table, src_ip, src_port) is not None:
+                return backend
+        return None
+
+    def has_backend(self, ip, port):
+        for backend in self.backends:
+            if backend.ip == ip and backend.port == port:
+                return True
+        return False
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		ip_to_int
+#
+#    Prototype:	def ip_to_int(ip_str)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    ip_str - a dotted-quad IPv4 address.
+#
+#    Return Values:
+#    The address as a big-endian integer.
+#
+#    Description:
+#    This function converts an address string to the integer form used by IpHeader.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def ip_to_int(ip_str):
+    return int.from_bytes(inet_pton(AF_INET, ip_str), 'big')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		endpoint_key
+#
+#    Prototype:	def endpoint_key(ip, port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    ip - an IP address as a big-endian integer.
+#    port - a port number.
+#
+#    Return Values:
+#    A single integer identifying the ip:port pair.
+#
+#    Description:
+#    This function packs an endpoint into the key used by the rule and NAT tables.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def endpoint_key(ip, port):
+    return (ip << 16) | port
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		client_hash
+#
+#    Prototype:	def client_hash(src_ip, src_port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    src_ip - the client's IP as a big-endian integer.
+#    src_port - the client's port.
+#
+#    Return Values:
+#    A 64-bit hash of the client's endpoint.
+#
+#    Description:
+#    This function places a client on a BackendPool's ring. It's the splitmix64 finalizer, so nearby
+#    addresses and ports land far apart, and unlike hash() it's the same in every process, so fanout
+#    workers agree on where a client goes.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def client_hash(src_ip, src_port):
+    h = (((src_ip << 16) | src_port) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return h ^ (h >> 31)
+
+class RuleTable:
+    __slots__ = ('exact', 'prefixes', 'rules')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the table
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates an empty rule table. Single-address, single-port rules go in exact, a
+#    dict keyed by endpoint_key, so the common case stays one dict lookup. Every other rule goes in
+#    prefixes: one (mask, networks) pair per prefix length, longest first, where networks maps a
+#    masked address to the sorted port ranges for that network (see add). A lookup costs at most one
+#    dict lookup and one bisect per distinct prefix length, however many rules there are.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = []
+        self.rules = []
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		add
+#
+#    Prototype:	def add(self, network, prefix_len, low_port, high_port, target)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the table
+#    network - the rule's source network as a big-endian integer.
+#    prefix_len - the network's prefix length (0 to 32).
+#    low_port - the first destination port the rule matches.
+#    high_port - the last destination port the rule matches.
+#    target - the ForwardTarget or BackendPool matching packets are sent to.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function adds a rule. Raises ValueError if the network has host bits set or if the rule
+#    overlaps another rule for the same network; rules for different prefix lengths may overlap, and
+#    the longest prefix wins.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def add(self, network, prefix_len, low_port, high_port, target):
+        if not 0 <= prefix_len <= 32:
+            raise ValueError("prefix length must be between 0 and 32")
+        if not 0 <= low_port <= high_port <= 0xFFFF:
+            raise ValueError("invalid port range")
+        mask = (0xFFFFFFFF << (32 - prefix_len)) & 0xFFFFFFFF
+        if network & ~mask:
+            raise ValueError("network has host bits set")
+
+        if prefix_len == 32 and low_port == high_port:
+            key = endpoint_key(network, low_port)
+            if key in self.exact:
+                raise ValueError("duplicate rule")
+            self.exact[key] = target
+        else:
+            for prefix_mask, networks in self.prefixes:
+                if prefix_mask == mask:
+                    break
+            else:
+                networks = {}
+                self.prefixes.append((mask, networks))
+                self.prefixes.sort(key=lambda prefix: prefix[0], reverse=True)
+
+            # Parallel lists: the rule for port p is at the last start <= p, if p <= its end
+            starts, ends, targets = networks.setdefault(network, ([], [], []))
+            i = bisect_right(starts, low_port)
+            if (i > 0 and ends[i - 1] >= low_port) or (i < len(starts) and starts[i] <= high_port):
+                raise ValueError("overlaps another rule for the same network")
+            starts.insert(i, low_port)
+            ends.insert(i, high_port)
+            targets.insert(i, target)
+
+        self.rules.append((network, prefix_len, low_port, high_port, target))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		get
+#
+#    Prototype:	def get(self, key)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the table
+#    key - endpoint_key(src_ip, dst_port) of a received segment.
+#
+#    Return Values:
+#    The ForwardTarget or BackendPool of the most specific matching rule, or None.
+#
+#    Description:
+#    This function looks up the rule for a segment: the exact rules first, then the network rules
+#    from the longest prefix down.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def get(self, key):
+        target = self.exact.get(key)
+        if target is None and self.prefixes:
+            ip = key >> 16
+            port = key & 0xFFFF
+            for mask, networks in self.prefixes:
+                ranges = networks.get(ip & mask)
+                if ranges is not None:
+                    starts, ends, targets = ranges
+                    i = bisect_right(starts, port) - 1
+                    if i >= 0 and port <= ends[i]:
+                        return targets[i]
+        return target
+
+    def __len__(self):
+        return len(self.rules)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		parse_source
+#
+#    Prototype:	def parse_source(source)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    source - the left-hand side of a rule: "ip[/prefix_len]:port[-port]".
+#
+#    Return Values:
+#    A (network, prefix_len, low_port, high_port) tuple.
+#
+#    Description:
+#    This function parses a rule's source. A bare address is a /32 and a bare port is a range of
+#    one. Raises ValueError if it's malformed.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def parse_source(source):
+    network_str, port_str = source.rsplit(':', 1)
+    network_str, slash, prefix_str = network_str.partition('/')
+    prefix_len = int(prefix_str) if slash else 32
+
+    low_str, dash, high_str = port_str.partition('-')
+    low_port = int(low_str)
+    high_port = int(high_str) if dash else low_port
+    return ip_to_int(network_str), prefix_len, low_port, high_port
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		parse_target
+#
+#    Prototype:	def parse_target(target)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    target - the right-hand side of a rule: {"ip", "port"}, or a list of them with optional weights.
+#
+#    Return Values:
+#    A ForwardTarget, or a BackendPool for a list of more than one backend.
+#
+#    Description:
+#    This function parses a rule's target. Raises ValueError if it's malformed.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def parse_target(target):
+    if isinstance(target, dict):
+        return ForwardTarget(target["ip"], int(target["port"]))
+    if not isinstance(target, list) or not target:
+        raise ValueError("target must be {\"ip\", \"port\"} or a non-empty list of them")
+
+    backends = []
+    for backend in target:
+        if not isinstance(backend, dict):
+            raise ValueError("backend must be {\"ip\", \"port\"[, \"weight\"]}")
+        weight = int(backend.get("weight", 1))
+        if weight < 1:
+            raise ValueError("backend weight must be at least 1")
+        backends.append(ForwardTarget(backend["ip"], int(backend["port"]), weight))
+
+    if len(set(backend.address for backend in backends)) != len(backends):
+        raise ValueError("duplicate backend")
+    if len(backends) == 1:
+        return backends[0]
+    return BackendPool(backends)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		load_rules
+#
+#    Prototype:	def load_rules(path)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    path - the forwarding rules file (see forward.json).
+#
+#    Return Values:
+#    A RuleTable.
+#
+#    Description:
+#    This function reads the rules file and compiles every rule into its integer form. Raises
+#    ValueError if a key or target is malformed or two rules overlap.
+#
+#    Revisions:
+#	2026-10-17 - Return a RuleTable so networks and port ranges can be used.
+#	2026-10-17 - Accept a list of backends as a target.
+#    
+#########################################################################################################
+def load_rules(path):
+    with open(path, 'r') as f:
+        raw_rules = json.load(f)
+
+    rules = RuleTable()
+    for source, target in raw_rules.items():
+        try:
+            network, prefix_len, low_port, high_port = parse_source(source)
+            rules.add(network, prefix_len, low_port, high_port, parse_target(target))
+        except (ValueError, KeyError, OSError) as e:
+            raise ValueError("Invalid forwarding rule \"" + source + "\": " + str(e))
+
+    return rules
@@ -0,0 +1,374 @@
+###################################################################################################
+#Name:	snapshot.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Saves the NAT table and connection tracking state to a file and loads it back, so a restarted
+#       forwarder carries on with the connections it was forwarding instead of dropping them all. A
+#       Checkpointer thread writes a snapshot every interval and once more on the way out; on startup
+#       the snapshot is loaded before the first packet is read.
+#
+#       The file is a fixed-size header followed by one fixed-size record per connection, all in
+#       network byte order, so it's written with Struct.pack_into and read back with iter_unpack
+#       without any per-record parsing. Deadlines are saved as the time left, and the time the
+#       forwarder was down is taken off when they're loaded; connections that ran out in between
+#       aren't restored. A snapshot is written to a temporary file and renamed over the old one, so a
+#       crash mid-write leaves the previous snapshot intact.
+#
+#       The packet loop never waits for a snapshot: the writer copies the table's entries (one quick
+#       step) and packs them off the loop, giving up the interpreter between chunks so the engine
+#       keeps forwarding. Connections set up or closed during the write may or may not make it in.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+import os
+import struct
+import threading
+import time
+from forwarder.conntrack import STATES
+
+MAGIC = b'FWDNAT\x00\x01'
+
+# magic, wall clock time it was written, NAT port shard (index, count), record count
+HEADER = struct.Struct('!8sdHHI')
+
+# forward_ip, nat_port, ip, dst_port, src_port, forward_port, state, fins, milliseconds left
+RECORD = struct.Struct('!IHIHHHBBI')
+
+# How often (in seconds) the snapshot is written
+DEFAULT_SNAPSHOT_INTERVAL = 10.0
+
+# Records packed between giving the engine a chance to run
+CHUNK_SIZE = 1024
+
+class Checkpointer:
+    __slots__ = ('path', 'nat_table', 'interval', 'writes', 'last_seconds', 'last_count', 'thread', '_stop')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, path, nat_table, interval = DEFAULT_SNAPSHOT_INTERVAL)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the checkpointer
+#    path - the snapshot file.
+#    nat_table - the NatTable to save.
+#    interval - how often to save it, in seconds.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a checkpointer. writes counts the snapshots written, and last_seconds
+#    and last_count are how long the latest one took and how many connections it saved.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, path, nat_table, interval = DEFAULT_SNAPSHOT_INTERVAL):
+        self.path = path
+        self.nat_table = nat_table
+        self.interval = interval
+        self.writes = 0
+        self.last_seconds = 0.0
+        self.last_count = 0
+        self.thread = None
+        self._stop = threading.Event()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		start
+#
+#    Prototype:	def start(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the checkpointer
+#
+#    Return Values:
+#	
+#    Description:
+#    This function starts the writing thread. It's a daemon thread, so it doesn't keep the
+#    forwarder alive. Threads don't survive fork, so each fanout worker starts its own checkpointer.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="checkpointer", daemon=True)
+        self.thread.start()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		stop
+#
+#    Prototype:	def stop(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the checkpointer
+#
+#    Return Values:
+#	
+#    Description:
+#    This function stops the writing thread and writes a last snapshot. It's called once the
+#    engine has stopped, so the snapshot holds every connection that was open.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def stop(self):
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.write()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		write
+#
+#    Prototype:	def write(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the checkpointer
+#
+#    Return Values:
+#	
+#    Description:
+#    This function writes a snapshot now. A snapshot that can't be written is reported and the
+#    previous one is kept; the next one is tried on schedule.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def write(self):
+        started = time.perf_counter()
+        try:
+            count = write_snapshot(self.path, self.nat_table, time.monotonic(), time.time())
+        except OSError as e:
+            print("Couldn't write the NAT snapshot " + self.path + ": " + str(e))
+            return
+        self.last_seconds = time.perf_counter() - started
+        self.last_count = count
+        self.writes += 1
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		write_snapshot
+#
+#    Prototype:	def write_snapshot(path, nat_table, now, wall)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    path - the snapshot file.
+#    nat_table - the NatTable to save.
+#    now - the current time.monotonic(), which the entries' deadlines are relative to.
+#    wall - the current time.time(), so the downtime can be worked out when it's loaded.
+#
+#    Return Values:
+#    The number of connections saved.
+#
+#    Description:
+#    This function saves every connection in the table that hasn't expired. It may run while the
+#    engine is changing the table: the entries are copied first, and each is checked to still be in
+#    the table when it's packed. Connections the engine has created but not yet tracked have no
+#    deadline and are left out.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def write_snapshot(path, nat_table, now, wall):
+    dnat_table = nat_table.dnat_table
+    entries = list(dnat_table.values())
+    buffer = bytearray(HEADER.size + RECORD.size * len(entries))
+    pack_into = RECORD.pack_into
+    offset = HEADER.size
+    count = 0
+
+    for i, entry in enumerate(entries):
+        if i % CHUNK_SIZE == 0:
+            time.sleep(0) # Let the engine have the interpreter
+
+        expires = entry.expires
+        key = entry.key
+        if expires is None or expires <= now or dnat_table.get(key) is not entry:
+            continue
+        remaining = int((expires - now) * 1000)
+        pack_into(buffer, offset, key >> 16, key & 0xFFFF, entry.ip, entry.dst_port, entry.src_port, entry.forward_port,
+                  entry.state, entry.fins, min(remaining, 0xFFFFFFFF))
+        offset += RECORD.size
+        count += 1
+
+    HEADER.pack_into(buffer, 0, MAGIC, wall, nat_table.port_shard[0], nat_table.port_shard[1], count)
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(memoryview(buffer)[:offset])
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return count
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		load_snapshot
+#
+#    Prototype:	def load_snapshot(path, nat_table, tracker, now, wall)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    path - the snapshot file.
+#    nat_table - the (empty) NatTable to restore the connections into.
+#    tracker - the table's ConnTracker.
+#    now - the current time.monotonic().
+#    wall - the current time.time().
+#
+#    Return Values:
+#    The number of connections restored.
+#
+#    Description:
+#    This function restores the connections saved in a snapshot, with their NAT ports, TCP state and
+#    what's left of their idle timeouts; records with an unknown state are skipped. The snapshot
+#    has to come from the same NAT port shard, since with fanout a connection's packets only reach
+#    the worker that owns its port. Raises ValueError if the file isn't a snapshot or doesn't
+#    match, and OSError if it can't be read.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def load_snapshot(path, nat_table, tracker, now, wall):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC:
+        raise ValueError(path + " isn't a NAT snapshot")
+    magic, saved_at, shard_index, shard_count, count = HEADER.unpack_from(data)
+    if (shard_index, shard_count) != tuple(nat_table.port_shard):
+        raise ValueError(path + " was saved by worker " + str(shard_index) + " of " + str(shard_count) +
+                         ", not worker " + str(nat_table.port_shard[0]) + " of " + str(nat_table.port_shard[1]))
+    if len(data) != HEADER.size + count * RECORD.size:
+        raise ValueError(path + " is truncated")
+
+    elapsed = max(0, int((wall - saved_at) * 1000))
+    restored = 0
+    for forward_ip, nat_port, ip, dst_port, src_port, forward_port, state, fins, remaining in RECORD.iter_unpack(memoryview(data)[HEADER.size:]):
+        remaining -= elapsed
+        if remaining <= 0 or state >= len(STATES):
+            continue
+        entry = nat_table.restore(ip, dst_port, src_port, forward_ip, forward_port, nat_port)
+        if entry is not None:
+            tracker.restore(entry, state, fins, now + remaining / 1000)
+            restored += 1
+    return restored
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		restore
+#
+#    Prototype:	def restore(path, nat_table, tracker)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    path - the snapshot file.
+#    nat_table - the (empty) NatTable to restore the connections into.
+#    tracker - the table's ConnTracker.
+#
+#    Return Values:
+#    The number of connections restored.
+#
+#    Description:
+#    This function loads a snapshot on startup and says how it went. A missing snapshot just means
+#    there's nothing to restore; one that can't be loaded is reported and the forwarder starts
+#    empty, as it would without one.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def restore(path, nat_table, tracker):
+    started = time.perf_counter()
+    try:
+        restored = load_snapshot(path, nat_table, tracker, time.monotonic(), time.time())
+    except FileNotFoundError:
+        return 0
+    except (ValueError, OSError) as e:
+        print("Not restoring the NAT table from " + path + ": " + str(e))
+        return 0
+
+    print("Restored " + str(restored) + " connections from " + path + " in " + str(round((time.perf_counter() - started) * 1000, 1)) + " ms")
+    return restored
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		worker_path
+#
+#    Prototype:	def worker_path(path, index)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    path - the snapshot file given on the command line.
+#    index - the fanout worker's index.
+#
+#    Return Values:
+#    The snapshot file of that worker.
+#
+#    Description:
+#    This function gives each fanout worker its own snapshot, the path with ".<index>" appended,
+#    since each one has its own NAT table.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def worker_path(path, index):
+    return path + "." + str(index)
@@ -0,0 +1,138 @@
+###################################################################################################
+#Name:	timerwheel.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       A hashed timer wheel. Items are dropped into the slot for their deadline tick and handed back
+#       when the wheel turns past that slot, so scheduling is O(1) and expiry only touches slots that
+#       are due instead of scanning every item. Deadlines further out than one turn of the wheel
+#       simply come back early; the caller checks the real deadline and schedules the item again.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+
+class TimerWheel:
+    __slots__ = ('tick', 'mask', 'slots', 'current', 'count')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, now, tick = 1.0, slot_count = 512)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the wheel
+#    now - the current time, in the same units as the deadlines (normally time.monotonic()).
+#    tick - the length of time covered by one slot.
+#    slot_count - the number of slots; must be a power of two.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates an empty wheel positioned at now.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def __init__(self, now, tick = 1.0, slot_count = 512):
+        if slot_count <= 0 or slot_count & (slot_count - 1):
+            raise ValueError("slot_count must be a power of two")
+
+        self.tick = tick
+        self.mask = slot_count - 1
+        self.slots = [[] for i in range(slot_count)]
+        self.current = int(now / tick)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		schedule
+#
+#    Prototype:	def schedule(self, item, deadline)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the wheel
+#    item - anything; it's returned as-is by advance.
+#    deadline - when the item is due.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function adds an item to the slot for its deadline. Items that are already due go in the
+#    next slot.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def schedule(self, item, deadline):
+        deadline_tick = int(deadline / self.tick)
+        if deadline_tick <= self.current:
+            deadline_tick = self.current + 1
+
+        self.slots[deadline_tick & self.mask].append(item)
+        self.count += 1
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		advance
+#
+#    Prototype:	def advance(self, now)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the wheel
+#    now - the current time.
+#
+#    Return Values:
+#    A list of the items in every slot the wheel passed (possibly empty).
+#
+#    Description:
+#    This function turns the wheel up to now and empties the slots it passes. The caller owns the
+#    returned items; anything that isn't really due yet has to be scheduled again.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def advance(self, now):
+        target = int(now / self.tick)
+        if target <= self.current:
+            return []
+
+        # After a full turn every slot has been visited, so don't loop more than that
+        steps = min(target - self.current, self.mask + 1)
+        due = []
+        for i in range(steps):
+            self.current += 1
+            index = self.current & self.mask
+            if self.slots[index]:
+                due.extend(self.slots[index])
+                self.slots[index] = []
+
+        self.current = target
+        self.count -= len(due)
+        return due
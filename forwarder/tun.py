@@ -0,0 +1,411 @@
+###################################################################################################
+#Name:	tun.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Packet I/O through a TUN device. The host routes the traffic to be forwarded into the device
+#       (e.g. with "ip route add <client network> dev fwd0" or policy routing), the forwarder reads
+#       whole IP packets from it and writes the forwarded ones back as whole IP packets, so the IP
+#       header is built here rather than by the kernel. Nothing reaches the host's own TCP stack,
+#       which means no RSTs for the forwarded ports either. A TUN device has no batched read or write,
+#       so each packet is still one system call, but the device is read until it's empty after each
+#       wakeup and nothing is allocated per packet. The kernel only takes socket filters on TAP
+#       devices, so there's no prefilter; the routes into the device decide what the forwarder sees.
+#
+#       Written packets come from one of the host's own addresses, which the kernel treats as a
+#       martian source on input unless accept_local is set on the device (see README.txt).
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+import os
+import select
+import struct
+from fcntl import ioctl
+from forwarder.batchio import BufferRing, DEFAULT_BATCH_SIZE, DEFAULT_BUFFER_SIZE, route_source
+from packet import checksum, tcp
+
+# linux/if_tun.h
+TUNSETIFF = 0x400454ca
+IFF_TUN = 0x0001
+IFF_NO_PI = 0x1000
+
+DEFAULT_TUN_NAME = "fwd0"
+
+# version/IHL, TOS, total length, ID, flags/fragment offset, TTL, protocol, checksum, source, destination
+IP_HEADER = struct.Struct('!BBHHHBBHII')
+IP_HEADER_LEN = 20
+IP_DONT_FRAGMENT = 0x4000
+DEFAULT_TTL = 64
+
+class TunDevice:
+    __slots__ = ('name', 'fd')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, name = DEFAULT_TUN_NAME)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the device
+#    name - the interface name; the device is created if it doesn't exist.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function opens a TUN device without the packet information header, so reads and writes
+#    are bare IP packets. The device still has to be brought up and routed to.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, name = DEFAULT_TUN_NAME):
+        self.fd = os.open("/dev/net/tun", os.O_RDWR | os.O_NONBLOCK)
+        try:
+            ifr = ioctl(self.fd, TUNSETIFF, struct.pack('16sH', name.encode(), IFF_TUN | IFF_NO_PI))
+        except OSError:
+            os.close(self.fd)
+            raise
+        self.name = ifr[:16].rstrip(b'\0').decode()
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+class TunReceiver:
+    __slots__ = ('device', 'ring', 'truncated', '_poll')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, device, batch_size = DEFAULT_BATCH_SIZE, buffer_size = DEFAULT_BUFFER_SIZE)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the receiver
+#    device - the TunDevice to read from.
+#    batch_size - the most packets returned by one recv.
+#    buffer_size - the largest packet that can be received.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a receiver with the same interface as batchio.BatchReceiver.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, device, batch_size = DEFAULT_BATCH_SIZE, buffer_size = DEFAULT_BUFFER_SIZE):
+        self.device = device
+        self.ring = BufferRing(batch_size, buffer_size)
+        self.truncated = 0
+        self._poll = select.poll()
+        self._poll.register(device.fd, select.POLLIN)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		recv
+#
+#    Prototype:	def recv(self, timeout)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the receiver
+#    timeout - the longest time to wait for a packet, in seconds.
+#
+#    Return Values:
+#    A list of memoryviews of the received packets (valid until the next call), possibly empty.
+#
+#    Description:
+#    This function waits for the device to become readable and then reads packets until it's empty
+#    or the batch is full. A TUN read returns the packet's full length even if it didn't fit, so
+#    oversized packets are counted as truncated and dropped.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def recv(self, timeout):
+        if not self._poll.poll(int(timeout * 1000)):
+            return []
+
+        fd = self.device.fd
+        ring = self.ring
+        views = ring.views
+        packets = []
+
+        for i in range(ring.count):
+            try:
+                length = os.readv(fd, [views[i]])
+            except BlockingIOError:
+                break
+
+            if length > ring.size:
+                self.truncated += 1
+                continue
+            ring.lengths[i] = length
+            packets.append(views[i][:length])
+
+        return packets
+
+class TunSender:
+    __slots__ = ('device', 'ring', 'pending', 'dropped', 'mark', '_ident', '_sources')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, device, batch_size = DEFAULT_BATCH_SIZE, buffer_size = DEFAULT_BUFFER_SIZE, mark = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the sender
+#    device - the TunDevice to write to.
+#    batch_size - the number of packets that can be queued before they're flushed.
+#    buffer_size - the largest TCP segment that can be queued.
+#    mark - the firewall mark whose routes pick the source address, or None. The device can't mark
+#           the packets it injects; use policy routing on the device instead.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function creates a sender with the same interface as batchio.BatchSender. Each ring slot
+#    has room for the IP header in front of the segment.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, device, batch_size = DEFAULT_BATCH_SIZE, buffer_size = DEFAULT_BUFFER_SIZE, mark = None):
+        self.device = device
+        self.ring = BufferRing(batch_size, buffer_size + IP_HEADER_LEN)
+        self.pending = 0
+        self.dropped = 0
+        self.mark = mark or 0
+        self._ident = 0
+        self._sources = {}
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		queue
+#
+#    Prototype:	def queue(self, data, dst_ip)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the sender
+#    data - the TCP segment to send (copied into the ring, so it can be reused right away).
+#    dst_ip - the destination IP as a big-endian integer.
+#
+#    Return Values:
+#    True if the packet was queued.
+#
+#    Description:
+#    This function puts an IP header in front of a segment and queues the packet for the next flush,
+#    flushing first if the ring is full. The source address is the one source_ip returned for
+#    dst_ip, which the segment's checksum was computed with.
+#
+#    Revisions:
+#	2026-10-17 - Return whether the packet was queued.
+#
+#########################################################################################################
+    def queue(self, data, dst_ip):
+        length = len(data) + IP_HEADER_LEN
+        if length > self.ring.size:
+            self.dropped += 1
+            return False
+
+        src_ip = self._sources.get(dst_ip)
+        if src_ip is None:
+            self.dropped += 1 # No route, so the segment couldn't have been checksummed for one
+            return False
+
+        if self.pending == self.ring.count:
+            self.flush()
+
+        index = self.pending
+        view = self.ring.views[index]
+        self._ident = (self._ident + 1) & 0xFFFF
+        pack_ip_header(view, src_ip, dst_ip, length, self._ident)
+        view[IP_HEADER_LEN:length] = data
+        self.ring.lengths[index] = length
+        self.pending += 1
+        return True
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		queue_rewrite
+#
+#    Prototype:	def queue_rewrite(self, data, dst_ip, src_port, dst_port, checksum)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the sender
+#    data - the received TCP segment to forward (copied into the ring).
+#    dst_ip - the destination IP as a big-endian integer.
+#    src_port - the source port to forward it from.
+#    dst_port - the destination port to forward it to.
+#    checksum - its checksum with the new ports and addresses.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function is batchio.BatchSender.queue_rewrite for the device: the segment is queued and
+#    then patched behind its IP header.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def queue_rewrite(self, data, dst_ip, src_port, dst_port, checksum):
+        if self.queue(data, dst_ip):
+            tcp.patch_header(self.ring.views[self.pending - 1], IP_HEADER_LEN, src_port, dst_port, checksum)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		flush
+#
+#    Prototype:	def flush(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the sender
+#
+#    Return Values:
+#	
+#    Description:
+#    This function writes every queued packet to the device. Packets the device won't take are
+#    dropped and counted rather than retried.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def flush(self):
+        pending = self.pending
+        if not pending:
+            return
+        self.pending = 0
+
+        fd = self.device.fd
+        views = self.ring.views
+        lengths = self.ring.lengths
+        for i in range(pending):
+            try:
+                os.write(fd, views[i][:lengths[i]])
+            except OSError:
+                self.dropped += 1
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		source_ip
+#
+#    Prototype:	def source_ip(self, dst_ip, default)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the sender
+#    dst_ip - a destination IP as a big-endian integer.
+#    default - what to return if there's no route to dst_ip.
+#
+#    Return Values:
+#    The source IP to put on packets sent to dst_ip, as a big-endian integer.
+#
+#    Description:
+#    This function picks the source address for a destination the same way batchio.BatchSender
+#    does: from the host's route to it, cached per destination.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def source_ip(self, dst_ip, default):
+        src_ip = self._sources.get(dst_ip)
+        if src_ip is not None:
+            return src_ip
+
+        src_ip = route_source(dst_ip, self.mark)
+        if src_ip is None:
+            return default
+
+        self._sources[dst_ip] = src_ip
+        return src_ip
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		pack_ip_header
+#
+#    Prototype:	def pack_ip_header(buffer, src_ip, dst_ip, total_len, ident, ttl = DEFAULT_TTL)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    buffer - a writable buffer with room for the header at offset 0.
+#    src_ip - the source IP as a big-endian integer.
+#    dst_ip - the destination IP as a big-endian integer.
+#    total_len - the length of the whole packet, header included.
+#    ident - the IP ID.
+#    ttl - the time to live.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function writes a 20-byte IPv4 header for a TCP segment, with DF set and the header
+#    checksum filled in. Only the lengths, ID and addresses vary, so the checksum is summed directly
+#    rather than over the packed words.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def pack_ip_header(buffer, src_ip, dst_ip, total_len, ident, ttl = DEFAULT_TTL):
+    proto_ttl = (ttl << 8) | 6
+    total = 0x4500 + total_len + ident + IP_DONT_FRAGMENT + proto_ttl + checksum.tuple_sum(src_ip, dst_ip, 0, 0)
+    header_checksum = ~checksum.fold(total) & 0xFFFF
+    IP_HEADER.pack_into(buffer, 0, 0x45, 0, total_len, ident, IP_DONT_FRAGMENT, ttl, 6, header_checksum, src_ip, dst_ip)
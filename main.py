@@ -20,125 +20,260 @@
 ###################################################################################################
 
 import sys
-import struct
-import json
-from socket import socket, inet_ntop, inet_pton
-from socket import AF_INET, SOCK_RAW, IPPROTO_TCP
-from packet import ip, tcp
-from random import randint
+import argparse
+from packet import batch, tcp
+from forwarder import admission, backends, batchio, conntrack, engine, fanout, flowcache, health, metrics, nat, packetlog, ports, profiling, reload, replication, rules, snapshot
+from time import monotonic
 
 FORWARD_RULES_FILE="forward.json"
 
+# Source ports handed out when a client's own source port collides with another client's
+NAT_PORT_RANGE=ports.DEFAULT_PORT_RANGE
+
+# Idle timeouts (in seconds) for each TCP state before a connection's NAT entries are removed
+CONNTRACK_TIMEOUTS=conntrack.DEFAULT_TIMEOUTS
+
+# Limits on the NAT table, so a SYN flood can't use up memory or ports: the most connections in
+# total and from one client IP (None for no limit). When the table is full, the least recently
+# closed connection is evicted, then the least recently used half-open one; established ones never
+# are. With --workers, NAT_MAX_ENTRIES is split between the workers and the other limits apply to
+# each worker on its own.
+NAT_MAX_ENTRIES=None
+NAT_MAX_PER_SOURCE=None
+
+# New connections (SYNs) allowed per client IP per second, and in one burst, or None for no limit
+# (see forwarder/admission.py)
+SYN_RATE=None
+SYN_BURST=admission.DEFAULT_SYN_BURST
+
+# How often (in seconds) to check for expired connections when no packets are arriving
+EXPIRY_INTERVAL=1.0
+
+# Packets received/sent per system call, and the largest packet that can be received. Larger
+# packets (e.g. GRO-merged or jumbo frames) are dropped rather than silently truncated.
+BATCH_SIZE=batchio.DEFAULT_BATCH_SIZE
+RECV_BUFFER_SIZE=batchio.DEFAULT_BUFFER_SIZE
+
+# Use recvmmsg/sendmmsg when available; otherwise one recvmsg_into/sendto per packet
+USE_MMSG=True
+
+# Most flows (one per direction of a connection) whose rewrite is cached, so their segments skip
+# the rules and NAT lookups; the least recently used flow is evicted beyond that. 0 disables the cache.
+FLOW_CACHE_SIZE=flowcache.DEFAULT_CAPACITY
+
+# How often (in seconds) to check the rules file for changes. Changed rules are swapped in without
+# a restart; connections using a removed or changed rule keep their old target until they close.
+# None disables reloading.
+RELOAD_INTERVAL=reload.DEFAULT_POLL_INTERVAL
+
+# How often (in seconds) to probe the backends of rules with several backends (--health-check), or
+# None to never eject them. A backend that refuses HEALTH_FALL connections in a row gets no new
+# connections until it accepts HEALTH_RISE in a row (see forwarder/health.py).
+HEALTH_CHECK_INTERVAL=None
+HEALTH_CHECK_TIMEOUT=health.DEFAULT_CHECK_TIMEOUT
+HEALTH_FALL=health.DEFAULT_FALL
+HEALTH_RISE=health.DEFAULT_RISE
+
+# File the NAT table is saved to every SNAPSHOT_INTERVAL seconds and on exit (--snapshot), and
+# loaded from on startup, so connections survive a restart; None to start from scratch every time.
+# Fanout workers each keep their own, the path with ".N" appended (see forwarder/snapshot.py).
+SNAPSHOT_PATH=None
+SNAPSHOT_INTERVAL=snapshot.DEFAULT_SNAPSHOT_INTERVAL
+
+# Active/standby replication (see forwarder/replication.py). The active forwarder sends every change
+# to its NAT table to the standby (--replicate-to ADDRESS) and the standby (--standby ADDRESS) mirrors
+# it without forwarding anything, until it hasn't heard from the active one for FAILOVER_TIMEOUT
+# seconds; then it takes over with the same connections. ADDRESS is "host:port" for UDP or a Unix
+# socket path. Give a standby --replicate-to as well so that, once it takes over, the old active
+# forwarder can be restarted as its standby. With --workers, worker N uses port+N or the path with ".N".
+REPLICATION_PEER=None
+STANDBY_ADDRESS=None
+REPLICATION_INTERVAL=replication.DEFAULT_FLUSH_INTERVAL
+HEARTBEAT_INTERVAL=replication.DEFAULT_HEARTBEAT_INTERVAL
+FAILOVER_TIMEOUT=replication.DEFAULT_FAILOVER_TIMEOUT
+
+# Number of forwarding processes (--workers). With more than one, each worker reads from its own
+# AF_PACKET socket in a fanout group and owns a shard of the NAT port range. FANOUT_GROUP_ID must be
+# unique on the host (None picks one from the pid); FANOUT_INTERFACE (--interface) limits the workers
+# to one interface.
+WORKER_COUNT=1
+FANOUT_GROUP_ID=None
+FANOUT_INTERFACE=None
+
+# Firewall mark (SO_MARK) put on forwarded packets (--mark), or None. This lets policy routing or
+# firewall rules tell forwarded segments apart from the host's own, e.g. to drop the RSTs the
+# kernel sends for the forwarded ports without dropping forwarded RSTs (see scripts/netns-setup.sh).
+SEND_MARK=None
+
+# Set to True to decode and rewrite the segments of cached flows a whole batch at a time with NumPy
+# (see packet/batch.py), if it's installed. This only pays off with large batches (BATCH_SIZE of
+# 64 or more), since the cache lookup and connection tracking are still done per packet.
+BATCH_HEADERS=False
+
+# Set to True to recompute every forwarded checksum from scratch and compare it with the
+# incrementally adjusted one. Slow; only useful when debugging the rewrite code.
+VERIFY_CHECKSUMS=False
+
+# Attach a socket filter compiled from the rules so the kernel only queues segments the forwarder
+# will actually handle (see forwarder/bpf.py). Everything else is dropped before it is copied out.
+PREFILTER=True
+
+# Where packets are read from and written to in single-process mode (--backend): "raw" (a raw TCP
+# socket; the kernel builds the forwarded IP headers), "packet" (an AF_PACKET socket, optionally on
+# one --interface), or "tun" (a TUN device named by --interface that the traffic is routed into).
+# See forwarder/backends.py. The fanout workers always use AF_PACKET.
+BACKEND="raw"
+
+# Packet logging (--log): "off", "drops" (packets dropped for lack of NAT ports and the like) or
+# "packets" (also every PACKET_LOG_SAMPLE'th forwarded packet, --log-sample). Records are formatted
+# and written by a background thread, so logging doesn't hold up forwarding (see forwarder/packetlog.py).
+PACKET_LOG_LEVEL="drops"
+PACKET_LOG_SAMPLE=packetlog.DEFAULT_SAMPLE_EVERY
+
+# Where to serve the metrics in the Prometheus text format (--metrics): "host:port", the path of a
+# Unix socket, or None for no endpoint (the counters are kept either way; see forwarder/metrics.py).
+# Fanout workers each serve their own: worker N on port+N, or on the socket path with ".N" appended.
+METRICS_ADDRESS=None
+
+# Profiling while running (see forwarder/profiling.py). SIGUSR1 starts timing each stage of the loop
+# (receiving, parsing, the rule and NAT lookups, rewriting, sending and so on) and the next SIGUSR1
+# prints the breakdown; PROFILE_STAGES starts with it on. SIGUSR2 samples the loop's stack every
+# PROFILE_INTERVAL seconds for PROFILE_SECONDS, prints the top functions and writes the stacks to
+# PROFILE_PATH (--profile-to) if it's set. With --workers, send the signals to the parent; worker N
+# writes to the path with ".N" appended.
+PROFILE_STAGES=False
+PROFILE_PATH=None
+PROFILE_SECONDS=profiling.DEFAULT_SAMPLE_SECONDS
+PROFILE_INTERVAL=profiling.DEFAULT_SAMPLE_INTERVAL
+
 if __name__ == "__main__":
-    forward_rules = None
-    with open(FORWARD_RULES_FILE, 'r') as f:
-        forward_rules = json.load(f)
-
-    # The DNAT table is used to forward traffic coming from the "outside" back to the "inside".
-    # Keys in this table are in the form "forward_dst_ip:dst_port", where "forward_dst_ip" is
-    # an IP to which packets are forwarded (right-hand side of a forwarding rule) and "dst_port"
-    # is the source port assigned by the forwarder for the "inside" machine.
-    #
-    # These keys map to another map with mappings "ip":[little-endian IP address],
-    # "port":[little-endian port].
-    #
-    # The SNAT table is used to do the opposite. Keys in this table are in the form
-    # "forwarded_src_ip:src_port", where "forwarded_src_ip" is the IP of some "internal" host,
-    # and "src_port" is also exactly what it sounds like.
-    #
-    # These keys map to the source port to use as a little-endian int.
-    dnat_table = {}
-    snat_table = {}
-
-    # Create a raw socket to get TCP packets
-    s = socket(AF_INET, SOCK_RAW, IPPROTO_TCP)
-    s.bind(('', IPPROTO_TCP)) # '' binds to any (all?) available interface
-    
-    while (True):
-        try:
-            response, address = s.recvfrom(1522)
-     
-            ip_header = ip.IpHeader(response)
-            tcp_header = tcp.TcpHeader(response[ip_header.header_len:])
-            data = response[ip_header.header_len + tcp_header.data_off:]
-
-            src_ip_str = inet_ntop(AF_INET, ip_header.src_ip.to_bytes(4, 'big'))
-
-            forward_str = src_ip_str + ":" + str(tcp_header.dst_port)
-
-            new_src_port = None
-
-            if forward_str in forward_rules:
-                forward_dst_ip_str = forward_rules[forward_str]["ip"]                
-
-                snat_entry_str = src_ip_str + ":" + str(tcp_header.src_port)
-                dnat_entry_str = forward_dst_ip_str + ":" + str(tcp_header.src_port)
-
-                if snat_entry_str in snat_table:
-                    # There's already a NAT entry for this source IP:port pair; perfect.
-                    new_src_port = snat_table[snat_entry_str]
-
-                elif dnat_entry_str not in dnat_table:
-                    # There wasn't already a mapping for this source NAT. There's no collision though
-                    # (no other host is forwarding to the same dest IP with the same source port), so
-                    # so just reuse the source port and update the mappings.
-                    dnat_table[dnat_entry_str] = {"ip":ip_header.src_ip, "dst_port":tcp_header.src_port, "src_port":tcp_header.dst_port}
-                    snat_table[snat_entry_str] = tcp_header.src_port
-                    new_src_port = tcp_header.src_port
-                else:
-                    # There wasn't already a mapping for this source NAT and there was a collision.
-                    # Choose a random new unused source port and create the mapping.
-                    # Theoretically this could loop infinitely (and almost certainly would in real life
-                    # since we never clear the used mappings), but for this case it doesn't matter.
-                    while True:
-                        print("Choosing a random source port to resolve NAT collision")
-                        possible_port = randint(49152, 65535)
-                        possible_dnat_str = forward_dst_ip_str + ":" + str(possible_port)
-                        if possible_dnat_str not in dnat_table:
-                            print("Port chosen: " + str(possible_port))
-                            new_src_port = possible_port
-                            snat_table[snat_entry_str] = possible_port
-                            dnat_table[possible_dnat_str] = {"ip":ip_header.src_ip, "dst_port":tcp_header.src_port, "src_port":tcp_header.dst_port}
-                            break
-
-                print(ip_header)
-                print(tcp_header)
-                forward_ip = forward_rules[forward_str]["ip"]
-                forward_port = forward_rules[forward_str]["port"]
-                forward_address = (forward_ip, forward_port)
-
-                tcp_header.dst_port = forward_port
-                tcp_header.src_port = new_src_port
-                response_address = int.from_bytes(inet_pton(AF_INET, address[0]), 'big')
-                forward_ip_little = int.from_bytes(inet_pton(AF_INET, forward_ip), 'big')
-                forward_tcp_header = tcp_header.to_bytes(ip_header.dst_ip, forward_ip_little, data)
-
-                forward_packet = bytearray(response[ip_header.header_len:])     
-                forward_packet[:tcp_header.data_off] = forward_tcp_header[:]
-
-                s.sendto(forward_packet, forward_address)
-            else:
-                # Is this traffic a response from a dest IP?
-#                snat_entry_str = src_ip_str + ":" + str(tcp_header.src_port)
-                dnat_entry_str = src_ip_str + ":" + str(tcp_header.dst_port)
-                
-                if dnat_entry_str in dnat_table:
-                    # TODO Change source IP, dest IP, and destination port, then forward
-                    print(ip_header)
-                    print(tcp_header)
-                    forward_dst_ip = dnat_table[dnat_entry_str]["ip"]
-                    forward_dst_port = dnat_table[dnat_entry_str]["dst_port"]
-                    forward_src_port = dnat_table[dnat_entry_str]["src_port"]
-                    tcp_header.dst_port = forward_dst_port
-                    tcp_header.src_port = forward_src_port
-                    forward_tcp_header = tcp_header.to_bytes(ip_header.dst_ip, forward_dst_ip, data)
-
-                    forward_packet = bytearray(response[ip_header.header_len:])     
-                    forward_packet[:tcp_header.data_off] = forward_tcp_header[:]
-
-                    forward_address = (inet_ntop(AF_INET, forward_dst_ip.to_bytes(4, byteorder='big')), forward_dst_port)
-                    s.sendto(forward_packet, forward_address)
+    parser = argparse.ArgumentParser(description="TCP port forwarder")
+    parser.add_argument("rules", nargs="?", default=FORWARD_RULES_FILE, help="forwarding rules file (default: " + FORWARD_RULES_FILE + ")")
+    parser.add_argument("-w", "--workers", type=int, default=WORKER_COUNT, help="number of fanout worker processes")
+    parser.add_argument("-i", "--interface", default=FANOUT_INTERFACE, help="interface the fanout workers or the packet backend listen on, or the tun backend's device")
+    parser.add_argument("-b", "--backend", choices=[name for name in backends.BACKENDS if name != "memory"], default=BACKEND, help="packet I/O backend in single-process mode")
+    parser.add_argument("-m", "--mark", type=int, default=SEND_MARK, help="firewall mark for forwarded packets")
+    parser.add_argument("-l", "--log", choices=list(packetlog.LEVELS), default=PACKET_LOG_LEVEL, help="what to log (default: " + PACKET_LOG_LEVEL + ")")
+    parser.add_argument("--log-sample", type=int, default=PACKET_LOG_SAMPLE, help="with --log packets, log one in this many forwarded packets")
+    parser.add_argument("--metrics", default=METRICS_ADDRESS, help="serve Prometheus metrics on host:port or a Unix socket path")
+    parser.add_argument("--health-check", type=float, default=HEALTH_CHECK_INTERVAL, metavar="SECONDS", help="probe pooled backends this often and eject the ones that are down")
+    parser.add_argument("--snapshot", default=SNAPSHOT_PATH, metavar="PATH", help="save the NAT table to this file and restore it on startup")
+    parser.add_argument("--replicate-to", default=REPLICATION_PEER, metavar="ADDRESS", help="send NAT table changes to a standby forwarder at host:port or a Unix socket path")
+    parser.add_argument("--standby", default=STANDBY_ADDRESS, metavar="ADDRESS", help="mirror an active forwarder's NAT table from host:port or a Unix socket path and take over when it stops")
+    parser.add_argument("--profile-to", default=PROFILE_PATH, metavar="PATH", help="write the stacks of each SIGUSR2 profile to this file, for flamegraph.pl or speedscope")
+    args = parser.parse_args()
 
+    # Rules are compiled into a RuleTable keyed by endpoint_key(src_ip, port); see forwarder/rules.py
+    forward_rules = rules.load_rules(args.rules)
+
+    tcp.TcpHeader.verify_checksums = VERIFY_CHECKSUMS
+
+    batch_headers = BATCH_HEADERS and batch.AVAILABLE
+    if BATCH_HEADERS and not batch.AVAILABLE:
+        print("NumPy isn't installed; parsing packets one at a time")
+
+    if args.workers > 1:
+        # Each worker has its own packet socket and its own shard of the NAT state; see forwarder/fanout.py
+        config = fanout.WorkerConfig(port_range=NAT_PORT_RANGE, timeouts=CONNTRACK_TIMEOUTS, batch_size=BATCH_SIZE, buffer_size=RECV_BUFFER_SIZE,
+                                     use_mmsg=USE_MMSG, expiry_interval=EXPIRY_INTERVAL, send_mark=args.mark, flow_cache_size=FLOW_CACHE_SIZE,
+                                     rules_path=args.rules, reload_interval=RELOAD_INTERVAL, prefilter=PREFILTER,
+                                     log_level=packetlog.LEVELS[args.log], log_sample=args.log_sample, metrics_address=args.metrics, batch_headers=batch_headers,
+                                     health_check_interval=args.health_check, health_check_timeout=HEALTH_CHECK_TIMEOUT, health_fall=HEALTH_FALL, health_rise=HEALTH_RISE,
+                                     nat_max_entries=NAT_MAX_ENTRIES, nat_max_per_source=NAT_MAX_PER_SOURCE, syn_rate=SYN_RATE, syn_burst=SYN_BURST,
+                                     snapshot_path=args.snapshot, snapshot_interval=SNAPSHOT_INTERVAL,
+                                     replicate_to=args.replicate_to, standby_address=args.standby, replication_interval=REPLICATION_INTERVAL,
+                                     heartbeat_interval=HEARTBEAT_INTERVAL, failover_timeout=FAILOVER_TIMEOUT,
+                                     profile_stages=PROFILE_STAGES, profile_path=args.profile_to, profile_seconds=PROFILE_SECONDS, profile_interval=PROFILE_INTERVAL)
+        sys.exit(fanout.run_workers(args.workers, forward_rules, config, FANOUT_GROUP_ID, args.interface))
+
+    # The SNAT and DNAT tables (see forwarder/nat.py) are keyed by packed integers rather
+    # than "ip:port" strings, so nothing has to be formatted per packet.
+    nat_table = nat.NatTable(NAT_PORT_RANGE, max_entries=NAT_MAX_ENTRIES, max_per_source=NAT_MAX_PER_SOURCE)
+
+    # Removes NAT entries once their connections close or go idle
+    tracker = conntrack.ConnTracker(nat_table, monotonic(), CONNTRACK_TIMEOUTS)
+
+    # Connections open when the forwarder last stopped carry on (see forwarder/snapshot.py)
+    if args.snapshot:
+        snapshot.restore(args.snapshot, nat_table, tracker)
+
+    # A standby mirrors the active forwarder's NAT table and only goes on once it has stopped
+    if args.standby:
+        try:
+            replication.Standby(nat_table, tracker, args.standby, FAILOVER_TIMEOUT).run()
         except KeyboardInterrupt:
             print("\nExiting")
             sys.exit(0)
+
+    checkpointer = None
+    if args.snapshot:
+        checkpointer = snapshot.Checkpointer(args.snapshot, nat_table, SNAPSHOT_INTERVAL)
+        checkpointer.start()
+
+    # Changes to the NAT table are sent to the standby on a separate thread
+    replicator = None
+    if args.replicate_to:
+        replicator = replication.Replicator(nat_table, args.replicate_to, REPLICATION_INTERVAL, HEARTBEAT_INTERVAL)
+        replicator.start()
+
+    # Segments of established flows are rewritten straight from the cache (see forwarder/flowcache.py)
+    flow_cache = flowcache.FlowCache(nat_table, FLOW_CACHE_SIZE) if FLOW_CACHE_SIZE else None
+
+    # Packets are received and sent in batches through the chosen backend (see forwarder/backends.py)
+    backend = backends.open_backend(args.backend, BATCH_SIZE, RECV_BUFFER_SIZE, USE_MMSG, args.mark, args.interface)
+    if PREFILTER:
+        backend.attach_prefilter(forward_rules)
+
+    # The rules file is polled and compiled on a separate thread (see forwarder/reload.py)
+    watcher = None
+    if RELOAD_INTERVAL:
+        watcher = reload.RuleWatcher(args.rules, RELOAD_INTERVAL)
+        watcher.start()
+
+    on_rules_changed = backend.attach_prefilter if PREFILTER else None
+
+    packet_log = packetlog.PacketLog(packetlog.LEVELS[args.log], args.log_sample)
+    packet_log.start()
+
+    # Cached flows can be forwarded a batch at a time (see packet/batch.py)
+    packet_batch = batch.PacketBatch(BATCH_SIZE, RECV_BUFFER_SIZE) if batch_headers else None
+
+    # New connections are rate limited per client before they get a NAT entry
+    syn_limiter = admission.SynLimiter(SYN_RATE, SYN_BURST) if SYN_RATE else None
+
+    # SIGUSR1 toggles the per-stage timings and SIGUSR2 captures a profile (see forwarder/profiling.py)
+    timer = profiling.StageTimer()
+    profiling.install_signals(timer, profiling.SamplingProfiler(PROFILE_INTERVAL, PROFILE_SECONDS, args.profile_to))
+    if PROFILE_STAGES:
+        timer.enable()
+
+    forwarding_engine = engine.Engine(forward_rules, nat_table, tracker, flow_cache, packet_log, packet_batch=packet_batch, syn_limiter=syn_limiter, timer=timer)
+
+    # Pooled backends are probed on a separate thread too; the engine only reads their flags
+    health_checker = None
+    if args.health_check:
+        health_checker = health.HealthChecker(lambda: [forwarding_engine.forward_rules] + list(forwarding_engine.draining),
+                                              args.health_check, HEALTH_CHECK_TIMEOUT, HEALTH_FALL, HEALTH_RISE, args.mark)
+        health_checker.start()
+
+    # Scrapes are answered on a separate thread from the engine's counters (see forwarder/metrics.py)
+    if args.metrics:
+        metrics.start_server(args.metrics, lambda: metrics.render(forwarding_engine, backend.receiver, backend.sender, watcher, packet_log, health_checker, checkpointer, replicator))
+
+    try:
+        forwarding_engine.run(backend.receiver, backend.sender, EXPIRY_INTERVAL, watcher, on_rules_changed)
+    except KeyboardInterrupt:
+        packet_log.stop()
+        if checkpointer is not None:
+            checkpointer.stop()
+        if replicator is not None:
+            replicator.stop()
+        print("\nExiting")
+        classifier = forwarding_engine.classifier
+        print("Rejected " + str(classifier.rejected) + " packets: " + str(classifier.not_tcp) + " not TCP, " + str(classifier.fragments) + " fragments, " +
+              str(classifier.short) + " truncated, " + str(classifier.unmatched) + " unrelated")
+        if flow_cache is not None:
+            print("Flow cache: " + str(flow_cache.hits) + " hits, " + str(flow_cache.misses) + " misses, " + str(flow_cache.evictions) + " evictions")
+        if timer.enabled:
+            print(timer.report())
+        sys.exit(0)
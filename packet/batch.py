@@ -0,0 +1,417 @@
+###################################################################################################
+#Name:	batch.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Header parsing and checksumming for a whole batch of packets at once, with NumPy. The batch
+#       is copied into one contiguous block (one row per packet), the IP and TCP fixed headers are
+#       decoded for every row into structured arrays, and checksums are summed and folded as arrays
+#       of 16-bit words instead of one packet at a time. Rewrites are done in place in the rows, so
+#       the forwarded segments are views of the batch rather than new copies.
+#
+#       NumPy is optional: if it isn't installed, AVAILABLE is False and the forwarder uses the
+#       per-packet path (ip.IpHeader, tcp.TcpHeader and checksum.py) for everything.
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+AVAILABLE = numpy is not None
+
+# Smaller batches are cheaper to handle one packet at a time than to set up the array operations for
+MIN_BATCH = 32
+
+TCP_HEADER_LEN = 20
+
+if AVAILABLE:
+    # The fixed IP header (RFC 791) and TCP header (RFC 793), in network order
+    IP_HEADER_DTYPE = numpy.dtype([('ver_ihl', 'u1'), ('tos', 'u1'), ('total_len', '>u2'), ('ident', '>u2'),
+                                   ('frag', '>u2'), ('ttl', 'u1'), ('proto', 'u1'), ('checksum', '>u2'),
+                                   ('src_ip', '>u4'), ('dst_ip', '>u4')])
+    TCP_HEADER_DTYPE = numpy.dtype([('src_port', '>u2'), ('dst_port', '>u2'), ('seq_num', '>u4'), ('ack_num', '>u4'),
+                                    ('off_flags', '>u2'), ('win_size', '>u2'), ('checksum', '>u2'), ('urg_ptr', '>u2')])
+    TCP_COLUMNS = numpy.arange(TCP_HEADER_LEN)
+    REWRITE_COLUMNS = numpy.array([0, 1, 2, 3, 16, 17]) # The ports and the checksum
+
+class PacketBatch:
+    __slots__ = ('capacity', 'size', 'data', 'views', 'count', 'lengths', 'header_len', 'ip', 'tcp', '_rows')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, capacity, size)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the batch
+#    capacity - the most packets a batch holds.
+#    size - the largest packet a batch holds.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function allocates the rows once; every load reuses them. Only call it if AVAILABLE.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, capacity, size):
+        self.capacity = capacity
+        self.size = size
+        # Rows are padded to an even width with room for one more byte, so every segment can be
+        # summed as whole 16-bit words (see tcp_checksums)
+        self.data = numpy.zeros((capacity, (size + 2) & ~1), numpy.uint8)
+        width = self.data.shape[1]
+        whole = memoryview(self.data.reshape(-1))
+        self.views = [whole[i * width:i * width + size] for i in range(capacity)]
+        self.count = 0
+        self.lengths = None
+        self.header_len = None
+        self.ip = None
+        self.tcp = None
+        self._rows = numpy.arange(capacity)[:, None]
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		load
+#
+#    Prototype:	def load(self, packets)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the batch
+#    packets - received IP packets (bytes-like objects), at most capacity of them, each at most
+#              size bytes and long enough for an IP and a TCP header.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function copies the packets into the rows and decodes their headers: ip is a structured
+#    array of the fixed IP headers, header_len the IP header lengths, tcp a structured array of the
+#    fixed TCP headers and lengths the packet lengths. ip is a view of the rows; tcp is gathered from
+#    each row's header_len, so it's a copy (see store_tcp).
+#    The lengths are taken from the IP headers, not from what was received, since frames read from
+#    a packet socket can carry link-layer padding after the packet. A packet shorter than its IP
+#    header says gets a length of 0, which tcp_segments rules out.
+#
+#    Revisions:
+#	2026-10-17 - Take the lengths from the IP headers.
+#
+#########################################################################################################
+    def load(self, packets):
+        views = self.views
+        lengths = []
+        for i, packet in enumerate(packets):
+            length = len(packet)
+            views[i][:length] = packet
+            lengths.append(length)
+
+        count = len(lengths)
+        rows = self.data[:count]
+        self.count = count
+        self.ip = rows[:, :20].view(IP_HEADER_DTYPE)[:, 0]
+        total_len = self.ip['total_len'].astype(numpy.intp)
+        self.lengths = numpy.where(total_len <= numpy.array(lengths, numpy.intp), total_len, 0)
+        self.header_len = (rows[:, 0] & 0x0F).astype(numpy.intp) << 2
+        self.tcp = rows[self._rows[:count], self.header_len[:, None] + TCP_COLUMNS].view(TCP_HEADER_DTYPE)[:, 0]
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		tcp_segments
+#
+#    Prototype:	def tcp_segments(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the batch
+#
+#    Return Values:
+#    A boolean array, True for the rows that hold an unfragmented TCP segment with a whole header.
+#
+#    Description:
+#    This function finds the rows whose tcp headers are real; the others were decoded from
+#    whatever was at their header_len. A first fragment (MF set, offset 0) has a real header but
+#    only part of the segment, so it's ruled out along with the later fragments.
+#
+#    Revisions:
+#	2026-10-17 - Rule out first fragments too.
+#
+#########################################################################################################
+    def tcp_segments(self):
+        ip = self.ip
+        return ((ip['proto'] == 6) & ((ip['frag'] & 0x3FFF) == 0) &
+                (self.lengths >= self.header_len + TCP_HEADER_LEN))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		store_tcp
+#
+#    Prototype:	def store_tcp(self, indexes)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the batch
+#    indexes - an integer array of the rows to store.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function writes the given rows' tcp headers (after they've been changed) back into the
+#    packets.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def store_tcp(self, indexes):
+        headers = self.tcp[indexes].view(numpy.uint8).reshape(-1, TCP_HEADER_LEN)
+        self.data[indexes[:, None], self.header_len[indexes][:, None] + TCP_COLUMNS] = headers
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		rewrite
+#
+#    Prototype:	def rewrite(self, indexes, src_ports, dst_ports, deltas)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the batch
+#    indexes - the rows to rewrite, as a list or an integer array.
+#    src_ports - the new source port for each of those rows.
+#    dst_ports - the new destination port for each of those rows.
+#    deltas - the checksum delta for each of those rows (see checksum.delta).
+#
+#    Return Values:
+#	
+#    Description:
+#    This function is engine.forward_flow for many packets at once: the ports are replaced and the
+#    checksums adjusted in place, in the rows.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def rewrite(self, indexes, src_ports, dst_ports, deltas):
+        indexes = numpy.array(indexes, numpy.intp)
+        tcp = self.tcp
+        checksums = apply_deltas(tcp['checksum'][indexes], numpy.array(deltas, numpy.uint32))
+        tcp['src_port'][indexes] = src_ports
+        tcp['dst_port'][indexes] = dst_ports
+        tcp['checksum'][indexes] = checksums
+
+        # Ports and checksum are scattered into the rows in one go
+        fields = numpy.empty((len(indexes), 3), '>u2')
+        fields[:, 0] = src_ports
+        fields[:, 1] = dst_ports
+        fields[:, 2] = checksums
+        rows = indexes[:, None]
+        self.data[rows, self.header_len[rows] + REWRITE_COLUMNS] = fields.view(numpy.uint8)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		replace_checksums
+#
+#    Prototype:	def replace_checksums(self, indexes, checksums)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the batch
+#    indexes - the rows to change, as a list or an integer array.
+#    checksums - the new TCP checksum for each of those rows.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function overwrites the TCP checksums of the given rows, in place.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def replace_checksums(self, indexes, checksums):
+        indexes = numpy.asarray(indexes, numpy.intp)
+        self.tcp['checksum'][indexes] = checksums
+        self.store_tcp(indexes)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		segments
+#
+#    Prototype:	def segments(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the batch
+#
+#    Return Values:
+#    A list of memoryviews of each row's TCP segment (valid until the next load).
+#
+#    Description:
+#    This function returns what to hand to the sender for each packet in the batch.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def segments(self):
+        views = self.views
+        return [views[i][header_len:length] for i, (header_len, length) in enumerate(zip(self.header_len.tolist(), self.lengths.tolist()))]
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		tcp_checksums
+#
+#    Prototype:	def tcp_checksums(self, src_ips = None, dst_ips = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the batch
+#    src_ips - the pseudo-header source IP for each row, or None for the IP header's.
+#    dst_ips - the pseudo-header destination IP for each row, or None for the IP header's.
+#
+#    Return Values:
+#    An array of the TCP checksum each row's segment should have, in network order.
+#
+#    Description:
+#    This function computes the full TCP checksums of the batch, as tcp.TcpHeader.calc_checksum
+#    does for one segment. Every row is viewed as big-endian 16-bit words; the words outside the
+#    segment (and the checksum field itself) are masked out, the rest are summed along each row
+#    along with the pseudo-header, and the sums are folded. A segment of odd length is padded with
+#    a zero byte, which is written into the row.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def tcp_checksums(self, src_ips = None, dst_ips = None):
+        count = self.count
+        header_len = self.header_len
+        lengths = self.lengths
+        rows = self.data[:count]
+        if not count:
+            return numpy.zeros(0, numpy.uint16)
+
+        odd = numpy.flatnonzero(lengths & 1)
+        rows[odd, lengths[odd]] = 0
+
+        words = rows[:, :(int(lengths.max()) + 1) & ~1].view('>u2')
+        columns = numpy.arange(words.shape[1])
+        first = header_len >> 1
+        in_segment = (columns >= first[:, None]) & (columns < ((lengths + 1) >> 1)[:, None])
+        in_segment[self._rows[:count, 0], first + (TCP_HEADER_LEN - 4) // 2] = False # The checksum field
+        total = numpy.where(in_segment, words, 0).sum(axis=1, dtype=numpy.uint64)
+
+        if src_ips is None:
+            src_ips = self.ip['src_ip']
+        if dst_ips is None:
+            dst_ips = self.ip['dst_ip']
+        src_ips = numpy.asarray(src_ips, numpy.uint64)
+        dst_ips = numpy.asarray(dst_ips, numpy.uint64)
+        total += (src_ips >> 16) + (src_ips & 0xFFFF) + (dst_ips >> 16) + (dst_ips & 0xFFFF)
+        total += 6 + (lengths - header_len).astype(numpy.uint64) # Protocol and TCP length
+
+        return ~fold(total).astype(numpy.uint16)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		fold
+#
+#    Prototype:	def fold(totals)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    totals - an unsigned integer array of sums of 16-bit words.
+#
+#    Return Values:
+#    The sums folded into 16 bits, as an array of the same type.
+#
+#    Description:
+#    This function is checksum.fold for an array. Sums of fewer than 2^32 words fold in three
+#    rounds at most, so the loop only runs while some element still has carries.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def fold(totals):
+    while (totals >> 16).any():
+        totals = (totals & 0xFFFF) + (totals >> 16)
+    return totals
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		apply_deltas
+#
+#    Prototype:	def apply_deltas(checksums, deltas)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    checksums - an array of checksums, as read from the packets.
+#    deltas - an array of deltas from checksum.delta, one per checksum.
+#
+#    Return Values:
+#    The adjusted checksums, as a uint16 array.
+#
+#    Description:
+#    This function is checksum.apply_delta for arrays. Both inputs are 16-bit, so it folds a fixed
+#    two rounds rather than checking for carries.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def apply_deltas(checksums, deltas):
+    totals = (~numpy.asarray(checksums, numpy.uint32) & 0xFFFF) + deltas
+    totals = (totals & 0xFFFF) + (totals >> 16) # At most 0x1FFFE before this, so two rounds are enough
+    totals = (totals & 0xFFFF) + (totals >> 16)
+    return ~totals.astype(numpy.uint16)
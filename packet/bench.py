@@ -0,0 +1,774 @@
+###################################################################################################
+#Name:	bench.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Microbenchmarks for the per-packet primitives in ip.py and tcp.py: parsing the IP and TCP
+#       headers, word_sum, calc_checksum and to_bytes. Each one is run over a small corpus of
+#       representative segments (a bare ACK, a full MSS of data, a SYN with the usual options and an
+#       odd-length payload) and timed in ns/op; the results can be saved as a baseline and later
+#       runs compared against it. The entry point is bench.py in the top-level directory.
+#
+#       A benchmark's time is the best of many short runs of a tight loop, which is the least noisy
+#       figure on a shared machine. Even so, a busy neighbour or a throttled CPU can slow everything
+#       down by half or more for seconds at a time, which is what made a fixed threshold on the
+#       times flaky. So:
+#         - each benchmark is scored against a reference loop that doesn't use the packet library,
+#           timed just before and after it, so a slowdown of the whole machine cancels out;
+#         - every benchmark is measured in several rounds, each a pass over all of them, and its
+#           noise is how far its median round's score is behind its best;
+#         - a baseline keeps the scores of the last few runs saved on this machine, and their
+#           spread is the run-to-run noise;
+#         - a run fails on a slowdown past the threshold, widened for the baseline's noise (never
+#           the run's own, which a regression could inflate) up to twice the threshold at most
+#           (see allowance), that's still there when the benchmark is measured again. A baseline
+#           too noisy to gate on within that is reported when it's saved.
+#       Scores only mean anything next to a baseline taken on the same machine and Python, so
+#       baselines are local files and aren't compared across hosts.
+#
+#       CPython has no count of allocations, and frees temporaries as soon as they're dropped, so
+#       allocs/op is the number of memory blocks each call leaves behind (sys.getallocatedblocks
+#       with the results kept): the header objects, the integers that don't fit the small-int cache,
+#       the rewritten segment and so on.
+#
+#    Revisions:
+#    2026-10-17 - Score against a reference loop and gate on the run-to-run noise; baselines are
+#                 per host.
+#
+###################################################################################################
+import gc
+import json
+import platform
+import random
+import struct
+import sys
+from time import perf_counter_ns
+from packet import ip, tcp
+
+IP_HEADER = struct.Struct('!BBHHHBBHII')
+TCP_HEADER = struct.Struct('!HHIIHHHH')
+
+# The addresses and ports of every segment in the corpus (10.0.0.1:40000 -> 192.168.100.1:80)
+SRC_IP = 0x0A000001
+DST_IP = 0xC0A86401
+SRC_PORT = 40000
+DST_PORT = 80
+
+# MSS, SACK permitted, timestamps and window scale, as a Linux SYN carries them
+SYN_OPTIONS = bytes([2, 4, 0x05, 0xB4, 4, 2, 8, 10, 0, 0, 0x12, 0x34, 0, 0, 0, 0, 1, 3, 3, 7])
+
+# Each round times a benchmark over DEFAULT_REPEAT runs of enough calls to take DEFAULT_RUN_TIME
+# seconds, and its allocations are counted over ALLOC_CALLS calls
+DEFAULT_RUN_TIME = 0.005
+DEFAULT_REPEAT = 10
+ALLOC_CALLS = 1000
+
+# The reference loop is timed over REFERENCE_REPEAT runs before and after each benchmark, in
+# every one of DEFAULT_ROUNDS rounds
+REFERENCE_REPEAT = 3
+DEFAULT_ROUNDS = 5
+
+# A baseline keeps the scores of the last HISTORY runs saved on its machine
+HISTORY = 5
+
+# A run fails if a benchmark's score is worse than its baseline by more than the threshold or, if
+# it's more, NOISE_FACTOR times the baseline's noise, but never more than ALLOWANCE_CAP times the
+# threshold; or it leaves more than ALLOC_TOLERANCE more blocks per call behind; and it still does
+# when it's measured again up to RECHECKS more times
+DEFAULT_THRESHOLD = 0.25
+NOISE_FACTOR = 1.5
+ALLOWANCE_CAP = 2
+ALLOC_TOLERANCE = 0.5
+RECHECKS = 2
+
+class Sample:
+    __slots__ = ('packet', 'segment', 'payload', 'ip_header', 'tcp_header')
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		__init__
+#
+#    Prototype:	def __init__(self, packet)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the sample
+#    packet - an IPv4 TCP packet.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function splits a packet up the way the engine does: a memoryview of the whole packet,
+#    of the TCP segment and of the payload, and the parsed headers.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+    def __init__(self, packet):
+        self.packet = memoryview(packet)
+        self.ip_header = ip.IpHeader(self.packet)
+        self.segment = self.packet[self.ip_header.header_len:]
+        self.tcp_header = tcp.TcpHeader(self.segment)
+        self.payload = self.segment[self.tcp_header.data_off:]
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		build_segment
+#
+#    Prototype:	def build_segment(flags, options, payload)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    flags - the TCP flags.
+#    options - the TCP options, a multiple of 4 bytes long.
+#    payload - the payload.
+#
+#    Return Values:
+#    An IPv4 TCP packet from SRC_IP:SRC_PORT to DST_IP:DST_PORT.
+#
+#    Description:
+#    This function builds a packet for the corpus, with a correct TCP checksum so the incremental
+#    path in to_bytes starts from a real one.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def build_segment(flags, options, payload):
+    data_off = tcp.TcpHeader.NO_OPT_SIZE + len(options)
+    segment = bytearray(TCP_HEADER.pack(SRC_PORT, DST_PORT, 0x12345678, 0x9ABCDEF0, (data_off << 10) | flags, 64240, 0, 0))
+    segment += options
+    segment += payload
+
+    header = tcp.TcpHeader(segment)
+    checksum = header.calc_checksum(SRC_IP, DST_IP, payload)
+    struct.pack_into('=H', segment, tcp.CHECKSUM_OFFSET, checksum)
+
+    total_len = ip.IpHeader.NO_OPT_SIZE + len(segment)
+    return IP_HEADER.pack(0x45, 0, total_len, 1, 0x4000, 64, 6, 0, SRC_IP, DST_IP) + bytes(segment)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		corpus
+#
+#    Prototype:	def corpus(seed = 0)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    seed - the random seed for the payload bytes.
+#
+#    Return Values:
+#    A list of (name, Sample) pairs.
+#
+#    Description:
+#    This function builds the segments every primitive is benchmarked on. The payloads are random
+#    but fixed by the seed, so every run works on the same bytes.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def corpus(seed = 0):
+    rng = random.Random(seed)
+    flags = tcp.TcpHeader.Flags
+    return [
+        ("bare_ack", Sample(build_segment(flags.ACK, b'', b''))),
+        ("mss", Sample(build_segment(flags.ACK | flags.PSH, b'', rng.randbytes(1460)))),
+        ("syn_options", Sample(build_segment(flags.SYN, SYN_OPTIONS, b''))),
+        ("odd_payload", Sample(build_segment(flags.ACK | flags.PSH, b'', rng.randbytes(37)))),
+    ]
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		benchmarks
+#
+#    Prototype:	def benchmarks(samples)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    samples - the (name, Sample) pairs from corpus.
+#
+#    Return Values:
+#    A list of (name, function, args) for every primitive on every sample.
+#
+#    Description:
+#    This function lists the benchmarks, named "<primitive>/<sample>". Each call is made the way the
+#    engine makes it: the headers are parsed from memoryviews, and to_bytes is given the original
+#    addresses so it takes the incremental checksum path, as it does for every forwarded segment.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def benchmarks(samples):
+    listed = []
+    for name, sample in samples:
+        header = sample.tcp_header
+        listed += [
+            ("ip_header/" + name, ip.IpHeader, (sample.packet,)),
+            ("tcp_header/" + name, tcp.TcpHeader, (sample.segment,)),
+            ("word_sum/" + name, tcp.TcpHeader.word_sum, (sample.payload, 'little')),
+            ("calc_checksum/" + name, header.calc_checksum, (SRC_IP, DST_IP, sample.payload)),
+            ("to_bytes/" + name, header.to_bytes, (SRC_IP, DST_IP, sample.payload, SRC_IP, DST_IP)),
+        ]
+    return listed
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		reference
+#
+#    Prototype:	def reference(data)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    data - at least a TCP header's worth of bytes.
+#
+#    Return Values:
+#    The 16-bit ones' complement sum of the fields, folded.
+#
+#    Description:
+#    This function is the yardstick the benchmarks are scored against: the same kind of work as
+#    the primitives (a struct unpack, a loop over the fields and some integer arithmetic) done
+#    without the packet library, so it runs just as fast whatever the library's code does, and only
+#    as fast as the machine happens to be at the time.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def reference(data):
+    total = 0
+    for field in TCP_HEADER.unpack_from(data, 0):
+        total += (field >> 16) + (field & 0xFFFF)
+    return (total & 0xFFFF) + (total >> 16)
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		calls_per_run
+#
+#    Prototype:	def calls_per_run(function, args, run_time = DEFAULT_RUN_TIME)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    function - the function to time.
+#    args - its arguments.
+#    run_time - how long a timed run should take, in seconds.
+#
+#    Return Values:
+#    The number of calls that take at least run_time.
+#
+#    Description:
+#    This function sizes a benchmark's runs, doubling the calls until they take long enough to
+#    time (as timeit's autorange does). A header parse and a checksum over an MSS differ by three
+#    orders of magnitude, so a fixed count would be either too short for one or far too long for
+#    the other.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def calls_per_run(function, args, run_time = DEFAULT_RUN_TIME):
+    number = 1
+    while True:
+        started = perf_counter_ns()
+        for i in range(number):
+            function(*args)
+        if perf_counter_ns() - started >= run_time * 1e9:
+            return number
+        number *= 2
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		time_per_op
+#
+#    Prototype:	def time_per_op(function, args, number, repeat)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    function - the function to time.
+#    args - its arguments.
+#    number - calls per run.
+#    repeat - runs.
+#
+#    Return Values:
+#    The best run's time per call, in nanoseconds.
+#
+#    Description:
+#    This function times a benchmark. The garbage collector is off while it runs, as timeit does,
+#    so a collection triggered by something else isn't charged to it.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def time_per_op(function, args, number, repeat):
+    loops = range(number)
+    best = None
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for run in range(repeat):
+            started = perf_counter_ns()
+            for i in loops:
+                function(*args)
+            elapsed = perf_counter_ns() - started
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        if enabled:
+            gc.enable()
+    return best / number
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		allocs_per_op
+#
+#    Prototype:	def allocs_per_op(function, args, number)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    function - the function to measure.
+#    args - its arguments.
+#    number - calls to average over.
+#
+#    Return Values:
+#    The memory blocks each call leaves allocated.
+#
+#    Description:
+#    This function counts what a benchmark allocates and keeps. The results are stored in a list
+#    made beforehand, so they (and whatever they hold) stay alive until the count is taken.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def allocs_per_op(function, args, number):
+    results = [None] * number
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        before = sys.getallocatedblocks()
+        for i in range(number):
+            results[i] = function(*args)
+        after = sys.getallocatedblocks()
+    finally:
+        if enabled:
+            gc.enable()
+    return (after - before) / number
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		run
+#
+#    Prototype:	def run(selected = None, rounds = DEFAULT_ROUNDS, run_time = DEFAULT_RUN_TIME, repeat = DEFAULT_REPEAT, seed = 0)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    selected - only run benchmarks whose names contain one of these strings, or None for all.
+#    rounds - times each benchmark is timed, one pass over all of them per round.
+#    run_time - how long each timed run should take, in seconds.
+#    repeat - timed runs per benchmark per round.
+#    seed - the random seed for the corpus.
+#
+#    Return Values:
+#    A dict mapping each benchmark's name to {"ns": ns/op, "score": score, "noise": noise,
+#    "allocs": allocs/op}, in run order.
+#
+#    Description:
+#    This function runs the benchmarks. In every round, each benchmark's time per call is divided
+#    by the reference loop's, timed right before and after it (the faster of the two), to give that
+#    round's score. A benchmark's ns/op and score are its best round's; its noise is how much worse
+#    its median round's score was, as a fraction of the best.
+#
+#    Revisions:
+#	2026-10-17 - Time the benchmarks in rounds, scored against the reference loop.
+#
+#########################################################################################################
+def run(selected = None, rounds = DEFAULT_ROUNDS, run_time = DEFAULT_RUN_TIME, repeat = DEFAULT_REPEAT, seed = 0):
+    chosen = [(name, function, args) for name, function, args in benchmarks(corpus(seed))
+              if selected is None or any(s in name for s in selected)]
+    numbers = [calls_per_run(function, args, run_time) for name, function, args in chosen] # Also warms them up
+    reference_args = (bytes(range(TCP_HEADER.size)),)
+    reference_number = calls_per_run(reference, reference_args, run_time)
+
+    times = [[] for benchmark in chosen]
+    scores = [[] for benchmark in chosen]
+    for i in range(rounds):
+        for (name, function, args), number, benchmark_times, benchmark_scores in zip(chosen, numbers, times, scores):
+            before = time_per_op(reference, reference_args, reference_number, REFERENCE_REPEAT)
+            elapsed = time_per_op(function, args, number, repeat)
+            after = time_per_op(reference, reference_args, reference_number, REFERENCE_REPEAT)
+            benchmark_times.append(elapsed)
+            benchmark_scores.append(elapsed / min(before, after))
+
+    results = {}
+    for (name, function, args), benchmark_times, benchmark_scores in zip(chosen, times, scores):
+        benchmark_scores.sort()
+        best = benchmark_scores[0]
+        results[name] = {"ns": round(min(benchmark_times), 1), "score": round(best, 4),
+                         "noise": round(benchmark_scores[len(benchmark_scores) // 2] / best - 1, 3),
+                         "allocs": round(allocs_per_op(function, args, ALLOC_CALLS), 2)}
+    return results
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		environment
+#
+#    Prototype:	def environment()
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#
+#    Return Values:
+#    A string naming the Python and machine the benchmarks ran on.
+#
+#    Description:
+#    This function describes where a baseline was taken. Times from another machine or Python
+#    aren't comparable, so bench.py won't compare against a baseline taken elsewhere.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def environment():
+    return platform.python_implementation() + " " + platform.python_version() + " on " + platform.machine() + " " + platform.node()
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		save_baseline
+#
+#    Prototype:	def save_baseline(path, results)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    path - the baseline file.
+#    results - what run returned.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function adds results to the baseline later runs are compared against. Each benchmark
+#    keeps the scores of its last HISTORY saved runs (the best of them is its baseline and their
+#    spread its noise), along with its latest ns/op, noise and allocs/op. Benchmarks that weren't run
+#    keep what they had. A baseline from another machine or Python, or an old one without scores,
+#    is started over.
+#
+#    Revisions:
+#	2026-10-17 - Keep a history of scores; start over on another machine.
+#
+#########################################################################################################
+def save_baseline(path, results):
+    try:
+        baseline = load_baseline(path)
+    except (FileNotFoundError, ValueError):
+        baseline = {}
+    benchmarks = baseline["benchmarks"] if baseline.get("environment") == environment() else {}
+
+    for name, result in results.items():
+        scores = benchmarks.get(name, {}).get("scores", [])
+        saved = dict(result)
+        del saved["score"]
+        saved["scores"] = (scores + [result["score"]])[-HISTORY:]
+        benchmarks[name] = saved
+
+    with open(path, "w") as f:
+        json.dump({"environment": environment(), "benchmarks": benchmarks}, f, indent=4, sort_keys=True)
+        f.write("\n")
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		load_baseline
+#
+#    Prototype:	def load_baseline(path)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    path - the baseline file.
+#
+#    Return Values:
+#    The baseline, {"environment": ..., "benchmarks": {name: {"scores": [...], "ns": ..., "noise": ...,
+#    "allocs": ...}}}.
+#
+#    Description:
+#    This function loads a baseline saved by save_baseline. Raises ValueError if the file isn't one,
+#    or was saved before benchmarks were scored.
+#
+#    Revisions:
+#	2026-10-17 - Check for the scores.
+#
+#########################################################################################################
+def load_baseline(path):
+    with open(path) as f:
+        baseline = json.load(f)
+    if not isinstance(baseline, dict) or not isinstance(baseline.get("benchmarks"), dict):
+        raise ValueError(path + " isn't a benchmark baseline")
+    if not all(base.get("scores") for base in baseline["benchmarks"].values()):
+        raise ValueError(path + " has no scores; save it again")
+    return baseline
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		baseline_noise
+#
+#    Prototype:	def baseline_noise(base)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    base - one benchmark's baseline.
+#
+#    Return Values:
+#    The benchmark's noise on this machine, as a fraction of its best saved score.
+#
+#    Description:
+#    This function works out how noisy a benchmark was when its baseline was saved: the spread
+#    between the saved runs' scores, or the noise between the latest run's rounds if that's more.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def baseline_noise(base):
+    scores = base["scores"]
+    return max(max(scores) / min(scores) - 1, base["noise"])
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		allowance
+#
+#    Prototype:	def allowance(base, threshold = DEFAULT_THRESHOLD)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    base - one benchmark's baseline.
+#    threshold - the least slowdown that counts, as a fraction of the baseline score.
+#
+#    Return Values:
+#    The slowdown allowed, as a fraction of the baseline score.
+#
+#    Description:
+#    This function works out how much worse than its baseline a benchmark's score can be before it
+#    counts as a regression: threshold, or NOISE_FACTOR times the baseline's noise if that's more,
+#    up to ALLOWANCE_CAP times threshold. Only the baseline's noise counts; a change that made the
+#    benchmark noisier as well as slower would otherwise loosen its own limit.
+#
+#    Revisions:
+#	2026-10-17 - Only allow for the baseline's noise, and cap the allowance.
+#
+#########################################################################################################
+def allowance(base, threshold = DEFAULT_THRESHOLD):
+    return min(ALLOWANCE_CAP * threshold, max(threshold, NOISE_FACTOR * baseline_noise(base)))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		too_noisy
+#
+#    Prototype:	def too_noisy(baseline, threshold = DEFAULT_THRESHOLD)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    baseline - what load_baseline returned.
+#    threshold - the least slowdown that counts, as a fraction of the baseline score.
+#
+#    Return Values:
+#    A list of messages, one for each benchmark whose baseline is too noisy to gate on.
+#
+#    Description:
+#    This function finds the benchmarks whose noise needs more room than the capped allowance
+#    gives, so comparing against them could fail on noise alone.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def too_noisy(baseline, threshold = DEFAULT_THRESHOLD):
+    noisy = []
+    for name, base in baseline["benchmarks"].items():
+        noise = baseline_noise(base)
+        if NOISE_FACTOR * noise > ALLOWANCE_CAP * threshold:
+            noisy.append(name + ": scores " + str(min(base["scores"])) + " to " + str(max(base["scores"])) +
+                         ", noise " + str(round(noise * 100)) + "%")
+    return noisy
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		change
+#
+#    Prototype:	def change(result, base)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    result - one benchmark's result from run.
+#    base - the same benchmark's baseline.
+#
+#    Return Values:
+#    How much worse the score is than the best saved one, as a fraction (negative if it's better).
+#
+#    Description:
+#    This function compares a benchmark's score with its baseline.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def change(result, base):
+    return result["score"] / min(base["scores"]) - 1
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		compare
+#
+#    Prototype:	def compare(results, baseline, threshold = DEFAULT_THRESHOLD)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    results - what run returned.
+#    baseline - what load_baseline returned.
+#    threshold - the least slowdown that counts, as a fraction of the baseline score.
+#
+#    Return Values:
+#    A list of messages, one for each benchmark that regressed.
+#
+#    Description:
+#    This function checks results against a baseline. A benchmark regresses if its score is worse
+#    by more than its allowance or it leaves more than ALLOC_TOLERANCE more blocks behind per call.
+#    Benchmarks without a baseline are skipped.
+#
+#    Revisions:
+#	2026-10-17 - Compare the scores and allow for the noise.
+#	2026-10-17 - Only allow for the baseline's noise.
+#
+#########################################################################################################
+def compare(results, baseline, threshold = DEFAULT_THRESHOLD):
+    regressions = []
+    for name, result in results.items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            continue
+        allowed = allowance(base, threshold)
+        if change(result, base) > allowed:
+            regressions.append(name + ": " + str(result["ns"]) + " ns/op, baseline " + str(base["ns"]) + " (+" +
+                               str(round(change(result, base) * 100)) + "% against the reference, allowed +" + str(round(allowed * 100)) + "%)")
+        if result["allocs"] > base["allocs"] + ALLOC_TOLERANCE:
+            regressions.append(name + ": " + str(result["allocs"]) + " allocs/op, baseline " + str(base["allocs"]))
+    return regressions
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		recheck
+#
+#    Prototype:	def recheck(results, baseline, threshold = DEFAULT_THRESHOLD, rounds = DEFAULT_ROUNDS, run_time = DEFAULT_RUN_TIME, repeat = DEFAULT_REPEAT, seed = 0)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    results - what run returned; updated with the reruns.
+#    baseline - what load_baseline returned.
+#    threshold - the least slowdown that counts, as a fraction of the baseline score.
+#    rounds - rounds per rerun.
+#    run_time - how long each timed run should take, in seconds.
+#    repeat - timed runs per benchmark per round.
+#    seed - the random seed for the corpus.
+#
+#    Return Values:
+#    What compare returns for the final results.
+#
+#    Description:
+#    This function runs the benchmarks that regressed up to RECHECKS more times, keeping the best
+#    score of each, and compares again. A real slowdown shows up every time; a noisy spell doesn't.
+#
+#    Revisions:
+#	2026-10-17 - Rerun in rounds and keep the best score and the noise.
+#	2026-10-17 - Keep the noise of the best rerun rather than the largest.
+#
+#########################################################################################################
+def recheck(results, baseline, threshold = DEFAULT_THRESHOLD, rounds = DEFAULT_ROUNDS, run_time = DEFAULT_RUN_TIME, repeat = DEFAULT_REPEAT, seed = 0):
+    regressions = compare(results, baseline, threshold)
+    for attempt in range(RECHECKS):
+        if not regressions:
+            break
+        regressed = [name for name in results if any(r.startswith(name + ":") for r in regressions)]
+        for name, result in run(regressed, rounds, run_time, repeat, seed).items():
+            if name in regressed:
+                previous = results[name]
+                if result["score"] < previous["score"]:
+                    previous["ns"] = result["ns"]
+                    previous["score"] = result["score"]
+                    previous["noise"] = result["noise"]
+                previous["allocs"] = result["allocs"]
+        regressions = compare(results, baseline, threshold)
+    return regressions
@@ -0,0 +1,132 @@
+###################################################################################################
+#Name:	checksum.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Ones-complement helpers for adjusting a TCP checksum when only the ports and the
+#       pseudo-header addresses change (RFC 1624). All values are integers in network order,
+#       i.e. exactly as they are read out of the packet with int.from_bytes(..., 'big').
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		fold
+#
+#    Prototype:	def fold(total)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    total - a non-negative sum of 16-bit words.
+#
+#    Return Values:
+#    The sum folded down to 16 bits with end-around carry.
+#
+#    Description:
+#    This function folds the carries of a word sum back into the low 16 bits.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def fold(total):
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return total
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		tuple_sum
+#
+#    Prototype:	def tuple_sum(src_ip, dst_ip, src_port, dst_port)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    src_ip - the pseudo-header source IP as an integer in network order.
+#    dst_ip - the pseudo-header destination IP as an integer in network order.
+#    src_port - the TCP source port.
+#    dst_port - the TCP destination port.
+#
+#    Return Values:
+#    The (unfolded) word sum of every checksummed field the forwarder rewrites.
+#
+#    Description:
+#    This function sums the words that change when a segment is forwarded.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def tuple_sum(src_ip, dst_ip, src_port, dst_port):
+    return (src_ip >> 16) + (src_ip & 0xFFFF) + (dst_ip >> 16) + (dst_ip & 0xFFFF) + src_port + dst_port
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		delta
+#
+#    Prototype:	def delta(old_sum, new_sum)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    old_sum - the word sum of the fields before rewriting (see tuple_sum).
+#    new_sum - the word sum of the same fields after rewriting.
+#
+#    Return Values:
+#    A 16-bit ones-complement delta (~m + m') that can be handed to apply_delta.
+#
+#    Description:
+#    This function computes the checksum adjustment for a rewrite. The delta only depends on the
+#    old and new field values, so it can be computed once per flow and reused for every segment.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def delta(old_sum, new_sum):
+    return fold((~fold(old_sum) & 0xFFFF) + fold(new_sum))
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		apply_delta
+#
+#    Prototype:	def apply_delta(checksum, delta)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    checksum - the checksum currently in the header, in network order.
+#    delta - the adjustment returned by delta().
+#
+#    Return Values:
+#    The updated checksum, in network order.
+#
+#    Description:
+#    This function applies equation 3 of RFC 1624: HC' = ~(~HC + ~m + m').
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def apply_delta(checksum, delta):
+    return ~fold((~checksum & 0xFFFF) + delta) & 0xFFFF
@@ -14,12 +14,20 @@
 ###################################################################################################
 
 import enum
+import struct
 from socket import inet_ntop
 from socket import AF_INET
 
 class IpHeader:
     NO_OPT_SIZE = 20 # The size of an IP header with no optional data
 
+    # Everything before the options, unpacked in one call
+    FIXED_FORMAT = struct.Struct('!BBHHHBBHII')
+
+    # Headers are created for every packet, so don't give each one a __dict__
+    __slots__ = ('version', 'header_len', 'service_type', 'total_len', 'id', 'flags', 'frag_off',
+                 'ttl', 'protocol', 'checksum', 'src_ip', 'dst_ip', '_buf', '_options')
+
     class Flags(enum.IntEnum):
         MF = 1, # More Fragments
         DF = 2, # Don't Fragment
@@ -45,37 +53,29 @@ class IpHeader:
 #    Description:
 #    This function unpacks contents into an IP header. If bytes are provided, unpacks then into an IP header; 
 #    otherwise, creates a new header with all fields set to None. 
+#    The buffer isn't copied: the fixed fields are unpacked with a single unpack_from and the options
+#    are only sliced out (as a view of the buffer) if they're asked for.
 #
 #    Revisions:
-#	(none)
+#	2026-10-17 - Unpack the fixed fields with one struct call and read the options lazily.
 #    
 #########################################################################################################
     def __init__(self, header_bytes = None):
         if not (header_bytes is None):
             # Unpack the byte-aligned fields of the IP header
-            self.service_type = header_bytes[1]
-            self.total_len    = int.from_bytes(header_bytes[2:4], 'big')
-            self.id           = int.from_bytes(header_bytes[4:6], 'big')
-            self.ttl          = header_bytes[8]
-            self.protocol     = header_bytes[9]
-            self.checksum     = int.from_bytes(header_bytes[10:12], 'big')
-            self.src_ip       = int.from_bytes(header_bytes[12:16], 'big')
-            self.dst_ip       = int.from_bytes(header_bytes[16:20], 'big')
+            (version_and_len, self.service_type, self.total_len, self.id, flags_and_fragoff,
+             self.ttl, self.protocol, self.checksum, self.src_ip, self.dst_ip) = IpHeader.FIXED_FORMAT.unpack_from(header_bytes)
 
             # Unpack the bit fields
-            version_and_len = header_bytes[0]
-            self.version    = (version_and_len & 0xF0) >> 4
+            self.version    = version_and_len >> 4
             self.header_len = (version_and_len & 0x0F) * 4 # header length is in 4-byte words
 
-            flags_and_fragoff = int.from_bytes(header_bytes[6:8], 'big')
-            self.flags = (flags_and_fragoff & 0xE000) >> 13
+            self.flags = flags_and_fragoff >> 13
             self.frag_off = flags_and_fragoff & 0x1FFF
 
-            # Check for options at the end of the header
-            if self.header_len != IpHeader.NO_OPT_SIZE:
-                self.options = header_bytes[IpHeader.NO_OPT_SIZE:self.header_len]
-            else:
-                self.options = None
+            # Options are sliced out of the buffer on first access
+            self._buf = header_bytes
+            self._options = None
         else:
             self.version      = None
             self.header_len   = None
@@ -89,7 +89,44 @@ class IpHeader:
             self.checksum     = None
             self.src_ip       = None
             self.dst_ip       = None
-            self.options      = None
+            self._buf         = None
+            self._options     = None
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		options
+#
+#    Prototype:	def options(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the ip header
+#
+#    Return Values:
+#    A view of the option bytes, or None if the header has no options.
+#
+#    Description:
+#    This property slices the options out of the received buffer the first time they're read.
+#    Assigning to it replaces them (e.g. for a header built from scratch).
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    @property
+    def options(self):
+        if self._options is None and self._buf is not None and self.header_len != IpHeader.NO_OPT_SIZE:
+            self._options = memoryview(self._buf)[IpHeader.NO_OPT_SIZE:self.header_len]
+        return self._options
+
+    @options.setter
+    def options(self, value):
+        self._buf = None
+        self._options = value
 
 #########################################################################################################
 # FUNCTION
@@ -9,16 +9,34 @@
 #       This is parses the tcp header and will also display the ip header out to the user.
 #
 #    Revisions:
-#    (none)
+#    2026-10-17 - Added patch_header for rewriting forwarded segments in place.
 #
 ###################################################################################################
 import enum
+import struct
 from socket import inet_ntop, htons
 from socket import AF_INET
+from packet import checksum as cksum
+
+# The ports (at offset 0) and the checksum (at offset 16), for patching a header in place
+PORTS = struct.Struct('!HH')
+CHECKSUM = struct.Struct('!H')
+CHECKSUM_OFFSET = 16
 
 class TcpHeader:
     NO_OPT_SIZE = 20 # The size of a TCP header with no optional data
 
+    # Everything before the options, unpacked in one call
+    FIXED_FORMAT = struct.Struct('!HHIIHHHH')
+
+    # Headers are created for every packet, so don't give each one a __dict__
+    __slots__ = ('src_port', 'dst_port', 'seq_num', 'ack_num', 'flags', 'data_off', 'win_size',
+                 'checksum', 'urg_ptr', '_buf', '_options', '_orig_src_port', '_orig_dst_port', '_orig_checksum')
+
+    # When set, to_bytes also recomputes the full checksum and reports any mismatch with the
+    # incrementally adjusted one. Only meant for debugging; it walks the whole payload again.
+    verify_checksums = False
+
     class Flags(enum.IntEnum):
         FIN = 1,
         SYN = 2,
@@ -46,31 +64,30 @@ class TcpHeader:
 #    Description:
 #    This function unpacks contents into an tcp header. If bytes are provided, unpacks then into an IP header; 
 #    otherwise, creates a new header with all fields set to None. 
+#    The buffer isn't copied: pass a memoryview of the received packet and the fixed fields are
+#    unpacked with a single unpack_from, while the options are only sliced out if they're asked for.
 #
 #    Revisions:
-#	(none)
+#	2026-10-17 - Unpack the fixed fields with one struct call and read the options lazily.
 #    
 #########################################################################################################
     def __init__(self, header_bytes = None):
         if not (header_bytes is None):
             # Unpack the buffer into a TCP header
-            self.src_port = int.from_bytes(header_bytes[0:2], 'big')
-            self.dst_port = int.from_bytes(header_bytes[2:4], 'big')
-            self.seq_num  = int.from_bytes(header_bytes[4:8], 'big')
-            self.ack_num  = int.from_bytes(header_bytes[8:12], 'big')
-            self.win_size = int.from_bytes(header_bytes[14:16], 'big')
-            self.checksum = int.from_bytes(header_bytes[16:18], 'big')
-            self.urg_ptr  = int.from_bytes(header_bytes[18:20], 'big')
+            (self.src_port, self.dst_port, self.seq_num, self.ack_num, data_off_and_flags,
+             self.win_size, self.checksum, self.urg_ptr) = TcpHeader.FIXED_FORMAT.unpack_from(header_bytes)
 
-            data_off_and_flags = int.from_bytes(header_bytes[12:14], 'big')
             self.data_off = (data_off_and_flags & 0xF000) >> 10 # The data offset is in 4-byte words, so only shift 10 (i.e. multiply by 4)
             self.flags = (data_off_and_flags & 0x003F)
 
-            # Check for options at the end of the header
-            if self.data_off != TcpHeader.NO_OPT_SIZE:
-                self.options = header_bytes[TcpHeader.NO_OPT_SIZE:self.data_off]
-            else:
-                self.options = None
+            # Options are sliced out of the buffer on first access
+            self._buf = header_bytes
+            self._options = None
+
+            # Remember what was on the wire so to_bytes can adjust the checksum incrementally
+            self._orig_src_port = self.src_port
+            self._orig_dst_port = self.dst_port
+            self._orig_checksum = self.checksum
 
         else:
             self.src_port = None
@@ -82,7 +99,75 @@ class TcpHeader:
             self.win_size = None
             self.checksum = None
             self.urg_ptr = None
-            self.options = None
+            self._buf = None
+            self._options = None
+            self._orig_src_port = None
+            self._orig_dst_port = None
+            self._orig_checksum = None
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		options
+#
+#    Prototype:	def options(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the tcp header
+#
+#    Return Values:
+#    A view of the option bytes, or None if the header has no options.
+#
+#    Description:
+#    This property slices the options out of the received buffer the first time they're read.
+#    Assigning to it replaces them (e.g. for a header built from scratch).
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    @property
+    def options(self):
+        if self._options is None and self._buf is not None and self.data_off != TcpHeader.NO_OPT_SIZE:
+            self._options = memoryview(self._buf)[TcpHeader.NO_OPT_SIZE:self.data_off]
+        return self._options
+
+    @options.setter
+    def options(self, value):
+        self._buf = None
+        self._options = value
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		orig_fields
+#
+#    Prototype:	def orig_fields(self)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the tcp header
+#
+#    Return Values:
+#    (src_port, dst_port, checksum) as received, or None for a header that wasn't parsed.
+#
+#    Description:
+#    This property returns the fields to_bytes needs to adjust the checksum incrementally.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    @property
+    def orig_fields(self):
+        if self._orig_checksum is None:
+            return None
+        return (self._orig_src_port, self._orig_dst_port, self._orig_checksum)
 #########################################################################################################
 # FUNCTION
 #
@@ -252,9 +337,57 @@ class TcpHeader:
 #########################################################################################################
 # FUNCTION
 #
+#   Name:		update_checksum
+#
+#    Prototype:	def update_checksum(self, src_ip, dst_ip, data, orig_src_ip = None, orig_dst_ip = None)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    self  - the header
+#    src_ip - the source IP address as an integer in host byte order.
+#    dst_ip - the destination IP address as an integer in host byte order.
+#    data - the data that will be included in the packet. Only read for a full calculation, so
+#           None will do if the checksum is adjusted and not verified.
+#    orig_src_ip - the pseudo-header source IP the header was received with, if it was parsed.
+#    orig_dst_ip - the pseudo-header destination IP the header was received with, if it was parsed.
+#
+#    Return Values:
+#    The new checksum.
+#
+#    Description:
+#    This function sets checksum for the header's current ports and the given addresses, the way
+#    to_bytes describes, without building the header. Use it to patch a received segment in place.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+    def update_checksum(self, src_ip, dst_ip, data, orig_src_ip = None, orig_dst_ip = None):
+        if self.orig_fields is not None and orig_src_ip is not None and orig_dst_ip is not None:
+            orig_src_port, orig_dst_port, orig_checksum = self.orig_fields
+            old_sum = cksum.tuple_sum(orig_src_ip, orig_dst_ip, orig_src_port, orig_dst_port)
+            new_sum = cksum.tuple_sum(src_ip, dst_ip, self.src_port, self.dst_port)
+            self.checksum = cksum.apply_delta(orig_checksum, cksum.delta(old_sum, new_sum))
+
+            if TcpHeader.verify_checksums:
+                full_checksum = self.calc_checksum(src_ip, dst_ip, data)
+                if full_checksum != self.checksum:
+                    print("Checksum mismatch: incremental " + str(self.checksum) + ", full " + str(full_checksum))
+                    self.checksum = full_checksum
+        else:
+            self.checksum = self.calc_checksum(src_ip, dst_ip, data)
+
+        return self.checksum
+
+#########################################################################################################
+# FUNCTION
+#
 #   Name:		to_bytes
 #
-#    Prototype:	def to_bytes(self, src_ip, dst_ip, data)
+#    Prototype:	def to_bytes(self, src_ip, dst_ip, data, orig_src_ip = None, orig_dst_ip = None)
 #
 #    Developer:	Mat Siwoski/Shane Spoor
 #
@@ -265,6 +398,8 @@ class TcpHeader:
 #    src_ip - the source IP address as an integer in host byte order.
 #    dst_ip - the destination IP address as an integer in host byte order.
 #    data - the data that will be included in the packet.
+#    orig_src_ip - the pseudo-header source IP the header was received with, if it was parsed.
+#    orig_dst_ip - the pseudo-header destination IP the header was received with, if it was parsed.
 #
 #    Return Values:
 #	
@@ -273,15 +408,19 @@ class TcpHeader:
 #    All other members of the header must be set before calling this function. Note that the IP 
 #    addresses and the data won't actually be included in a header anywhere; they're used for creating 
 #    the TCP "pseudo-header" included in the checksum calculation. 
-#    Note also that (like basically everything else in this program) this is not very efficient since 
-#    we could adjust the checksum based on the previous values instead of calculating the whole thing again.
+#    If the header was parsed from a packet and the original pseudo-header addresses are given, the
+#    checksum is adjusted for the changed ports and addresses (RFC 1624) instead of being recomputed
+#    over the whole segment, so the cost no longer depends on the payload size. Only the ports may
+#    have changed since parsing for this to be valid.
 #
 #    Revisions:
-#	(none)
+#	2026-10-17 - Adjust the received checksum incrementally when the original addresses are known;
+#	             the full calculation is kept for new headers and for verify_checksums.
+#	2026-10-17 - Moved the checksum into update_checksum.
 #    
 ######################################################################################################### 
-    def to_bytes(self, src_ip, dst_ip, data):
-        self.checksum = self.calc_checksum(src_ip, dst_ip, data)
+    def to_bytes(self, src_ip, dst_ip, data, orig_src_ip = None, orig_dst_ip = None):
+        self.update_checksum(src_ip, dst_ip, data, orig_src_ip, orig_dst_ip)
 
         data_off_and_flags = (self.data_off << 10) + self.flags
         
@@ -300,3 +439,35 @@ class TcpHeader:
             result.extend(self.options)
         
         return result
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		patch_header
+#
+#    Prototype:	def patch_header(buffer, offset, src_port, dst_port, checksum)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    buffer - a writable buffer holding a TCP segment.
+#    offset - where the segment starts in buffer.
+#    src_port - the new source port.
+#    dst_port - the new destination port.
+#    checksum - the new checksum.
+#
+#    Return Values:
+#	
+#    Description:
+#    This function overwrites the ports and the checksum of a segment in place. These are the only
+#    fields forwarding changes, so the rest of the header is left as it was received.
+#
+#    Revisions:
+#	(none)
+#    
+#########################################################################################################
+def patch_header(buffer, offset, src_port, dst_port, checksum):
+    PORTS.pack_into(buffer, offset, src_port, dst_port)
+    CHECKSUM.pack_into(buffer, offset + CHECKSUM_OFFSET, checksum)
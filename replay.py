@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+###################################################################################################
+#Name:	replay.py
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Measures the forwarding engine offline: replays a pcap file, or a synthetic mix of flows,
+#       through the same Engine main.py runs and reports packets/s, bytes/s and batch latency
+#       percentiles. No root, sockets or network are needed, so the numbers are reproducible.
+#
+#       Examples:
+#           ./replay.py --flows 1000 --packets-per-flow 20 --payload 0-1460 --replies
+#           ./replay.py --pcap capture.pcap forward.json
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+
+import argparse
+from time import monotonic
+from forwarder import conntrack, engine, flowcache, nat, profiling, replay, rules
+from packet import batch
+
+# Used for synthetic mixes when no rules file is given: every client in 10.0.0.0/8 connecting to
+# port 8005 on the forwarder (FORWARDER_IP) is forwarded to SYNTHETIC_TARGET.
+SYNTHETIC_SOURCE="10.0.0.0/8:8005"
+SYNTHETIC_TARGET=("192.168.100.1", 80)
+FORWARDER_IP="172.16.0.1"
+
+BATCH_SIZE=64
+FLOW_CACHE_SIZE=flowcache.DEFAULT_CAPACITY
+
+#########################################################################################################
+# FUNCTION
+#
+#   Name:		parse_range
+#
+#    Prototype:	def parse_range(text)
+#
+#    Developer:	Mat Siwoski/Shane Spoor
+#
+#    Created On: 2026-10-17
+#
+#    Parameters:
+#    text - "N" or "MIN-MAX".
+#
+#    Return Values:
+#    A (min, max) tuple.
+#
+#    Description:
+#    This function parses the --payload option.
+#
+#    Revisions:
+#	(none)
+#
+#########################################################################################################
+def parse_range(text):
+    low, dash, high = text.partition('-')
+    low = int(low)
+    high = int(high) if dash else low
+    if not 0 <= low <= high <= 65495:
+        raise argparse.ArgumentTypeError("invalid payload size range " + text)
+    return (low, high)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline forwarder benchmark")
+    parser.add_argument("rules", nargs="?", help="forwarding rules file (default: a single " + SYNTHETIC_SOURCE + " rule)")
+    parser.add_argument("--pcap", help="replay the IPv4 TCP packets in this pcap file instead of a synthetic mix")
+    parser.add_argument("--flows", type=int, default=1000, help="synthetic connections (default: 1000)")
+    parser.add_argument("--packets-per-flow", type=int, default=20, help="client packets per synthetic connection (default: 20)")
+    parser.add_argument("--payload", type=parse_range, default=(0, 1460), help="synthetic payload size, N or MIN-MAX (default: 0-1460)")
+    parser.add_argument("--replies", action="store_true", help="answer every forwarded segment, so both directions are measured")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="packets per batch (default: " + str(BATCH_SIZE) + ")")
+    parser.add_argument("--repeat", type=int, default=1, help="run the replay this many times, with fresh state each time")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic mix")
+    parser.add_argument("--no-flow-cache", action="store_true", help="send every packet through the slow path")
+    parser.add_argument("--batch-headers", action="store_true", help="forward cached flows a batch at a time with NumPy (see packet/batch.py)")
+    parser.add_argument("--stages", action="store_true", help="time each stage of the engine and print the breakdown (see forwarder/profiling.py)")
+    args = parser.parse_args()
+
+    if args.rules:
+        forward_rules = rules.load_rules(args.rules)
+    else:
+        forward_rules = rules.RuleTable()
+        network, prefix_len, low_port, high_port = rules.parse_source(SYNTHETIC_SOURCE)
+        forward_rules.add(network, prefix_len, low_port, high_port, rules.ForwardTarget(*SYNTHETIC_TARGET))
+
+    forwarder_ip = rules.ip_to_int(FORWARDER_IP)
+    if args.pcap:
+        packets = replay.read_pcap(args.pcap)
+        source = None
+    else:
+        sources = [rule[:4] for rule in forward_rules.rules]
+        packets = replay.synthetic_packets(sources, forwarder_ip, args.flows, args.packets_per_flow, args.payload, args.seed)
+        source = forwarder_ip
+    if not packets:
+        parser.error("no IPv4 TCP packets to replay" + (" in " + args.pcap if args.pcap else "; --flows and --packets-per-flow must be above 0"))
+
+    targets = None
+    if args.replies:
+        if source is None:
+            parser.error("--replies only works with synthetic mixes")
+        targets = set(backend.ip for rule in forward_rules.rules for backend in rule[4].backends)
+
+    if args.batch_headers and not batch.AVAILABLE:
+        parser.error("--batch-headers needs NumPy")
+
+    print("Replaying " + str(len(packets)) + " packets, " + str(len(forward_rules)) + " rules, batches of " + str(args.batch))
+
+    for run in range(args.repeat):
+        nat_table = nat.NatTable()
+        tracker = conntrack.ConnTracker(nat_table, monotonic(), conntrack.DEFAULT_TIMEOUTS)
+        flow_cache = None if args.no_flow_cache else flowcache.FlowCache(nat_table, FLOW_CACHE_SIZE)
+        packet_batch = batch.PacketBatch(args.batch, max(map(len, packets))) if args.batch_headers else None
+        timer = profiling.StageTimer() if args.stages else None
+        if timer is not None:
+            timer.enable()
+        forwarding_engine = engine.Engine(forward_rules, nat_table, tracker, flow_cache, packet_batch=packet_batch, timer=timer)
+
+        result = replay.replay(forwarding_engine, packets, args.batch, source, targets)
+
+        print("\nRun " + str(run + 1) + ":")
+        print(result)
+        classifier = forwarding_engine.classifier
+        if classifier.rejected:
+            print("Rejected: " + str(classifier.not_tcp) + " not TCP, " + str(classifier.fragments) + " fragments, " + str(classifier.short) + " truncated, " +
+                  str(classifier.unmatched) + " unrelated")
+        if flow_cache is not None:
+            print("Flow cache: " + str(flow_cache.hits) + " hits, " + str(flow_cache.misses) + " misses, " + str(flow_cache.evictions) + " evictions")
+        if timer is not None:
+            print(timer.report())
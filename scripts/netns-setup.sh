@@ -0,0 +1,84 @@
+#!/bin/sh
+###################################################################################################
+#Name:	netns-setup.sh
+#
+#       Developer:	Mat Siwoski/Shane Spoor
+#
+#       Created On: 2026-10-17
+#
+#       Description:
+#       Builds a client -> forwarder -> server test network on one machine out of network namespaces
+#       and veth pairs, so the forwarder (including the fanout workers) can be tried without real hosts:
+#
+#           fwd-client 10.0.1.2 <-> 10.0.1.1 fwd-router 10.0.2.1 <-> 10.0.2.2 fwd-server
+#
+#       The router's kernel would answer the forwarded ports with RSTs (iprules.txt drops those with
+#       iptables). Here the router's connected routes are moved to a table that only packets with
+#       fwmark 1 use, so only the forwarder's output (run it with --mark 1) can leave the router and
+#       nothing but iproute2 is needed.
+#
+#       veth devices leave TCP checksums to "hardware" by default, so segments reach the router with
+#       only a partial checksum. The forwarder adjusts the checksum it receives rather than recomputing
+#       it, so transmit checksum offload is turned off on the client and server ends.
+#
+#       Usage: netns-setup.sh [up|down]
+#       Then:  ip netns exec fwd-router ./main.py scripts/netns-forward.json --mark 1 --workers 4
+#              ip netns exec fwd-server python3 -m http.server 8080
+#              ip netns exec fwd-client curl http://10.0.1.1:8005/
+#
+#    Revisions:
+#    (none)
+#
+###################################################################################################
+set -e
+
+case "${1:-up}" in
+up)
+    for ns in fwd-client fwd-router fwd-server; do
+        ip netns add $ns
+        ip -n $ns link set lo up
+    done
+
+    ip link add veth-client type veth peer name veth-rc
+    ip link set veth-client netns fwd-client
+    ip link set veth-rc netns fwd-router
+    ip link add veth-server type veth peer name veth-rs
+    ip link set veth-server netns fwd-server
+    ip link set veth-rs netns fwd-router
+
+    ip -n fwd-client addr add 10.0.1.2/24 dev veth-client
+    ip -n fwd-router addr add 10.0.1.1/24 dev veth-rc
+    ip -n fwd-router addr add 10.0.2.1/24 dev veth-rs
+    ip -n fwd-server addr add 10.0.2.2/24 dev veth-server
+
+    ip -n fwd-client link set veth-client up
+    ip -n fwd-router link set veth-rc up
+    ip -n fwd-router link set veth-rs up
+    ip -n fwd-server link set veth-server up
+
+    # Turn off tx checksum offload (ETHTOOL_STXCSUM), without needing ethtool installed
+    for pair in fwd-client:veth-client fwd-server:veth-server; do
+        ip netns exec ${pair%%:*} python3 -c '
+import array, fcntl, socket, struct, sys
+value = array.array("I", [0x17, 0])
+ifreq = struct.pack("16sP", sys.argv[1].encode(), value.buffer_info()[0])
+fcntl.ioctl(socket.socket(), 0x8946, ifreq)' ${pair#*:}
+    done
+
+    # Only marked (i.e. forwarded) packets get a route out of the router
+    ip -n fwd-router route del 10.0.1.0/24 dev veth-rc
+    ip -n fwd-router route del 10.0.2.0/24 dev veth-rs
+    ip -n fwd-router route add 10.0.1.0/24 dev veth-rc table 100
+    ip -n fwd-router route add 10.0.2.0/24 dev veth-rs table 100
+    ip -n fwd-router rule add fwmark 1 lookup 100
+    ;;
+down)
+    for ns in fwd-client fwd-router fwd-server; do
+        ip netns del $ns 2>/dev/null || true
+    done
+    ;;
+*)
+    echo "Usage: $0 [up|down]" >&2
+    exit 1
+    ;;
+esac